@@ -0,0 +1,664 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from googleapiclient.discovery import build_from_document
+from httplib2 import Http
+from zoomout import ZoomOut, parse_args, zoomout_options
+from records import HostRegistry, Meeting
+from datetime import datetime, timedelta
+import argparse
+import email
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+# Bytes every synthetic recording file is cut from, starting like an MP4 file
+SYNTHETIC_BLOCK = '\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom' + os.urandom(1024 * 1024 - 24)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        # Wakes the threads waiting on idle keep-alive connections, so they end before the interpreter does
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _dispatch(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        parsed = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        status, headers, content = self.server.fake.handle(self.command, parsed.path, query, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if callable(content):
+            self.end_headers()
+            content(self.wfile)
+        else:
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(object):
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """Initializer for a FakeServer: an HTTP server on a free local port, answering every request on its own thread
+        through handle(). Subclasses answer the requests in route().
+
+        latency: Seconds every request waits before it is answered
+
+        error_rate: Fraction of the requests flagged by route() as unreliable that fail with a server error
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.fake = self
+        self.server.connections = set()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        """Starts answering requests in the background. Returns the server."""
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server and closes its socket"""
+        self.server.shutdown()
+        self.server.close_connections()
+        self.server.server_close()
+
+    def count(self, name, amount=1):
+        """Adds to a named counter, like the calls made to one endpoint"""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + amount
+
+    def fail(self):
+        """Returns True when a request should fail, at the configured error rate"""
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def handle(self, method, path, query, headers, body):
+        """Answers one HTTP request. Returns (status, headers dict, content), where content is a string or a function
+        writing the response body to a file object."""
+        if self.latency:
+            time.sleep(self.latency)
+        return self.route(method, path, query, headers, body)
+
+    def route(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+    @staticmethod
+    def json_response(content, status=200):
+        """Returns the handle() result for a JSON body"""
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(content)
+
+
+def zoom_user(number):
+    """Returns a Zoom v1 user/list entry for fake host number, with the fields Zoom sends"""
+    return dict(id='user{0}'.format(number),
+                email='host{0}@example.edu'.format(number),
+                first_name='Host',
+                last_name=str(number),
+                pic_url='',
+                type=2,
+                pmi=8000000000 + number,
+                dept='',
+                timezone='America/Indiana/Indianapolis',
+                verified=1,
+                disable_chat=False,
+                enable_e2e_encryption=False,
+                enable_silent_mode=False,
+                disable_recording=False,
+                enable_cmr=True,
+                enable_auto_recording=False,
+                enable_cloud_auto_recording=False,
+                meeting_capacity=0,
+                enable_webinar=False,
+                enable_large=False,
+                lastClientVersion='4.0.25513.0228(mac)',
+                lastLoginTime='2017-03-01T14:00:00Z',
+                created_at='2015-08-20T17:38:11Z',
+                token='',
+                zpk='')
+
+
+def zoom_recording(user, meeting_number, topic, start_time, files, file_size, download_root):
+    """Returns a Zoom v1 recording/list entry with the fields Zoom sends, holding files recording files of file_size
+    bytes downloaded from download_root followed by the file id"""
+    meeting_uuid = 'uuid-{0}=='.format(meeting_number)
+    started = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%SZ')
+    ended = (started + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    recording_files = []
+    for index in range(files):
+        file_id = 'file-{0}-{1}'.format(meeting_number, index)
+        recording_files.append(dict(id=file_id,
+                                    meeting_id=meeting_uuid,
+                                    recording_start=start_time,
+                                    recording_end=ended,
+                                    file_type='MP4' if index % 2 == 0 else 'M4A',
+                                    file_size=file_size,
+                                    play_url='https://zoom.us/recording/play/' + hashlib.sha1(file_id).hexdigest(),
+                                    download_url=download_root + file_id,
+                                    status='completed',
+                                    recording_type='shared_screen_with_speaker_view'))
+    return dict(uuid=meeting_uuid,
+                id=meeting_uuid,
+                meeting_number=meeting_number,
+                account_id='account0',
+                host_id=user['id'],
+                topic=topic,
+                start_time=start_time,
+                timezone='America/Indiana/Indianapolis',
+                duration=60,
+                total_size=file_size * files,
+                recording_count=files,
+                recording_files=recording_files)
+
+
+class FakeZoom(FakeServer):
+    def __init__(self, users=10, meetings=5, files=2, file_size=8 * 1024 * 1024, **kwargs):
+        """Initializer for FakeZoom: a stand-in for the Zoom v1 endpoints ZoomOut calls (user/list, recording/list with
+        its from and to dates, and recording/delete) and for the download URLs of the recordings, which serve synthetic
+        MP4 bytes. Downloads fail with a 500 at the error rate.
+
+        users: Number of hosts in the account
+
+        meetings: Number of recorded meetings per host, all two days old or older
+
+        files: Number of recording files per meeting
+
+        file_size: Size in bytes of every recording file
+
+        Takes the latency and error_rate keyword arguments of FakeServer.
+        """
+        super(FakeZoom, self).__init__(**kwargs)
+        self.file_size = file_size
+        self.users = [zoom_user(user) for user in range(users)]
+        self.recordings = {}
+        self.recording_files = {}
+        meeting_numbers = itertools.count(100000000)
+        started = datetime.utcnow() - timedelta(days=2)
+        for user in self.users:
+            self.recordings[user['id']] = []
+            for meeting in range(meetings):
+                recording = zoom_recording(user, next(meeting_numbers), 'Benchmark meeting {0}'.format(meeting),
+                                           (started - timedelta(hours=meeting)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                           files, file_size, self.url + 'download/')
+                for recording_file in recording['recording_files']:
+                    self.recording_files[recording_file['id']] = recording
+                self.recordings[user['id']].append(recording)
+
+    @property
+    def total_files(self):
+        """Number of recording files the account started with"""
+        return len(self.recording_files)
+
+    def route(self, method, path, query, headers, body):
+        if method == 'GET' and path.startswith('/download/'):
+            self.count('download')
+            if self.fail():
+                return 500, {}, 'Internal Server Error'
+            self.count('download_bytes', self.file_size)
+            return 200, {'Content-Type': 'video/mp4', 'Content-Length': str(self.file_size)}, self.write_recording
+        params = dict(urlparse.parse_qsl(body))
+        endpoint = path[len('/v1/'):]
+        self.count(endpoint)
+        page_number = int(params.get('page_number', 1))
+        page_size = int(params.get('page_size', 30))
+        if endpoint == 'user/list':
+            return self.json_response(self.page(self.users, 'users', page_number, page_size))
+        if endpoint == 'recording/list':
+            with self.lock:
+                recordings = [dict(recording, recording_files=list(recording['recording_files']))
+                              for recording in self.recordings.get(params.get('host_id'), [])
+                              if params.get('from', '0000') <= recording['start_time'][:10] <= params.get('to', '9999')]
+            return self.json_response(self.page(recordings, 'meetings', page_number, page_size))
+        if endpoint == 'recording/delete':
+            with self.lock:
+                recording = self.recording_files.get(params.get('file_id'))
+                if recording is not None:
+                    recording['recording_files'] = [recording_file for recording_file in recording['recording_files']
+                                                    if recording_file['id'] != params['file_id']]
+                    if not recording['recording_files'] and recording in self.recordings[recording['host_id']]:
+                        self.recordings[recording['host_id']].remove(recording)
+            if recording is None:
+                return self.json_response({'error': {'code': 3001, 'message': 'File does not exist'}})
+            return self.json_response({'id': params['meeting_id'], 'deleted_at': datetime.utcnow().isoformat()})
+        return self.json_response({'error': {'code': 404, 'message': 'Unknown endpoint'}}, status=404)
+
+    @staticmethod
+    def page(items, key, page_number, page_size):
+        """Returns one page of a Zoom list response"""
+        start = (page_number - 1) * page_size
+        return {'page_count': max(1, (len(items) + page_size - 1) // page_size),
+                'page_number': page_number,
+                'page_size': page_size,
+                'total_records': len(items),
+                key: items[start:start + page_size]}
+
+    def write_recording(self, output):
+        """Writes file_size synthetic MP4 bytes to a response"""
+        remaining = self.file_size
+        while remaining > 0:
+            block = SYNTHETIC_BLOCK[:remaining]
+            output.write(block)
+            remaining -= len(block)
+
+
+def drive_discovery(root_url):
+    """Returns a discovery document for the part of the Drive API v3 ZoomOut uses, served from root_url"""
+    string = {'type': 'string', 'location': 'query'}
+    file_id = {'type': 'string', 'location': 'path', 'required': True}
+    schema = lambda name: {'id': name, 'type': 'object'}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'drive:v3',
+        'name': 'drive',
+        'version': 'v3',
+        'rootUrl': root_url,
+        'servicePath': 'drive/v3/',
+        'batchPath': 'batch',
+        'parameters': {'alt': {'type': 'string', 'location': 'query', 'default': 'json'},
+                       'fields': string},
+        'schemas': {'File': schema('File'), 'FileList': schema('FileList'), 'Permission': schema('Permission')},
+        'resources': {
+            'files': {'methods': {
+                'list': {'id': 'drive.files.list', 'path': 'files', 'httpMethod': 'GET',
+                         'parameters': {'q': string, 'pageToken': string,
+                                        'pageSize': {'type': 'integer', 'location': 'query'}},
+                         'response': {'$ref': 'FileList'}},
+                'create': {'id': 'drive.files.create', 'path': 'files', 'httpMethod': 'POST', 'parameters': {},
+                           'request': {'$ref': 'File'}, 'response': {'$ref': 'File'},
+                           'supportsMediaUpload': True,
+                           'mediaUpload': {'accept': ['*/*'], 'maxSize': '5120GB',
+                                           'protocols': {'simple': {'multipart': True,
+                                                                    'path': '/upload/drive/v3/files'},
+                                                         'resumable': {'multipart': True,
+                                                                       'path': '/resumable/upload/drive/v3/files'}}}},
+                'get': {'id': 'drive.files.get', 'path': 'files/{fileId}', 'httpMethod': 'GET',
+                        'parameters': {'fileId': file_id}, 'parameterOrder': ['fileId'],
+                        'response': {'$ref': 'File'}},
+                'delete': {'id': 'drive.files.delete', 'path': 'files/{fileId}', 'httpMethod': 'DELETE',
+                           'parameters': {'fileId': file_id}, 'parameterOrder': ['fileId']}}},
+            'permissions': {'methods': {
+                'create': {'id': 'drive.permissions.create', 'path': 'files/{fileId}/permissions', 'httpMethod': 'POST',
+                           'parameters': {'fileId': file_id, 'emailMessage': string,
+                                          'sendNotificationEmail': {'type': 'boolean', 'location': 'query'}},
+                           'parameterOrder': ['fileId'],
+                           'request': {'$ref': 'Permission'}, 'response': {'$ref': 'Permission'}}}}}}
+
+
+class FakeDrive(FakeServer):
+    def __init__(self, **kwargs):
+        """Initializer for FakeDrive: a stand-in for the Drive API v3 holding files in memory. It answers files.list
+        (with the query terms ZoomOut uses), files.create with resumable uploads, files.get, files.delete,
+        permissions.create and batch requests. Upload chunks fail with a 503 at the error rate. Uploaded bytes are
+        counted and hashed, not kept.
+
+        Takes the latency and error_rate keyword arguments of FakeServer.
+        """
+        super(FakeDrive, self).__init__(**kwargs)
+        self.files = {}
+        self.sessions = {}
+        self.ids = itertools.count(1)
+
+    def route(self, method, path, query, headers, body):
+        if method == 'POST' and path == '/batch':
+            return self.batch(headers, body)
+        if path.startswith('/upload/drive/v3/files'):
+            return self.upload(method, query, headers, body)
+        self.count('{0} {1}'.format(method, re.sub(r'files/[^/]+', 'files/{fileId}', path[len('/drive/v3/'):])))
+        return self.metadata(method, path[len('/drive/v3/'):], query, body)
+
+    def metadata(self, method, path, query, body):
+        """Answers a files or permissions call"""
+        parts = path.split('/')
+        if parts == ['files'] and method == 'GET':
+            return self.json_response(self.list_files(query))
+        if parts == ['files'] and method == 'POST':
+            return self.json_response(self.create_file(json.loads(body or '{}')))
+        if len(parts) == 2 and parts[1] in self.files:
+            if method == 'GET':
+                return self.json_response(self.files[parts[1]])
+            if method == 'DELETE':
+                with self.lock:
+                    del self.files[parts[1]]
+                return 204, {}, ''
+        if len(parts) == 3 and parts[2] == 'permissions' and parts[1] in self.files:
+            permission = json.loads(body or '{}')
+            permission.update(id='permission{0}'.format(next(self.ids)), kind='drive#permission')
+            return self.json_response(permission)
+        return self.json_response({'error': {'code': 404, 'message': 'File not found'}}, status=404)
+
+    def create_file(self, resource):
+        """Stores a new file resource. Returns it."""
+        resource = dict(resource, id='drive{0}'.format(next(self.ids)), kind='drive#file')
+        resource.setdefault('mimeType', 'application/octet-stream')
+        with self.lock:
+            self.files[resource['id']] = resource
+        return resource
+
+    def list_files(self, query):
+        """Returns a page of the files matching a q expression built from mimeType equality and appProperties terms"""
+        q = query.get('q', '')
+        mime_type = re.search(r"mimeType\s*=\s*'([^']*)'", q)
+        properties = re.findall(r"appProperties has \{\s*key='([^']*)' and value='([^']*)'\s*\}", q)
+        with self.lock:
+            files = sorted(self.files.values(), key=lambda resource: int(resource['id'][len('drive'):]))
+        matches = [resource for resource in files
+                   if (not mime_type or resource.get('mimeType') == mime_type.group(1))
+                   and all(str((resource.get('appProperties') or {}).get(key)) == value for key, value in properties)]
+        start = int(query.get('pageToken') or 0)
+        size = int(query.get('pageSize') or 100)
+        response = {'kind': 'drive#fileList', 'files': matches[start:start + size]}
+        if start + size < len(matches):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+    def upload(self, method, query, headers, body):
+        """Answers the requests of a resumable upload: the one opening the session, then the chunks and status
+        queries sent to it"""
+        if method == 'POST':
+            self.count('upload session')
+            session_id = str(next(self.ids))
+            with self.lock:
+                self.sessions[session_id] = dict(resource=json.loads(body or '{}'), received=0, md5=hashlib.md5())
+            return 200, {'Location': '{0}upload/drive/v3/files?uploadType=resumable&upload_id={1}'.
+                         format(self.url, session_id)}, ''
+        self.count('upload chunk')
+        session = self.sessions.get(query.get('upload_id'))
+        if session is None:
+            return self.json_response({'error': {'code': 404, 'message': 'Upload session not found'}}, status=404)
+        if body and self.fail():
+            return self.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, status=503)
+        content_range = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', headers.get('content-range', ''))
+        total = content_range and content_range.group(4)
+        with self.lock:
+            if content_range and content_range.group(2) is not None:
+                start = int(content_range.group(2))
+                if start <= session['received']:
+                    fresh = body[session['received'] - start:]
+                    session['md5'].update(fresh)
+                    session['received'] += len(fresh)
+                    self.calls['upload_bytes'] = self.calls.get('upload_bytes', 0) + len(body)
+            finished = total not in (None, '*') and session['received'] >= int(total)
+        if finished:
+            self.count('upload finished')
+            resource = dict(session['resource'], md5Checksum=session['md5'].hexdigest(), size=str(session['received']))
+            return self.json_response(self.create_file(resource))
+        headers = {'Range': 'bytes=0-{0}'.format(session['received'] - 1)} if session['received'] else {}
+        return 308, headers, ''
+
+    def batch(self, headers, body):
+        """Answers a multipart/mixed batch request by running each of its calls"""
+        self.count('batch')
+        message = email.message_from_string('Content-Type: {0}\r\n\r\n{1}'.format(headers['content-type'], body))
+        boundary = 'batch_{0}'.format(next(self.ids))
+        parts = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, url, _ = request_line.split(' ', 2)
+            call_body = rest.replace('\r\n', '\n').partition('\n\n')[2]
+            parsed = urlparse.urlparse(url)
+            path = parsed.path[len('/drive/v3/'):]
+            self.count('batched {0} {1}'.format(method, re.sub(r'files/[^/]+', 'files/{fileId}', path)))
+            status, _, content = self.metadata(method, path, dict(urlparse.parse_qsl(parsed.query)), call_body)
+            parts.append('--{0}\r\nContent-Type: application/http\r\nContent-ID: <response-{1}\r\n\r\n'
+                         'HTTP/1.1 {2} OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{3}\r\n'.
+                         format(boundary, part['Content-ID'][1:], status, content))
+        content = ''.join(parts) + '--{0}--\r\n'.format(boundary)
+        return 200, {'Content-Type': 'multipart/mixed; boundary={0}'.format(boundary)}, content
+
+
+class BenchmarkZoomOut(ZoomOut):
+    def __init__(self, drive_url, *args, **kwargs):
+        """Initializer for a ZoomOut that talks to a FakeDrive at drive_url instead of Google. Takes the arguments of
+        ZoomOut after it."""
+        self.drive_url = drive_url
+        super(BenchmarkZoomOut, self).__init__(*args, **kwargs)
+
+    def authorize_with_drive(self):
+        """Returns a Drive API v3 resource object bound to the fake Drive server, without credentials"""
+        return build_from_document(drive_discovery(self.drive_url), http=Http())
+
+
+def run_benchmark(args, zoomout_args):
+    """Starts a FakeZoom and a FakeDrive, runs ZoomOut.main (or list_eligible, with --dry-run) against them in a scratch
+    directory and stops them.
+
+    args: Namespace from parse_benchmark_args
+
+    zoomout_args: Namespace from zoomout.parse_args, holding the ZoomOut options under test
+
+    Returns a dict of measurements
+    """
+    zoom = FakeZoom(users=args.users, meetings=args.meetings, files=args.files, file_size=args.file_size * 1024,
+                    latency=args.latency, error_rate=args.error_rate).start()
+    drive = FakeDrive(latency=args.latency, error_rate=args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix='zoomout-benchmark-')
+    cwd, stdout = os.getcwd(), sys.stdout
+    os.environ.update(ZOOM_API_KEY='benchmark',
+                      ZOOM_API_SECRET='benchmark',
+                      ZOOM_API_URL=zoom.url + 'v1/',
+                      ZOOMOUT_DONEFILE_PATH=os.path.join(workdir, 'done'),
+                      ZOOMOUT_INDEX_PATH=os.path.join(workdir, 'zoomout_index.db'),
+                      ZOOMOUT_JOURNAL_PATH=os.path.join(workdir, 'zoomout_journal.jsonl'))
+    os.environ.pop('ZOOMOUT_MESSAGING_JSON', None)
+    try:
+        lim = int(zoomout_args.limit) if zoomout_args.limit is not None else 1
+        os.chdir(workdir)
+        if args.quiet:
+            sys.stdout = open(os.devnull, 'w')
+        started = time.time()
+        zoomout = BenchmarkZoomOut(drive.url, limit=lim, **zoomout_options(zoomout_args))
+        try:
+            if zoomout_args.dry_run:
+                zoomout.list_eligible()
+            else:
+                zoomout.main()
+        except SystemExit:
+            pass  # ZoomOut.main exits after logging a fatal error; the counters still tell what got done
+        elapsed = time.time() - started
+        finished = os.path.exists(os.environ['ZOOMOUT_DONEFILE_PATH'])
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        zoom.stop()
+        drive.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    archived = zoom.calls.get('recording/delete', 0)
+    zoom_api_calls = sum(count for name, count in zoom.calls.items() if '/' in name)
+    drive_requests = sum(count for name, count in drive.calls.items()
+                         if not name.startswith('batched ') and not name.endswith('bytes') and name != 'upload finished')
+    return dict(finished=finished,
+                elapsed=elapsed,
+                files=zoom.total_files,
+                archived=archived,
+                uploaded_bytes=drive.calls.get('upload_bytes', 0),
+                downloaded_bytes=zoom.calls.get('download_bytes', 0),
+                files_per_second=archived / max(elapsed, 0.001),
+                bytes_per_second=archived * zoom.file_size / max(elapsed, 0.001),
+                zoom_api_calls=zoom_api_calls,
+                drive_requests=drive_requests,
+                api_calls_per_file=(zoom_api_calls + drive_requests) / float(max(archived, 1)),
+                zoom_calls=zoom.calls,
+                drive_calls=drive.calls,
+                phases=zoomout.metrics.summary()['phases'],
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def format_report(report):
+    """Returns a measurement dict from run_benchmark as readable lines"""
+    lines = ["Run {0} in {1:.2f} seconds".format('finished' if report['finished'] else 'DID NOT FINISH', report['elapsed']),
+             "Archived {0} of {1} recording files".format(report['archived'], report['files']),
+             "Throughput: {0:.2f} files/sec, {1:.2f} MB/sec".format(report['files_per_second'],
+                                                                   report['bytes_per_second'] / (1024 * 1024)),
+             "API calls: {0} to Zoom, {1} HTTP requests to Drive, {2:.2f} per archived file".
+             format(report['zoom_api_calls'], report['drive_requests'], report['api_calls_per_file']),
+             "Bytes: {0} downloaded from Zoom, {1} sent to Drive".format(report['downloaded_bytes'],
+                                                                        report['uploaded_bytes']),
+             "Peak memory (RSS, including the fake servers): {0:.1f} MB".format(report['peak_rss_kb'] / 1024.0)]
+    for phase, summary in sorted(report['phases'].items()):
+        if 'count' in summary:
+            lines.append("  {0}: {1} calls, {2} errors, mean {3:.3f}s, p95 {4:.3f}s, max {5:.3f}s".format(
+                phase, summary['count'], summary.get('errors', 0), summary['mean'], summary['p95'], summary['max']))
+    for server in ('zoom', 'drive'):
+        for name, count in sorted(report[server + '_calls'].items()):
+            lines.append("  {0} {1}: {2}".format(server, name, count))
+    return '\n'.join(lines)
+
+
+def deep_size(obj):
+    """Returns the bytes held by obj and everything it references, counting an object referenced from several places
+    once. Follows dicts, lists, tuples, sets and the attributes of objects with __slots__ or a __dict__."""
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            for cls in type(obj).__mro__:
+                stack.extend(getattr(obj, slot) for slot in cls.__dict__.get('__slots__', ()) if hasattr(obj, slot))
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+    return size
+
+
+def memory_benchmark(meetings=100000, files=2, meetings_per_host=100):
+    """Measures the memory held by the meetings of a large account kept two ways: as collect_meetings used to keep
+    them, a dict holding the host's user dict and the raw recording dict parsed from Zoom's JSON, and as the Meeting
+    records it builds now. Each host's recording list is parsed from JSON like the Zoom client does, so strings aren't
+    shared in ways a real run wouldn't share them.
+
+    meetings: Number of recorded meetings in the account
+
+    files: Recording files per meeting
+
+    meetings_per_host: Recorded meetings per host
+
+    Returns a dict of measurements
+    """
+    started = datetime.utcnow() - timedelta(days=2)
+    hosts = (meetings + meetings_per_host - 1) // meetings_per_host
+
+    def pages():
+        # Yields each host's user dict and recording list as a Zoom client would parse them
+        users = json.loads(json.dumps([zoom_user(number) for number in range(hosts)]))
+        meeting_numbers = itertools.count(100000000)
+        for number, user in enumerate(users):
+            count = min(meetings_per_host, meetings - number * meetings_per_host)
+            page = [zoom_recording(user, next(meeting_numbers), 'Weekly meeting {0}'.format(meeting),
+                                   (started - timedelta(hours=meeting)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                   files, 512 * 1024 * 1024, 'https://zoom.us/recording/download/')
+                    for meeting in range(count)]
+            yield user, json.loads(json.dumps(page))
+
+    report = dict(meetings=meetings, files=files, hosts=hosts)
+    timer = time.time()
+    raw = [dict(host=user, recording=recording) for user, page in pages() for recording in page]
+    report['raw_seconds'] = time.time() - timer
+    report['raw_bytes'] = deep_size(raw)
+    del raw
+
+    registry = HostRegistry()
+    timer = time.time()
+    records = [Meeting.from_zoom(registry.get(user), recording) for user, page in pages() for recording in page]
+    report['records_seconds'] = time.time() - timer
+    report['records_bytes'] = deep_size(records)
+    del records
+    report['reduction'] = 1 - report['records_bytes'] / float(max(report['raw_bytes'], 1))
+    return report
+
+
+def format_memory_report(report):
+    """Returns a measurement dict from memory_benchmark as readable lines"""
+    lines = ["{0} meetings from {1} hosts, {2} recording files each".format(report['meetings'], report['hosts'],
+                                                                          report['files'])]
+    for name, label in (('raw', 'Raw Zoom JSON dicts'), ('records', 'Meeting records')):
+        lines.append("{0}: {1:.1f} MB, {2} bytes per meeting, built in {3:.2f} seconds".format(
+            label, report[name + '_bytes'] / (1024.0 * 1024), report[name + '_bytes'] // max(report['meetings'], 1),
+            report[name + '_seconds']))
+    lines.append("Reduction: {0:.1%}".format(report['reduction']))
+    return '\n'.join(lines)
+
+
+def parse_benchmark_args(argv):
+    """Parses the benchmark's command line. Returns the benchmark's Namespace and the Namespace of the ZoomOut options
+    given after them."""
+    parser = argparse.ArgumentParser(description="Runs ZoomOut end to end against local stand-ins for Zoom and Drive "
+                                                 "and reports its throughput. Options not listed here are passed to "
+                                                 "ZoomOut, e.g. --stream or --upload-workers 4.")
+    parser.add_argument('--users', type=int, default=10, help="Hosts in the fake Zoom account. Defaults to 10.")
+    parser.add_argument('--meetings', type=int, default=5, help="Recorded meetings per host. Defaults to 5.")
+    parser.add_argument('--files', type=int, default=2, help="Recording files per meeting. Defaults to 2.")
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help="Size of each recording file in kilobytes. Defaults to 4096.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds added to every request to either server. Defaults to 0.")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of downloads and upload chunks that fail with a server error. Defaults to 0.")
+    parser.add_argument('--quiet', action='store_true', help="Hide ZoomOut's log while it runs.")
+    parser.add_argument('--json', action='store_true', help="Print the measurements as JSON.")
+    parser.add_argument('--memory', type=int, metavar='MEETINGS',
+                        help="Instead of running ZoomOut, compare the memory held by MEETINGS meetings (e.g. 100000) "
+                             "as raw Zoom JSON and as Meeting records. --files sets the recording files per meeting.")
+    args, rest = parser.parse_known_args(argv)
+    return args, parse_args(rest)
+
+
+if __name__ == "__main__":
+    benchmark_args, zoomout_args = parse_benchmark_args(sys.argv[1:])
+    if benchmark_args.memory:
+        report = memory_benchmark(benchmark_args.memory, files=benchmark_args.files)
+        print(json.dumps(report, indent=2, sort_keys=True) if benchmark_args.json else format_memory_report(report))
+    else:
+        report = run_benchmark(benchmark_args, zoomout_args)
+        print(json.dumps(report, indent=2, sort_keys=True) if benchmark_args.json else format_report(report))
@@ -0,0 +1,89 @@
+from apiclient import errors
+from drive_upload import is_retryable, retry_delay
+from metrics import Metrics
+import time
+
+# Drive refuses batches of more than 100 calls
+MAX_BATCH_SIZE = 100
+
+
+class DriveBatch(object):
+    def __init__(self, drive, max_size=MAX_BATCH_SIZE, retries=5, metrics=None):
+        """Initializer for a DriveBatch, which collects Drive API requests and sends them as batch HTTP requests, so
+        a hundred metadata calls cost one round trip.
+
+        drive: Resource object for the Drive API v3, from ZoomOut.authorize_with_drive
+
+        max_size: Maximum number of calls per batch request
+
+        retries: Number of times a call failing with a retryable error is sent again in a later batch
+
+        metrics: Metrics that every batch request is timed in, as the 'drive batch' phase, along with its retried calls
+        """
+        self.drive = drive
+        self.max_size = max(1, min(max_size, MAX_BATCH_SIZE))
+        self.retries = retries
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, request, callback=None):
+        """Queues an unexecuted Drive request, like drive.files().create(...).
+
+        callback: Called as callback(response, exception) once the call finally succeeds or fails. exception is None on
+        success, response is None on failure.
+        """
+        self.pending.append((request, callback))
+
+    def execute(self):
+        """Sends every queued call, max_size at a time. Calls that fail with a retryable error are collected and sent
+        again after an exponential backoff with jitter. Returns the number of calls that failed for good."""
+        pending, self.pending = self.pending, []
+        failures = 0
+        attempt = 0
+        while pending:
+            retry = []
+            for start in range(0, len(pending), self.max_size):
+                retry.extend(self._execute_batch(pending[start:start + self.max_size], attempt))
+            failures += len([item for item in retry if item[2] is not None])
+            pending = [(request, callback) for request, callback, exc in retry if exc is None]
+            if pending:
+                self.metrics.add('retries', 'drive batch', len(pending))
+                attempt += 1
+                time.sleep(retry_delay(attempt))
+        return failures
+
+    def _execute_batch(self, items, attempt):
+        """Sends one batch request. Returns (request, callback, exception) for every call that didn't succeed, with
+        exception set to None for calls that should be retried."""
+        failed = []
+
+        def handle(request_id, response, exception):
+            request, callback = items[int(request_id)]
+            if exception is None:
+                if callback:
+                    callback(response, None)
+            elif is_retryable(exception) and attempt < self.retries:
+                failed.append((request, callback, None))
+            else:
+                failed.append((request, callback, exception))
+                if callback:
+                    callback(None, exception)
+
+        batch = self.drive.new_batch_http_request(callback=handle)
+        for index, (request, callback) in enumerate(items):
+            batch.add(request, request_id=str(index))
+        try:
+            with self.metrics.timer('drive batch'):
+                batch.execute()
+        except errors.HttpError as exc:
+            # The batch request as a whole failed, so none of its calls ran
+            if is_retryable(exc) and attempt < self.retries:
+                return [(request, callback, None) for request, callback in items]
+            for request, callback in items:
+                if callback:
+                    callback(None, exc)
+            return [(request, callback, exc) for request, callback in items]
+        return failed
@@ -0,0 +1,60 @@
+from metrics import log, write_atomically
+import json
+import os
+import threading
+import time
+import urllib2
+
+# Where build('drive', 'v3') fetches the Drive API's discovery document from
+DRIVE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+
+# Seconds a cached discovery document is used before it is fetched again
+MAX_AGE = 7 * 24 * 60 * 60
+
+_lock = threading.Lock()
+_documents = {}
+
+
+def load_discovery_document(path, url=DRIVE_DISCOVERY_URL, max_age=MAX_AGE):
+    """Returns the Drive API v3 discovery document as a JSON string, for googleapiclient's build_from_document, so
+    authorizing with Drive doesn't cost a network fetch. The document is kept in memory for the life of the process,
+    and on disk at path for max_age seconds. When it has to be fetched again but can't be, a stale copy on disk is still
+    used.
+
+    path: File the document is cached in
+
+    url: Where to fetch the document from
+
+    max_age: Seconds a document on disk is fresh for
+    """
+    with _lock:
+        if path not in _documents:
+            _documents[path] = _load(path, url, max_age)
+        return _documents[path]
+
+
+def _load(path, url, max_age):
+    cached = None
+    try:
+        with open(path, 'rb') as cache_file:
+            cached = cache_file.read()
+        json.loads(cached)
+        if time.time() - os.path.getmtime(path) < max_age:
+            return cached
+    except (IOError, OSError, ValueError):
+        cached = None  # Missing or unreadable: fetch it
+
+    try:
+        document = urllib2.urlopen(url, timeout=60).read()
+        json.loads(document)
+    except (urllib2.URLError, IOError, ValueError) as exc:
+        if cached is None:
+            raise
+        log("Couldn't refresh the Drive discovery document ({0}). Using the copy at {1}".format(exc, path))
+        return cached
+
+    try:
+        write_atomically(path, document)
+    except (IOError, OSError) as exc:
+        log("Couldn't cache the Drive discovery document at {0}: {1}".format(path, exc))
+    return document
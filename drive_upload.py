@@ -0,0 +1,175 @@
+from apiclient.http import MediaUpload
+from apiclient import errors
+import hashlib
+import json
+import random
+
+# Size of each read from the HTTP response while filling a chunk
+READ_SIZE = 1024 * 1024
+
+# Drive requires every chunk but the last to be a multiple of this
+CHUNK_MULTIPLE = 256 * 1024
+
+# Reasons Drive gives with a 403 when the caller should slow down and try again
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_retryable(exc):
+    """Returns True if a Drive HttpError is worth retrying: a 429, a 5xx, or a 403 for exceeding a rate limit. Any other
+    status is a permanent failure."""
+    if not isinstance(exc, errors.HttpError):
+        return False
+    status = exc.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        try:
+            reasons = [error.get('reason') for error in json.loads(exc.content)['error']['errors']]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return any(reason in RATE_LIMIT_REASONS for reason in reasons)
+    return False
+
+
+def retry_delay(attempt, retry_after=None, cap=64):
+    """Returns how many seconds to wait before retry number attempt (starting at 1).
+
+    retry_after: Value of the Retry-After header of the failed response, if any. A number of seconds there wins.
+
+    cap: Upper bound on the exponential part of the delay
+
+    Otherwise the delay is exponential with jitter: somewhere between half of and all of min(cap, 2 ** attempt), so
+    workers that failed together don't retry together.
+    """
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass  # An HTTP date. Fall back to backing off.
+    ceiling = min(cap, 2 ** attempt)
+    return ceiling / 2.0 + random.uniform(0, ceiling / 2.0)
+
+
+class AdaptiveChunkSize(object):
+    def __init__(self, initial, minimum=CHUNK_MULTIPLE, maximum=64 * 1024 * 1024, target_seconds=5.0):
+        """Initializer for AdaptiveChunkSize, which picks the size of each resumable upload chunk from the throughput
+        measured on the chunks before it, aiming for chunks that take target_seconds to send. Slow links get small
+        chunks that are cheap to resend, fast links get big chunks and few round trips.
+
+        initial: Size of the first chunk in bytes
+
+        minimum, maximum: Bounds on the chunk size in bytes. Sizes are kept to multiples of 256 KB.
+
+        target_seconds: How long each chunk should take to send
+        """
+        self.minimum = max(CHUNK_MULTIPLE, minimum - minimum % CHUNK_MULTIPLE)
+        self.maximum = max(self.minimum, maximum - maximum % CHUNK_MULTIPLE)
+        self.target_seconds = target_seconds
+        self.throughput = None
+        self.size = self.clamp(initial)
+
+    def clamp(self, size):
+        """Rounds size down to a multiple of 256 KB within the bounds"""
+        size = int(size)
+        return min(self.maximum, max(self.minimum, size - size % CHUNK_MULTIPLE))
+
+    def update(self, sent, seconds):
+        """Records that sent bytes took seconds to upload. Returns the size for the next chunk."""
+        if sent > 0 and seconds > 0:
+            rate = sent / seconds
+            # Smooth the estimate so one slow chunk doesn't collapse the size
+            self.throughput = rate if self.throughput is None else (self.throughput + rate) / 2
+            self.size = self.clamp(self.throughput * self.target_seconds)
+        return self.size
+
+
+class StreamRewindError(Exception):
+    """Raised when Drive asks for bytes that have already left the in-memory buffer of a StreamingMediaUpload."""
+    pass
+
+
+class StreamingMediaUpload(MediaUpload):
+    def __init__(self, stream, size=None, mimetype='application/octet-stream', chunksize=16 * 1024 * 1024):
+        """Media for a Drive resumable upload whose bytes come from a file-like object that can only be read forward,
+        such as the response from urllib2.urlopen. Holds at most one chunk in memory, so a chunk that fails can be sent
+        again without rereading the source. Every byte is hashed as it is first read from the stream, so the upload can
+        be checked against Drive's md5Checksum without reading the source again.
+
+        stream: Object with a read(n) method
+
+        size: Total number of bytes in the stream, or None if it is not known up front
+
+        mimetype: Mime type of the uploaded file
+
+        chunksize: Bytes sent per request. Drive requires a multiple of 256 KB.
+        """
+        super(StreamingMediaUpload, self).__init__()
+        self.stream = stream
+        self._size = size
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self.buffer = ''
+        self.buffer_start = 0
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+
+    def chunksize(self):
+        """Bytes sent per upload request."""
+        return self._chunksize
+
+    def mimetype(self):
+        """Mime type of the uploaded file."""
+        return self._mimetype
+
+    def size(self):
+        """Total size of the upload in bytes, or None when unknown."""
+        return self._size
+
+    def hexdigest(self):
+        """MD5 hash, in hex, of the bytes read from the stream so far. Once the upload has finished, that is the whole
+        file."""
+        return self.md5.hexdigest()
+
+    def read(self, length):
+        """Reads up to length bytes from the stream, adding them to the hash. Returns '' at the end of the stream."""
+        data = self.stream.read(length)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def resumable(self):
+        """Streams are always uploaded with a resumable session."""
+        return True
+
+    def has_stream(self):
+        """Always False. The client library seeks within streams it is handed, so it gets the bytes through getbytes()
+        instead."""
+        return False
+
+    def getbytes(self, begin, length):
+        """Returns up to length bytes starting at offset begin. Bytes before begin have been acknowledged by Drive and
+        are dropped from the buffer. When a resumed upload starts past the bytes read so far, the stream is read up to
+        begin and the skipped bytes are thrown away. Returns fewer bytes than asked for only at the end of the stream."""
+        if begin < self.buffer_start:
+            raise StreamRewindError("Drive asked for byte {0} but the buffer starts at byte {1}".
+                                    format(begin, self.buffer_start))
+        position = self.buffer_start + len(self.buffer)
+        while position < begin:
+            data = self.read(min(begin - position, READ_SIZE))
+            if not data:
+                break
+            position += len(data)
+        if position <= begin:
+            self.buffer = ''
+            self.buffer_start = position
+        pieces = [self.buffer[begin - self.buffer_start:]]
+        buffered = len(pieces[0])
+        while buffered < length:
+            data = self.read(min(length - buffered, READ_SIZE))
+            if not data:
+                break
+            pieces.append(data)
+            buffered += len(data)
+        self.buffer = ''.join(pieces)
+        self.buffer_start = begin
+        return self.buffer[:length]
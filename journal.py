@@ -0,0 +1,112 @@
+from records import HostRegistry, Meeting
+from datetime import datetime
+import json
+import os
+import threading
+
+
+class Journal(object):
+    def __init__(self, path, resume=False):
+        """Initializer for a Journal: an append-only file of JSON lines recording what happened to every meeting,
+        recording file and host during a run, flushed to disk as it is written so a crashed run can be picked up.
+
+        path: Location of the journal file
+
+        resume: When True, the entries already in the file are replayed into self.files, self.meetings (as Meeting
+        records) and self.hosts and new entries are appended. Otherwise, or when the previous run finished, the journal starts empty.
+
+        Only the replayed state is held in memory, and a replayed file's entry is dropped once the file settles, so a
+        long run's journal costs disk space but not memory.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.meetings = []
+        self.hosts = set()
+        self.meeting_uuids = set()
+        finished = True
+        if resume and os.path.exists(path):
+            finished = self.replay()
+        if finished:
+            self.files, self.meetings, self.hosts, self.meeting_uuids = {}, [], set(), set()
+        self.resuming = not finished
+        self.journal_file = open(path, 'a' if self.resuming else 'w')
+        if self.resuming and self.journal_file.tell() > 0:
+            self.journal_file.write('\n')  # Ends a line the crash may have cut short; replay skips blank lines
+
+    def replay(self):
+        """Reads the journal file. Returns True if the run it records finished."""
+        finished = False
+        host_records = HostRegistry()  # One Host per user, shared by the replayed meetings
+        with open(self.path, 'rb') as journal_file:
+            for line in journal_file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by the crash
+                state = entry['state']
+                if state == 'started':
+                    finished = False
+                elif state == 'finished':
+                    finished = True
+                elif state == 'enumerated':
+                    self.hosts.add(entry['host'])
+                elif state == 'discovered':
+                    meeting = Meeting.from_dict(entry['meeting'], host_records)
+                    if meeting.uuid not in self.meeting_uuids:
+                        self.meeting_uuids.add(meeting.uuid)
+                        self.meetings.append(meeting)
+                elif 'file' in entry:
+                    self.files.setdefault(entry['file'], {}).update(entry)
+        return finished
+
+    def discover(self, meeting):
+        """Records a Meeting handed out by Zoom. Returns False, without recording it again, if the journal already has
+        it from the run being resumed."""
+        with self.lock:
+            if meeting.uuid in self.meeting_uuids:
+                self.meeting_uuids.remove(meeting.uuid)  # Zoom lists a meeting once per run
+                return False
+        self.record('discovered', meeting=meeting.to_dict())
+        return True
+
+    def record(self, state, **details):
+        """Appends an entry and flushes it to disk.
+
+        state: What happened, one of 'started', 'discovered' (with meeting), 'enumerated' (with host), 'downloaded',
+        'uploading', 'uploaded', 'deleted', 'failed', 'deferred' (each with file), 'shared' (with host and folder),
+        'stopped' (the time budget ran out, so the run can be resumed) or 'finished'
+        """
+        details.update(state=state, time=datetime.utcnow().isoformat())
+        line = json.dumps(details) + '\n'
+        with self.lock:
+            if details.get('file') in self.files:
+                self.files[details['file']].update(details)
+            self.journal_file.write(line)
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def file_state(self, zoom_file_id):
+        """Returns the last journal entry for a recording file the resumed run left unsettled, merged with the details
+        of the entries before it, or an empty dict"""
+        with self.lock:
+            return dict(self.files.get(zoom_file_id, {}))
+
+    def settle(self, zoom_file_id):
+        """Forgets the replayed state of a recording file that has left the pipeline. Returns nothing."""
+        with self.lock:
+            self.files.pop(zoom_file_id, None)
+
+    def unfinished_meetings(self):
+        """Returns the meetings discovered by the previous run that still have recording files not deleted from Zoom"""
+        with self.lock:
+            meetings = list(self.meetings)
+        return [meeting for meeting in meetings
+                if any(self.file_state(recording_file.id).get('state') != 'deleted'
+                       for recording_file in meeting.recording_files)]
+
+    def close(self):
+        """Closes the journal file"""
+        self.journal_file.close()
@@ -0,0 +1,175 @@
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, from a fast API call to a slow upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+
+def log(message, **fields):
+    """
+    Prints a JSON line to stdout holding the time in the format %Y-%m-%d %H:%M:%S, the message and any other fields,
+    like log("Uploaded", file='123abc.MP4', bytes=1024)
+    """
+    entry = dict(fields, time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message=message)
+    print(json.dumps(entry, sort_keys=True, default=str))
+
+
+def write_atomically(path, content):
+    """Writes content to a temporary file next to path and renames it into place, so readers, including other runs,
+    never see half a file. Raises IOError or OSError when the file can't be written."""
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as output:
+        output.write(content)
+    os.rename(temporary, path)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initializer for a Histogram counting observations in buckets with the given upper bounds. The last bound
+        should be infinity. Not thread safe on its own; Metrics locks around it."""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Adds one observation"""
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-th quantile, capped at the largest observation"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """Returns the count, sum, mean, max, approximate median and 95th percentile as a dict"""
+        return dict(count=self.count,
+                    seconds=round(self.sum, 6),
+                    mean=round(self.sum / self.count, 6) if self.count else 0.0,
+                    max=round(self.max, 6),
+                    p50=round(self.quantile(0.5), 6),
+                    p95=round(self.quantile(0.95), 6))
+
+
+class _Timer(object):
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.observe(self.phase, time.time() - self.started, error=exc_type is not None)
+        return False
+
+
+class Metrics(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initializer for Metrics: thread-safe per-phase instrumentation for a run. Every phase, like 'zoom user/list',
+        'download' or 'drive share', gets a latency histogram and a count of errors, and can add to named counters like
+        'bytes' and 'retries'.
+
+        buckets: Upper bounds in seconds of the latency histogram buckets
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def timer(self, phase):
+        """Returns a context manager timing its block as one call of a phase. The call counts as an error if the block
+        raises."""
+        return _Timer(self, phase)
+
+    def observe(self, phase, seconds, error=False):
+        """Records one call of a phase that took the given number of seconds"""
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            if error:
+                self._add('errors', phase, 1)
+
+    def add(self, name, phase, amount=1):
+        """Adds to a phase's counter, like add('bytes', 'upload', 1024) or add('retries', 'upload')"""
+        with self.lock:
+            self._add(name, phase, amount)
+
+    def count(self, name, phase):
+        """Returns the value of a phase's counter, like count('files', 'archived')"""
+        with self.lock:
+            return self.counters.get(name, {}).get(phase, 0)
+
+    def _add(self, name, phase, amount):
+        counter = self.counters.setdefault(name, {})
+        counter[phase] = counter.get(phase, 0) + amount
+
+    def summary(self, **details):
+        """Returns a dict with the latency summary and counters of every phase, plus any details given, like
+        finished=True"""
+        with self.lock:
+            phases = dict((phase, histogram.summary()) for phase, histogram in self.histograms.items())
+            for name, counter in self.counters.items():
+                for phase, value in counter.items():
+                    phases.setdefault(phase, {})[name] = value
+            totals = dict((name, sum(counter.values())) for name, counter in self.counters.items())
+        return dict(details,
+                    started=datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                    elapsed=round(time.time() - self.started, 3),
+                    phases=phases,
+                    totals=totals)
+
+    def prometheus(self):
+        """Returns every histogram and counter in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            if self.histograms:
+                lines.append('# HELP zoomout_phase_seconds Time taken by each call, by phase')
+                lines.append('# TYPE zoomout_phase_seconds histogram')
+            for phase, histogram in sorted(self.histograms.items()):
+                label = self._label(phase)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('zoomout_phase_seconds_bucket{{phase="{0}",le="{1}"}} {2}'.format(label, le, cumulative))
+                lines.append('zoomout_phase_seconds_sum{{phase="{0}"}} {1!r}'.format(label, histogram.sum))
+                lines.append('zoomout_phase_seconds_count{{phase="{0}"}} {1}'.format(label, histogram.count))
+            for name, counter in sorted(self.counters.items()):
+                lines.append('# HELP zoomout_{0}_total Count of {0}, by phase'.format(name))
+                lines.append('# TYPE zoomout_{0}_total counter'.format(name))
+                for phase, value in sorted(counter.items()):
+                    lines.append('zoomout_{0}_total{{phase="{1}"}} {2}'.format(name, self._label(phase), value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def write_summary(self, path, **details):
+        """Writes summary(**details) to a JSON file"""
+        write_atomically(path, json.dumps(self.summary(**details), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        """Writes prometheus() to a file, e.g. in the directory read by node_exporter's textfile collector"""
+        write_atomically(path, self.prometheus())
@@ -0,0 +1,1172 @@
+import unittest
+import hashlib
+import json
+import os
+import re
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from datetime import datetime, timedelta
+
+# ZoomOut imports some modules only when first needed, after the archive tests have changed directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from apiclient import errors
+from googleapiclient.discovery import build_from_document
+from httplib2 import Http, Response
+import benchmark
+from drive_discovery import load_discovery_document
+from drive_batch import DriveBatch
+from drive_upload import (AdaptiveChunkSize, StreamingMediaUpload, StreamRewindError, CHUNK_MULTIPLE, is_retryable,
+                          retry_delay)
+from journal import Journal
+from metrics import Histogram, Metrics, write_atomically
+from pipeline import Pipeline
+from records import Host, HostRegistry, Meeting
+from scheduler import Scheduler
+from share_queue import ShareQueue
+from sharding import Shard, wait_for_shards
+from single_flight import SingleFlightCache
+from state_index import DriveInventory, StateIndex, FOLDER_MIME_TYPE
+from zoom_api import AsyncZoomApi, RateLimiter, ZoomApi, ZoomApiError
+
+# Tests that need neither Zoom nor Google credentials. Run them with: python -m unittest offline_tests
+
+KB = 1024
+MB = 1024 * 1024
+
+
+def zoom_meeting(host, meeting_number, file_ids):
+    """Returns a Meeting built from a Zoom recording with one recording file per id in file_ids"""
+    start_time = (datetime.utcnow() - timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    recording = benchmark.zoom_recording(host.to_dict(), meeting_number, 'Test meeting', start_time, len(file_ids),
+                                         KB, 'http://127.0.0.1/download/')
+    for recording_file, file_id in zip(recording['recording_files'], file_ids):
+        recording_file['id'] = file_id
+    return Meeting.from_zoom(host, recording)
+
+
+class CorruptingDrive(benchmark.FakeDrive):
+    def upload(self, method, query, headers, body):
+        """Answers like FakeDrive, but reports a wrong md5Checksum for every finished upload"""
+        status, response_headers, content = super(CorruptingDrive, self).upload(method, query, headers, body)
+        if status == 200 and 'md5Checksum' in content:
+            resource = json.loads(content)
+            resource['md5Checksum'] = hashlib.md5(resource['md5Checksum']).hexdigest()
+            self.files[resource['id']]['md5Checksum'] = resource['md5Checksum']
+            content = json.dumps(resource)
+        return status, response_headers, content
+
+
+def quietly(function, *args, **kwargs):
+    """Calls function with the arguments given, throwing away the log lines it prints. Returns what it returns."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class FailingZoom(benchmark.FakeZoom):
+    def __init__(self, failing=(), **kwargs):
+        """A FakeZoom whose endpoints named in failing, like 'user/list', answer with a 500"""
+        super(FailingZoom, self).__init__(**kwargs)
+        self.failing = set(failing)
+
+    def route(self, method, path, query, headers, body):
+        if path[len('/v1/'):] in self.failing:
+            self.count(path[len('/v1/'):])
+            return 500, {}, 'Internal Server Error'
+        return super(FailingZoom, self).route(method, path, query, headers, body)
+
+
+class BusyDrive(benchmark.FakeDrive):
+    def __init__(self, busy_batches=0, busy_chunks=0, **kwargs):
+        """A FakeDrive that answers its first busy_batches batch requests and its first busy_chunks upload chunks with
+        a 503"""
+        super(BusyDrive, self).__init__(**kwargs)
+        self.busy_batches = busy_batches
+        self.busy_chunks = busy_chunks
+
+    def upload(self, method, query, headers, body):
+        with self.lock:
+            busy = bool(body) and self.busy_chunks > 0
+            self.busy_chunks -= busy
+        if busy:
+            self.count('upload chunk')
+            return self.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, status=503)
+        return super(BusyDrive, self).upload(method, query, headers, body)
+
+    def batch(self, headers, body):
+        with self.lock:
+            busy, self.busy_batches = self.busy_batches > 0, self.busy_batches - 1
+        if busy:
+            self.count('batch')
+            return 503, {}, 'Service Unavailable'
+        return super(BusyDrive, self).batch(headers, body)
+
+
+class BrokenDrive(benchmark.FakeDrive):
+    def __init__(self, **kwargs):
+        """A FakeDrive that, while broken is True, turns away every upload chunk past the first 256 KB of a file with a
+        403 that isn't worth retrying, leaving the upload sessions half full"""
+        super(BrokenDrive, self).__init__(**kwargs)
+        self.broken = True
+
+    def upload(self, method, query, headers, body):
+        content_range = re.match(r'bytes (\d+)-', headers.get('content-range', ''))
+        if self.broken and body and content_range and int(content_range.group(1)) >= 256 * KB:
+            self.count('upload chunk')
+            return self.json_response({'error': {'code': 403, 'message': 'Forbidden',
+                                                 'errors': [{'reason': 'forbidden'}]}}, status=403)
+        return super(BrokenDrive, self).upload(method, query, headers, body)
+
+
+class ArchiveRunTest(unittest.TestCase):
+    """Runs ZoomOut against the benchmark's stand-in Zoom and Drive servers, in a scratch directory"""
+
+    users, meetings, files, file_size = 2, 2, 2, 300 * KB
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.environ = dict(os.environ)
+        self.zoom = self.fake_zoom().start()
+        os.environ.update(ZOOM_API_KEY='test',
+                          ZOOM_API_SECRET='test',
+                          ZOOM_API_URL=self.zoom.url + 'v1/',
+                          ZOOMOUT_DONEFILE_PATH=os.path.join(self.directory, 'done'),
+                          ZOOMOUT_INDEX_PATH=os.path.join(self.directory, 'zoomout_index.db'),
+                          ZOOMOUT_JOURNAL_PATH=os.path.join(self.directory, 'zoomout_journal.jsonl'))
+        os.environ.pop('ZOOMOUT_MESSAGING_JSON', None)
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.zoom.stop()
+        shutil.rmtree(self.directory)
+
+    def fake_zoom(self):
+        return benchmark.FakeZoom(users=self.users, meetings=self.meetings, files=self.files, file_size=self.file_size)
+
+    def archive(self, drive, limit=1, **kwargs):
+        """Runs ZoomOut.main against drive with the ZoomOut arguments given. Returns the ZoomOut."""
+        zoomout = quietly(benchmark.BenchmarkZoomOut, drive.url, limit, **kwargs)
+        try:
+            quietly(zoomout.main)
+        except SystemExit:
+            pass  # main exits after logging a fatal error
+        return zoomout
+
+    def remaining_files(self):
+        """Number of recording files still in the fake Zoom account"""
+        return sum(len(recording['recording_files']) for recordings in self.zoom.recordings.values()
+                   for recording in recordings)
+
+    @staticmethod
+    def uploaded_files(drive):
+        return [resource for resource in drive.files.values() if 'zoomFileId' in (resource.get('appProperties') or {})]
+
+    @property
+    def done(self):
+        return os.path.exists(os.environ['ZOOMOUT_DONEFILE_PATH'])
+
+    def journal_states(self):
+        with open(os.environ['ZOOMOUT_JOURNAL_PATH']) as journal_file:
+            return [json.loads(line)['state'] for line in journal_file if line.strip()]
+
+
+class ZoomListingTest(ArchiveRunTest):
+
+    def test_user_list_failure_stops_the_run(self):
+        self.zoom.stop()
+        self.zoom = FailingZoom(failing=['user/list'], users=self.users, meetings=self.meetings).start()
+        os.environ['ZOOM_API_URL'] = self.zoom.url + 'v1/'
+        self.assertRaises(ZoomApiError, list, ZoomApi('test', 'test', base_url=self.zoom.url + 'v1/').collect_meetings())
+
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive)
+        finally:
+            drive.stop()
+        # A Zoom outage must not pass for a finished run with nothing to archive
+        self.assertFalse(self.done)
+        self.assertFalse('finished' in self.journal_states())
+
+    def test_age_is_measured_in_utc(self):
+        self.zoom.stop()
+        self.zoom = benchmark.FakeZoom(users=1, meetings=2, files=1, file_size=KB).start()
+        young, old = self.zoom.recordings['user0']
+        young['start_time'] = (datetime.utcnow() - timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        old['start_time'] = (datetime.utcnow() - timedelta(minutes=90)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        zoom = ZoomApi('test', 'test', base_url=self.zoom.url + 'v1/')
+        # Zoom's start times are UTC, so the server's own time zone must not move the cutoff
+        for time_zone in ('Etc/GMT+5', 'Etc/GMT-5'):
+            os.environ['TZ'] = time_zone
+            time.tzset()
+            try:
+                meetings = zoom.aging_recordings('user0', older_than=60 * 60)
+            finally:
+                os.environ.pop('TZ')
+                time.tzset()
+            self.assertEqual([meeting.meeting_number for meeting in meetings], [old['meeting_number']])
+
+
+class ArchiveTest(ArchiveRunTest):
+
+    def assert_archives_every_file(self, **kwargs):
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive, **kwargs)
+        finally:
+            drive.stop()
+        self.assertEqual(self.zoom.calls.get('recording/delete'), self.zoom.total_files)
+        self.assertEqual(self.remaining_files(), 0)
+        self.assertEqual(len(self.uploaded_files(drive)), self.zoom.total_files)
+        self.assertTrue(self.done)
+
+    def test_archives_every_file(self):
+        self.assert_archives_every_file(prometheus_path=os.path.join(self.directory, 'zoomout.prom'))
+        with open(os.path.join(self.directory, 'zoomout_metrics.json')) as summary_file:
+            summary = json.load(summary_file)
+        self.assertTrue(summary['finished'])
+        self.assertEqual(summary['phases']['archived']['files'], self.zoom.total_files)
+        self.assertEqual(summary['phases']['download']['bytes'], self.zoom.total_files * self.file_size)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'zoomout.prom')))
+
+    def test_creates_each_folder_once(self):
+        # Every file of a meeting is uploaded at once, so their workers ask for the same folders together
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive, upload_workers=8)
+        finally:
+            drive.stop()
+        folders = [resource['appProperties'] for resource in drive.files.values()
+                   if resource['mimeType'] == FOLDER_MIME_TYPE]
+        self.assertEqual(len([properties for properties in folders if 'zoomUserId' in properties]), self.users)
+        self.assertEqual(len([properties for properties in folders if 'zoomMeetingId' in properties]),
+                         self.users * self.meetings)
+
+    def test_streams_every_file(self):
+        self.assert_archives_every_file(stream=True, stream_chunksize=256 * KB)
+
+    def assert_mismatch_keeps_the_zoom_copy(self, drive_class=CorruptingDrive, **kwargs):
+        drive = drive_class().start()
+        try:
+            zoomout = self.archive(drive, **kwargs)
+        finally:
+            drive.stop()
+        self.assertEqual(self.zoom.calls.get('recording/delete'), None)
+        self.assertEqual(self.remaining_files(), self.zoom.total_files)
+        self.assertEqual(zoomout.metrics.count('files', 'mismatched'), self.zoom.total_files)
+        self.assertEqual(self.uploaded_files(drive), [])  # The bad copies were removed from Drive
+
+    def test_md5_mismatch_keeps_the_zoom_copy(self):
+        self.assert_mismatch_keeps_the_zoom_copy()
+
+    def test_md5_mismatch_keeps_the_zoom_copy_when_streaming(self):
+        self.assert_mismatch_keeps_the_zoom_copy(stream=True, stream_chunksize=256 * KB)
+
+    def test_size_mismatch_keeps_the_zoom_copy(self):
+        # Zoom reports one byte more than it serves
+        for recording in self.zoom.recording_files.values():
+            for recording_file in recording['recording_files']:
+                recording_file['file_size'] = self.file_size + 1
+        self.assert_mismatch_keeps_the_zoom_copy(drive_class=benchmark.FakeDrive)
+
+
+class AdaptiveChunkSizeTest(unittest.TestCase):
+
+    def test_clamp(self):
+        chunk_size = AdaptiveChunkSize(4 * MB, minimum=1 * MB, maximum=8 * MB)
+        self.assertEqual(chunk_size.clamp(3 * MB + 1000), 3 * MB)
+        self.assertEqual(chunk_size.clamp(100), 1 * MB)
+        self.assertEqual(chunk_size.clamp(100 * MB), 8 * MB)
+        self.assertEqual(chunk_size.clamp(5 * MB + CHUNK_MULTIPLE - 1) % CHUNK_MULTIPLE, 0)
+
+    def test_bounds_are_rounded_to_chunk_multiples(self):
+        chunk_size = AdaptiveChunkSize(0, minimum=1000, maximum=CHUNK_MULTIPLE + 1000)
+        self.assertEqual(chunk_size.minimum, CHUNK_MULTIPLE)
+        self.assertEqual(chunk_size.maximum, CHUNK_MULTIPLE)
+        self.assertEqual(chunk_size.size, CHUNK_MULTIPLE)
+
+    def test_update_follows_throughput(self):
+        chunk_size = AdaptiveChunkSize(1 * MB, minimum=256 * KB, maximum=64 * MB, target_seconds=5.0)
+        self.assertEqual(chunk_size.update(2 * MB, 1.0), 10 * MB)
+        self.assertEqual(chunk_size.update(0, 1.0), 10 * MB)
+
+    def test_retry_delay(self):
+        for attempt in range(1, 10):
+            ceiling = min(64, 2 ** attempt)
+            self.assertTrue(ceiling / 2.0 <= retry_delay(attempt) <= ceiling)
+        self.assertEqual(retry_delay(3, retry_after='7'), 7.0)
+        self.assertTrue(4 <= retry_delay(3, retry_after='Wed, 21 Oct 2015 07:28:00 GMT') <= 8)
+
+    def test_is_retryable(self):
+        def http_error(status, reason=None):
+            content = json.dumps({'error': {'errors': [{'reason': reason}]}}) if reason else ''
+            return errors.HttpError(Response({'status': status}), content)
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(403, 'userRateLimitExceeded')))
+        self.assertFalse(is_retryable(http_error(403, 'forbidden')))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(ValueError()))
+
+
+class ChunkRetryTest(ArchiveRunTest):
+
+    def test_retries_chunks_drive_turned_away(self):
+        drive = BusyDrive(busy_chunks=3).start()
+        try:
+            self.archive(drive, min_chunksize=256 * KB, max_chunksize=256 * KB)
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+        self.assertEqual(len(self.uploaded_files(drive)), self.zoom.total_files)
+        self.assertEqual(drive.calls['upload session'], self.zoom.total_files)
+
+
+class IncrementalTest(ArchiveRunTest):
+
+    def pending(self):
+        """Returns the uuids of the meetings the state index holds as pending"""
+        index = StateIndex(os.environ['ZOOMOUT_INDEX_PATH'])
+        try:
+            return set(meeting_uuid for user in self.zoom.users for meeting_uuid, _ in index.pending_meetings(user['id']))
+        finally:
+            index.connection.close()
+
+    def meeting_uuids(self):
+        """Returns the uuids of the meetings still in the fake Zoom account"""
+        return set(recording['uuid'] for recordings in self.zoom.recordings.values() for recording in recordings)
+
+    def test_failed_deletes_stay_pending(self):
+        self.zoom.stop()
+        self.zoom = FailingZoom(failing=['recording/delete'], users=self.users, meetings=self.meetings,
+                                files=self.files, file_size=self.file_size).start()
+        os.environ['ZOOM_API_URL'] = self.zoom.url + 'v1/'
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive, incremental=True)
+            self.assertEqual(len(self.uploaded_files(drive)), self.zoom.total_files)
+            self.assertEqual(self.remaining_files(), self.zoom.total_files)
+            self.assertEqual(self.pending(), self.meeting_uuids())
+            self.zoom.failing.clear()
+            self.archive(drive, incremental=True)
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+        self.assertEqual(self.pending(), set())
+
+    def test_young_meetings_wait_for_a_later_run(self):
+        young = self.zoom.recordings['user0'][0]
+        young['start_time'] = (datetime.utcnow() - timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive, incremental=True)
+            self.assertEqual(self.meeting_uuids(), set([young['uuid']]))
+            self.assertEqual(self.pending(), set([young['uuid']]))
+            young['start_time'] = (datetime.utcnow() - timedelta(hours=2)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            self.archive(drive, incremental=True)
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+        self.assertEqual(self.pending(), set())
+
+    def test_meetings_handed_out_stay_pending_until_finished(self):
+        drive = benchmark.FakeDrive().start()
+        # As if the run died before any meeting finished
+        benchmark.BenchmarkZoomOut.finish_meeting = lambda zoomout, progress: None
+        try:
+            self.archive(drive, incremental=True)
+        finally:
+            del benchmark.BenchmarkZoomOut.finish_meeting
+        uuids = set(recording['uuid'] for recording in self.zoom.recording_files.values())
+        self.assertEqual(self.pending(), uuids)
+        try:
+            self.archive(drive, incremental=True)
+        finally:
+            drive.stop()
+        # The next run finds them gone from Zoom
+        self.assertEqual(self.pending(), set())
+
+
+class StateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.db')
+        self.index = StateIndex(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_and_looks_up(self):
+        self.index.record_top_folder('user0', 'folder1')
+        self.index.record_meeting_folder(1234, 'folder2')
+        self.index.record_file('file1', 'uploaded', 'drive3')
+        self.assertEqual(self.index.top_folder('user0'), 'folder1')
+        self.assertEqual(self.index.meeting_folder('1234'), 'folder2')
+        self.assertEqual(self.index.file_state('file1'), 'uploaded')
+        self.assertEqual(self.index.top_folder('user1'), None)
+        self.assertEqual(self.index.file_state('file2'), None)
+
+    def test_state_change_keeps_the_drive_id(self):
+        self.index.record_file('file1', 'uploaded', 'drive3')
+        self.index.record_file('file1', 'deleted')
+        self.assertEqual(self.index.file_state('file1'), 'deleted')
+        self.assertEqual(self.index._fetch("SELECT drive_id FROM files WHERE zoom_file_id = ?", ('file1',)), 'drive3')
+
+    def test_survives_reopening(self):
+        self.index.record_top_folder('user0', 'folder1')
+        self.index.record_file('file1', 'deleted', 'drive3')
+        self.index.connection.close()
+        index = StateIndex(self.path)
+        self.assertEqual(index.top_folder('user0'), 'folder1')
+        self.assertEqual(index.file_state('file1'), 'deleted')
+        self.assertFalse(index.bootstrapped)
+
+
+class DriveInventoryTest(unittest.TestCase):
+
+    listing = [
+        {'id': 'top0', 'mimeType': FOLDER_MIME_TYPE, 'appProperties': {'zoomUserId': 'user0'}},
+        {'id': 'meeting1', 'mimeType': FOLDER_MIME_TYPE, 'parents': ['top0'], 'appProperties': {'zoomMeetingId': '11'}},
+        {'id': 'meeting2', 'mimeType': FOLDER_MIME_TYPE, 'parents': ['top0'], 'appProperties': {'zoomMeetingId': '12'}},
+        {'id': 'file1', 'mimeType': 'video/mp4', 'parents': ['meeting1'],
+         'appProperties': {'zoomFileId': 'a', 'zoomMeetingId': '11'}},
+        {'id': 'file2', 'mimeType': 'video/mp4', 'parents': ['meeting1'],
+         'appProperties': {'zoomFileId': 'b', 'zoomMeetingId': '11'}},
+        {'id': 'file3', 'mimeType': 'video/mp4', 'parents': ['meeting2'], 'appProperties': {'zoomFileId': 'c'}},
+        {'id': 'other', 'mimeType': FOLDER_MIME_TYPE},
+    ]
+
+    def test_from_listing(self):
+        inventory = DriveInventory.from_listing(self.listing)
+        self.assertEqual(inventory.top_folders['user0']['id'], 'top0')
+        self.assertEqual(sorted(inventory.meeting_ids()), ['11', '12'])
+        self.assertEqual(sorted(inventory.meetings_for_user('user0')), ['11', '12'])
+        self.assertEqual(inventory.meetings_for_user('user1'), [])
+        self.assertEqual(sorted(inventory.files), ['a', 'b', 'c'])
+        self.assertEqual([drive_file['id'] for drive_file in inventory.files_for_meeting(11)], ['file1', 'file2'])
+        self.assertEqual(inventory.files_for_meeting(12), [])  # file3 predates the zoomMeetingId property
+        self.assertFalse(inventory.add({'id': 'plain', 'mimeType': 'text/plain'}))
+
+    def test_loads_into_the_state_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            index = StateIndex(os.path.join(directory, 'index.db'))
+            index.record_file('stale', 'uploaded', 'gone')
+            index.record_high_water('user0', '2017-03-01')
+            self.assertFalse(index.bootstrapped)
+            index.load(DriveInventory.from_listing(self.listing))
+            self.assertTrue(index.bootstrapped)
+            self.assertEqual(index.top_folder('user0'), 'top0')
+            self.assertEqual(index.meeting_folder('12'), 'meeting2')
+            self.assertEqual(index.file_state('c'), 'uploaded')
+            self.assertEqual(index.file_state('stale'), None)
+            self.assertEqual(index.high_water('user0'), '2017-03-01')
+        finally:
+            shutil.rmtree(directory)
+
+
+class StateIndexRunTest(ArchiveRunTest):
+
+    def test_second_run_answers_from_the_index(self):
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive)
+            self.assertEqual(drive.calls.get('GET files'), 1)  # The listing that builds the index
+            # Zoom offers the same recordings again: they are known to be in Drive, so only their Zoom copies go
+            self.zoom.stop()
+            self.zoom = self.fake_zoom().start()
+            os.environ['ZOOM_API_URL'] = self.zoom.url + 'v1/'
+            drive.calls.clear()
+            self.archive(drive)
+        finally:
+            drive.stop()
+        self.assertEqual(drive.calls, {})
+        self.assertEqual(self.remaining_files(), 0)
+
+
+class DriveBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_drive = benchmark.FakeDrive().start()
+        self.drive = build_from_document(benchmark.drive_discovery(self.fake_drive.url), http=Http())
+
+    def tearDown(self):
+        self.fake_drive.stop()
+
+    def test_sends_at_most_a_hundred_calls_per_batch(self):
+        created = {}
+        batch = DriveBatch(self.drive, max_size=500)
+        for number in range(150):
+            batch.add(self.drive.files().create(body={'name': 'file{0}'.format(number)}),
+                      lambda response, exc, number=number: created.__setitem__(number, (response['name'], exc)))
+        self.assertEqual(len(batch), 150)
+        self.assertEqual(batch.execute(), 0)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(self.fake_drive.calls['batch'], 2)
+        self.assertEqual(self.fake_drive.calls['batched POST files'], 150)
+        self.assertEqual(created, dict((number, ('file{0}'.format(number), None)) for number in range(150)))
+
+    def test_failed_calls_are_counted_and_reported(self):
+        folder = self.drive.files().create(body={'name': 'folder'}).execute()
+        results = []
+        batch = DriveBatch(self.drive)
+        for file_id in (folder['id'], 'missing'):
+            batch.add(self.drive.permissions().create(fileId=file_id, body={'role': 'reader', 'type': 'anyone'}),
+                      lambda response, exc: results.append((response is not None, exc is not None)))
+        self.assertEqual(batch.execute(), 1)
+        self.assertEqual(sorted(results), [(False, True), (True, False)])
+        self.assertEqual(self.fake_drive.calls['batch'], 1)  # A 404 isn't retried
+
+    def test_retries_a_batch_drive_turned_away(self):
+        self.fake_drive.stop()
+        self.fake_drive = BusyDrive(busy_batches=1).start()
+        self.drive = build_from_document(benchmark.drive_discovery(self.fake_drive.url), http=Http())
+        batch = DriveBatch(self.drive)
+        batch.add(self.drive.files().create(body={'name': 'file'}))
+        self.assertEqual(batch.execute(), 0)
+        self.assertEqual(self.fake_drive.calls['batch'], 2)
+        self.assertEqual(self.fake_drive.calls['batched POST files'], 1)
+
+
+class SingleFlightCacheTest(unittest.TestCase):
+
+    def get_concurrently(self, cache, compute, threads=8):
+        """Calls cache.get('key', compute) from several threads at once. Returns what each one got or raised."""
+        results = []
+
+        def get():
+            try:
+                results.append(cache.get('key', compute))
+            except Exception as exc:
+                results.append(exc)
+        workers = [threading.Thread(target=get) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(5)
+        return results
+
+    def test_concurrent_misses_compute_once(self):
+        computed = []
+
+        def compute():
+            computed.append(1)
+            time.sleep(0.2)
+            return 'value'
+        cache = SingleFlightCache()
+        self.assertEqual(self.get_concurrently(cache, compute), ['value'] * 8)
+        self.assertEqual(len(computed), 1)
+        self.assertTrue('key' in cache)
+        self.assertEqual(cache.get('key', lambda: 'other'), 'value')
+
+    def test_errors_reach_every_caller_and_are_not_cached(self):
+        error = ValueError('Drive is down')
+
+        def compute():
+            time.sleep(0.2)
+            raise error
+        cache = SingleFlightCache()
+        self.assertEqual(self.get_concurrently(cache, compute), [error] * 8)
+        self.assertFalse('key' in cache)
+        self.assertEqual(cache.get('key', lambda: 'value'), 'value')
+
+    def test_set(self):
+        cache = SingleFlightCache()
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key', lambda: 'other'), 'value')
+
+
+class ResumeTest(ArchiveRunTest):
+
+    users, meetings, files, file_size = 1, 1, 2, 1 * MB
+
+    def crash(self, drive, **kwargs):
+        """Runs ZoomOut against a broken drive, then cuts the journal short as if the run had crashed after opening
+        its upload sessions"""
+        self.archive(drive, **kwargs)
+        with open(os.environ['ZOOMOUT_JOURNAL_PATH']) as journal_file:
+            lines = [line for line in journal_file if json.loads(line)['state'] not in ('failed', 'finished')]
+        with open(os.environ['ZOOMOUT_JOURNAL_PATH'], 'w') as journal_file:
+            journal_file.writelines(lines)
+
+    def test_resumes_streamed_uploads(self):
+        drive = BrokenDrive().start()
+        try:
+            chunks = dict(stream=True, stream_chunksize=256 * KB, min_chunksize=256 * KB, max_chunksize=256 * KB)
+            self.crash(drive, **chunks)
+            self.assertEqual(self.remaining_files(), self.zoom.total_files)
+            self.assertEqual(drive.calls['upload session'], self.zoom.total_files)
+            drive.broken = False
+            self.archive(drive, resume=True, **chunks)
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+        # The uploads went on in the sessions the crashed run opened
+        self.assertEqual(drive.calls['upload session'], self.zoom.total_files)
+        self.assertEqual(drive.calls['upload finished'], self.zoom.total_files)
+        self.assertTrue(self.done)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.jsonl')
+        self.host = Host('user1', 'host1@example.edu')
+        self.meeting = zoom_meeting(self.host, 123456789, ['file1', 'file2'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def crashed_run(self):
+        journal = Journal(self.path)
+        journal.record('started')
+        self.assertTrue(journal.discover(self.meeting))
+        journal.record('enumerated', host=self.host.id)
+        journal.record('downloaded', file='file1', filename='file1.MP4', size=KB, md5='abc')
+        journal.record('deleted', file='file1')
+        journal.record('uploading', file='file2', session_uri='http://127.0.0.1/session')
+        journal.close()
+
+    def test_resume_replays_unfinished_meetings(self):
+        self.crashed_run()
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"state": "upl')  # A line cut short by the crash
+        journal = Journal(self.path, resume=True)
+        self.assertTrue(journal.resuming)
+        self.assertEqual(journal.hosts, set(['user1']))
+        unfinished = journal.unfinished_meetings()
+        self.assertEqual([meeting.uuid for meeting in unfinished], [self.meeting.uuid])
+        self.assertEqual(unfinished[0].host.email, 'host1@example.edu')
+        self.assertEqual(unfinished[0].start_time, self.meeting.start_time)
+        self.assertEqual(journal.file_state('file2')['session_uri'], 'http://127.0.0.1/session')
+        self.assertEqual(journal.file_state('file1')['md5'], 'abc')
+        self.assertFalse(journal.discover(self.meeting))
+        journal.close()
+
+    def test_holds_only_the_replayed_state(self):
+        journal = Journal(self.path)
+        journal.record('started')
+        journal.discover(self.meeting)
+        journal.record('uploading', file='file1', session_uri='http://127.0.0.1/session')
+        self.assertEqual(journal.files, {})
+        self.assertEqual(journal.meeting_uuids, set())
+        journal.close()
+
+        journal = Journal(self.path, resume=True)
+        self.assertEqual(journal.file_state('file1')['state'], 'uploading')
+        journal.record('uploaded', file='file1')
+        journal.record('downloaded', file='file2', filename='file2.MP4', size=KB, md5='abc')
+        self.assertEqual(journal.file_state('file1')['state'], 'uploaded')
+        self.assertEqual(journal.file_state('file2'), {})
+        journal.settle('file1')
+        self.assertEqual(journal.files, {})
+        # Zoom lists the meeting again once; after that it is new to the journal
+        self.assertFalse(journal.discover(self.meeting))
+        self.assertTrue(journal.discover(self.meeting))
+        journal.close()
+
+    def test_meetings_without_files_are_told_apart(self):
+        journal = Journal(self.path)
+        journal.record('started')
+        for meeting_number in (1, 2):
+            self.assertTrue(journal.discover(zoom_meeting(self.host, meeting_number, [])))
+        journal.close()
+        journal = Journal(self.path, resume=True)
+        self.assertEqual(len(journal.meetings), 2)
+        journal.close()
+
+    def test_finished_run_starts_over(self):
+        self.crashed_run()
+        journal = Journal(self.path, resume=True)
+        journal.record('finished')
+        journal.close()
+        journal = Journal(self.path, resume=True)
+        self.assertFalse(journal.resuming)
+        self.assertEqual(journal.unfinished_meetings(), [])
+        self.assertTrue(journal.discover(self.meeting))
+        journal.close()
+
+    def test_replays_meetings_journaled_as_zoom_dicts(self):
+        # Journals written before Meeting records held the Zoom user and recording as Zoom sent them
+        recording = self.meeting.to_dict()['recording']
+        recording.update(host_id='user1', duration=30, recording_count=2)
+        with open(self.path, 'w') as journal_file:
+            journal_file.write(json.dumps(dict(state='started')) + '\n')
+            journal_file.write(json.dumps(dict(state='discovered', meeting=dict(
+                host=dict(id='user1', email='host1@example.edu', first_name='Host', type=2), recording=recording))) + '\n')
+        journal = Journal(self.path, resume=True)
+        meeting, = journal.unfinished_meetings()
+        journal.close()
+        self.assertEqual(meeting.uuid, self.meeting.uuid)
+        self.assertEqual(meeting.host.email, 'host1@example.edu')
+        self.assertEqual([recording_file.id for recording_file in meeting.recording_files], ['file1', 'file2'])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1.0, float('inf')))
+        for seconds in (0.05, 0.05, 0.5, 2.0):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(1.0), 2.0)  # Capped at the largest observation
+        self.assertEqual(histogram.summary()['mean'], 0.65)
+
+    def test_summary_and_prometheus(self):
+        metrics = Metrics()
+        metrics.observe('zoom user/list', 0.02)
+        try:
+            with metrics.timer('upload'):
+                raise IOError()
+        except IOError:
+            pass
+        metrics.add('bytes', 'upload', 1024)
+        summary = metrics.summary(finished=True)
+        self.assertTrue(summary['finished'])
+        self.assertEqual(summary['phases']['upload']['errors'], 1)
+        self.assertEqual(summary['phases']['upload']['bytes'], 1024)
+        self.assertEqual(summary['totals'], {'errors': 1, 'bytes': 1024})
+        text = metrics.prometheus()
+        self.assertTrue('zoomout_phase_seconds_count{phase="zoom user/list"} 1\n' in text)
+        self.assertTrue('zoomout_phase_seconds_bucket{phase="zoom user/list",le="0.025"} 1\n' in text)
+        self.assertTrue('zoomout_bytes_total{phase="upload"} 1024\n' in text)
+
+    def test_written_files_replace_the_old_ones_whole(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics.json')
+            metrics = Metrics()
+            metrics.write_summary(path)
+            metrics.add('files', 'archived')
+            metrics.write_summary(path, finished=True)
+            with open(path) as summary_file:
+                self.assertEqual(json.load(summary_file)['totals'], {'files': 1})
+            self.assertEqual(os.listdir(directory), ['metrics.json'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class DryRunTest(ArchiveRunTest):
+
+    def test_lists_without_touching_anything(self):
+        zoomout = quietly(benchmark.BenchmarkZoomOut, 'http://127.0.0.1:1/', 1, dry_run=True, priority='largest')
+        self.assertEqual(quietly(zoomout.list_eligible), self.users * self.meetings)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(self.zoom.calls.get('download'), None)
+        self.assertEqual(self.zoom.calls.get('recording/delete'), None)
+
+
+class DiscoveryDocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'drive_v3.json')
+        self.source = os.path.join(self.directory, 'source.json')
+        write_atomically(self.source, json.dumps({'name': 'drive', 'version': 'fetched'}))
+        self.url = 'file://' + self.source
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self, version, age=0):
+        with open(self.path, 'wb') as cache_file:
+            json.dump({'name': 'drive', 'version': version}, cache_file)
+        os.utime(self.path, (time.time() - age, time.time() - age))
+
+    def load(self, url):
+        return json.loads(quietly(load_discovery_document, self.path, url=url, max_age=60))['version']
+
+    def test_fetches_and_caches(self):
+        self.assertEqual(self.load(self.url), 'fetched')
+        with open(self.path) as cache_file:
+            self.assertEqual(json.load(cache_file)['version'], 'fetched')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['drive_v3.json', 'source.json'])
+
+    def test_uses_a_fresh_copy_without_fetching(self):
+        self.cache('cached', age=30)
+        self.assertEqual(self.load('http://127.0.0.1:1/unreachable'), 'cached')
+
+    def test_refreshes_a_stale_copy(self):
+        self.cache('cached', age=120)
+        self.assertEqual(self.load(self.url), 'fetched')
+
+    def test_falls_back_to_a_stale_copy(self):
+        self.cache('cached', age=120)
+        self.assertEqual(self.load('http://127.0.0.1:1/unreachable'), 'cached')
+
+    def test_fails_without_any_copy(self):
+        self.assertRaises(IOError, self.load, 'http://127.0.0.1:1/unreachable')
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_reports_a_finished_run(self):
+        args, zoomout_args = benchmark.parse_benchmark_args(['--users', '2', '--meetings', '2', '--files', '2',
+                                                             '--file-size', '100', '--quiet', '--upload-workers', '3'])
+        self.assertEqual(zoomout_args.upload_workers, 3)
+        report = benchmark.run_benchmark(args, zoomout_args)
+        self.assertTrue(report['finished'])
+        self.assertEqual(report['files'], 8)
+        self.assertEqual(report['archived'], 8)
+        self.assertEqual(report['uploaded_bytes'], 8 * 100 * KB)
+        self.assertTrue(benchmark.format_report(report))
+
+
+class ShareQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shares = ShareQueue('Shared with you.', 'Your folder is new.', max_listed=2)
+        self.new_host = Host('user1', 'host1@example.edu')
+        self.known_host = Host('user2', 'host2@example.edu')
+        self.lost_host = Host('user3', 'host3@example.edu')
+
+    def test_drain(self):
+        self.shares.add_top_folder(self.new_host, 'top1')
+        for number in range(3):
+            self.shares.add_meeting_folder(self.new_host, 'meeting1{0}'.format(number), 'Meeting {0}'.format(number))
+        self.shares.add_meeting_folder(self.known_host, 'meeting2', 'Known meeting')
+        self.shares.add_meeting_folder(self.lost_host, 'meeting30', 'First')
+        self.shares.add_meeting_folder(self.lost_host, 'meeting31', 'Second')
+        self.assertEqual(len(self.shares), 3)
+
+        top_folders = {'user2': 'top2'}
+        grants = sorted(self.shares.drain(top_folders.get), key=lambda grant: (grant[0].id, grant[1]))
+        self.assertEqual([(host.id, folder) for host, folder, message in grants],
+                         [('user1', 'top1'), ('user2', 'top2'), ('user3', 'meeting30'), ('user3', 'meeting31')])
+
+        new_message = grants[0][2]
+        self.assertTrue(new_message.startswith('Your folder is new.'))
+        self.assertTrue('3 recorded meetings added:' in new_message)
+        self.assertTrue(' * Meeting 1' in new_message and ' * Meeting 2' not in new_message)
+        self.assertTrue('... and 1 more' in new_message)
+
+        known_message = grants[1][2]
+        self.assertFalse('Your folder is new.' in known_message)
+        self.assertTrue('1 recorded meeting added:' in known_message)
+
+        # Without a top level folder each meeting folder is granted, with a single notification
+        self.assertTrue(' * First' in grants[2][2] and ' * Second' in grants[2][2])
+        self.assertEqual(grants[3][2], None)
+
+        self.assertEqual(len(self.shares), 0)
+        self.assertEqual(self.shares.drain(top_folders.get), [])
+
+
+class ShareTest(ArchiveRunTest):
+
+    def test_each_host_is_granted_its_top_folder_and_notified_once(self):
+        drive = benchmark.FakeDrive().start()
+        try:
+            zoomout = self.archive(drive)
+            # New hosts: a silent grant when the folder is created, then the digest
+            self.assertEqual(sum(count for name, count in drive.calls.items() if name.endswith('permissions')),
+                             2 * self.users)
+            silent = urlparse.urlparse(zoomout.share_request('drive1', 'host0@example.edu', None).uri)
+            notifying = urlparse.urlparse(zoomout.share_request('drive1', 'host0@example.edu', 'New recordings').uri)
+        finally:
+            drive.stop()
+        self.assertEqual(urlparse.parse_qs(silent.query).get('sendNotificationEmail'), ['false'])
+        self.assertFalse('emailMessage' in urlparse.parse_qs(silent.query))
+        self.assertEqual(urlparse.parse_qs(notifying.query).get('sendNotificationEmail'), ['true'])
+        self.assertEqual(urlparse.parse_qs(notifying.query).get('emailMessage'), ['New recordings'])
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_owns_is_stable(self):
+        # Every shard process, on every machine and in every run, must agree on the split
+        shards = [Shard(number, 8) for number in range(1, 9)]
+        owners = dict((user_id, [shard.number for shard in shards if shard.owns(user_id)])
+                      for user_id in ['user0', 'user1', 'user2', 'xK3jA9uQT5uW2aB', 12345])
+        self.assertEqual(owners, {'user0': [7], 'user1': [7], 'user2': [4], 'xK3jA9uQT5uW2aB': [4], 12345: [7]})
+
+    def test_every_host_has_one_shard(self):
+        shards = [Shard(number, 5) for number in range(1, 6)]
+        for user_id in range(200):
+            self.assertEqual(len([shard for shard in shards if shard.owns(str(user_id))]), 1)
+
+    def test_path(self):
+        self.assertEqual(Shard(3, 8).path('zoomout_index.db'), 'zoomout_index.shard3of8.db')
+        self.assertEqual(Shard(3, 8).path(os.devnull), os.devnull)
+        self.assertRaises(ValueError, Shard, 9, 8)
+
+
+class ShardRunTest(ArchiveRunTest):
+
+    users = 6
+
+    def test_shards_split_the_hosts_and_the_zoom_rate(self):
+        drive = benchmark.FakeDrive().start()
+        try:
+            for number in (1, 2):
+                zoomout = self.archive(drive, shard=Shard(number, 2))
+                self.assertEqual(zoomout.zoom.client.rate_limiter.rate, 5.0)
+                owned = [user['id'] for user in self.zoom.users if Shard(number, 2).owns(user['id'])]
+                self.assertEqual(sorted(user_id for user_id, recordings in self.zoom.recordings.items()
+                                        if user_id in owned and recordings), [])
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+        self.assertFalse(self.done)
+
+        done_file_path = os.environ['ZOOMOUT_DONEFILE_PATH']
+        metrics_path = os.path.join(self.directory, 'zoomout_metrics.json')
+        self.assertTrue(quietly(wait_for_shards, done_file_path, 2, metrics_path=metrics_path, timeout=1))
+        self.assertTrue(self.done)
+        self.assertFalse(os.path.exists(Shard(1, 2).path(done_file_path)))
+        with open(metrics_path) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual(sorted(summary['shards']), ['1/2', '2/2'])
+        self.assertEqual(summary['totals']['files'], self.zoom.total_files)
+
+    def test_coordinator_gives_up_on_missing_shards(self):
+        done_file_path = os.environ['ZOOMOUT_DONEFILE_PATH']
+        with open(Shard(2, 3).path(done_file_path), 'wb') as done_file:
+            done_file.write('Done')
+        self.assertFalse(quietly(wait_for_shards, done_file_path, 3, poll_interval=0.05, timeout=0.2))
+        self.assertFalse(self.done)
+        self.assertTrue(os.path.exists(Shard(2, 3).path(done_file_path)))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        host = Host('user1', 'host1@example.edu')
+        self.old = zoom_meeting(host, 1, ['a'])
+        self.big = zoom_meeting(host, 2, ['b', 'c'])
+        self.new = zoom_meeting(host, 3, ['d'])
+        self.old.start_time -= timedelta(days=1)
+        self.new.start_time += timedelta(hours=1)
+        self.big.recording_files[1].file_size = 5 * KB
+
+    def test_order(self):
+        meetings = [self.new, self.big, self.old]
+        self.assertEqual(Scheduler('listing').order(iter(meetings)), meetings)
+        self.assertEqual(Scheduler('oldest').order(meetings), [self.old, self.big, self.new])
+        self.assertEqual(Scheduler('largest').order(meetings)[0], self.big)
+        self.assertEqual([recording_file.id for recording_file in Scheduler('largest').order_files(
+            self.big.recording_files)], ['c', 'b'])
+        self.assertEqual([recording_file.id for recording_file in Scheduler('oldest').order_files(
+            self.big.recording_files)], ['b', 'c'])
+        self.assertRaises(ValueError, Scheduler, 'newest')
+
+    def test_time_budget_starts_with_the_run(self):
+        scheduler = Scheduler(time_budget=0)
+        self.assertFalse(scheduler.expired)
+        scheduler.start()
+        self.assertTrue(scheduler.expired)
+        scheduler = Scheduler()
+        scheduler.start()
+        self.assertFalse(scheduler.expired)
+
+
+class TimeBudgetTest(ArchiveRunTest):
+
+    def stopped(self):
+        """Returns the journal's 'stopped' entries"""
+        with open(os.environ['ZOOMOUT_JOURNAL_PATH']) as journal_file:
+            return [entry for entry in map(json.loads, journal_file) if entry['state'] == 'stopped']
+
+    def assert_leaves_everything(self, remaining_meetings, **kwargs):
+        drive = benchmark.FakeDrive().start()
+        try:
+            self.archive(drive, time_budget=0, **kwargs)
+            self.assertEqual(self.zoom.calls.get('recording/delete'), None)
+            self.assertEqual(self.remaining_files(), self.zoom.total_files)
+            self.assertTrue(self.done)
+            stopped, = self.stopped()
+            self.assertEqual(stopped['remaining_meetings'], remaining_meetings)
+            self.assertEqual(stopped['remaining_bytes'], remaining_meetings * self.files * self.file_size)
+            # The next run picks up what was left
+            self.archive(drive, resume=True, **kwargs)
+        finally:
+            drive.stop()
+        self.assertEqual(self.remaining_files(), 0)
+
+    def test_out_of_time_in_listing_order(self):
+        # Only the meeting pulled from Zoom when time was up; the rest are listed again next time
+        self.assert_leaves_everything(1)
+
+    def test_out_of_time_in_priority_order(self):
+        self.assert_leaves_everything(self.users * self.meetings, priority='oldest')
+
+
+class RecordsTest(ArchiveRunTest):
+
+    def test_host_registry(self):
+        hosts = HostRegistry()
+        self.assertEqual(hosts.get('user1').email, None)
+        host = hosts.get({'id': 'user1', 'email': 'host1@example.edu', 'type': 2})
+        self.assertTrue(hosts.get({'id': 'user1', 'email': 'host1@example.edu'}) is host)
+        self.assertTrue(hosts.get('user1') is host)
+
+    def test_meetings_survive_the_journal(self):
+        meeting = zoom_meeting(Host('user1', 'host1@example.edu'), 123456789, ['file1', 'file2'])
+        copy = Meeting.from_dict(json.loads(json.dumps(meeting.to_dict())), HostRegistry())
+        for name in Meeting.__slots__:
+            if name not in ('host', 'recording_files'):
+                self.assertEqual(getattr(copy, name), getattr(meeting, name))
+        self.assertEqual([(recording_file.id, recording_file.meeting_id, recording_file.file_size)
+                          for recording_file in copy.recording_files],
+                         [(recording_file.id, recording_file.meeting_id, recording_file.file_size)
+                          for recording_file in meeting.recording_files])
+
+    def test_list_recordings_takes_a_user_id_or_dict(self):
+        zoom = ZoomApi('test', 'test', base_url=self.zoom.url + 'v1/')
+        by_id = list(zoom.list_recordings('user1'))
+        by_dict = list(zoom.list_recordings(self.zoom.users[1]))
+        self.assertEqual([meeting.uuid for meeting in by_id], [meeting.uuid for meeting in by_dict])
+        self.assertEqual(len(by_id), self.meetings)
+        self.assertEqual(by_dict[0].host.email, self.zoom.users[1]['email'])
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_items_flow_through_every_stage(self):
+        results = []
+        pipeline = Pipeline()
+        pipeline.add_stage('double', lambda item: item * 2, workers=3)
+        pipeline.add_stage('drop odd', lambda item: item if item % 4 == 0 else None, workers=2)
+        pipeline.add_stage('collect', results.append)
+        pipeline.start()
+        for item in range(20):
+            pipeline.put(item)
+        pipeline.join()
+        self.assertEqual(sorted(results), [item * 2 for item in range(0, 20, 2)])
+
+    def test_put_blocks_while_the_first_stage_is_full(self):
+        release = threading.Event()
+        pipeline = Pipeline()
+        pipeline.add_stage('wait', lambda item: release.wait(), workers=1, queue_size=2)
+        pipeline.start()
+        put = []
+
+        def producer():
+            for item in range(5):
+                pipeline.put(item)
+                put.append(item)
+        thread = threading.Thread(target=producer)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.2)
+        # One item with the worker and two in the queue: the producer waits on the fourth
+        self.assertEqual(len(put), 3)
+        release.set()
+        thread.join(5)
+        pipeline.join()
+        self.assertEqual(len(put), 5)
+
+    def test_errors_go_to_the_handler(self):
+        errors = []
+        pipeline = Pipeline(error_handler=lambda stage, item, exc: errors.append((stage, item, str(exc))))
+        pipeline.add_stage('divide', lambda item: 10 / item)
+        pipeline.start()
+        for item in (1, 0, 2):
+            pipeline.put(item)
+        pipeline.join()
+        self.assertEqual(errors, [('divide', 0, 'integer division or modulo by zero')])
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_paces_calls_after_the_burst(self):
+        limiter = RateLimiter(20)
+        started = time.time()
+        for _ in range(30):
+            limiter.acquire()
+        # The first 20 are the burst, the next 10 come at 20 a second
+        self.assertTrue(0.45 <= time.time() - started < 1.0)
+
+
+class AsyncZoomApiTest(ArchiveRunTest):
+
+    users, meetings = 20, 2
+
+    def test_collect_meetings_keeps_the_hosts_in_order(self):
+        zoom = AsyncZoomApi('test', 'test', concurrency=4, requests_per_second=1000, base_url=self.zoom.url + 'v1/')
+        done = []
+        try:
+            meetings = list(zoom.collect_meetings(host_done=done.append))
+        finally:
+            zoom.close()
+        hosts = ['user{0}'.format(number) for number in range(self.users)]
+        self.assertEqual([host.id for host in done], hosts)
+        self.assertEqual([meeting.host.id for meeting in meetings], [host for host in hosts for _ in range(self.meetings)])
+
+    def test_single_calls_return_futures(self):
+        zoom = AsyncZoomApi('test', 'test', base_url=self.zoom.url + 'v1/')
+        try:
+            future = zoom.list_recordings('user3')
+            self.assertEqual(len(future.get(5)), self.meetings)
+            meeting = future.get()[0]
+            recording_file = meeting.recording_files[0]
+            response = zoom.delete_recording(recording_file.meeting_id, recording_file.id).get(5)
+        finally:
+            zoom.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.remaining_files(), self.zoom.total_files - 1)
+
+
+class StreamingMediaUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3 * 256 * KB + 1000)
+        self.media = StreamingMediaUpload(StringIO.StringIO(self.data), size=len(self.data), chunksize=256 * KB)
+
+    def test_chunks_in_order(self):
+        chunks = [self.media.getbytes(begin, 256 * KB) for begin in range(0, len(self.data), 256 * KB)]
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertEqual(self.media.bytes_read, len(self.data))
+        self.assertEqual(self.media.hexdigest(), hashlib.md5(self.data).hexdigest())
+
+    def test_resends_a_failed_chunk_from_the_buffer(self):
+        first = self.media.getbytes(0, 256 * KB)
+        again = self.media.getbytes(0, 256 * KB)
+        self.assertEqual(first, again)
+        # Drive kept only part of the chunk: the rest is sent again, followed by new bytes
+        partial = self.media.getbytes(100 * KB, 256 * KB)
+        self.assertEqual(partial, self.data[100 * KB:356 * KB])
+        self.assertEqual(self.media.bytes_read, 356 * KB)  # Resent bytes are hashed once
+
+    def test_cannot_rewind_past_the_buffer(self):
+        self.media.getbytes(0, 256 * KB)
+        self.media.getbytes(256 * KB, 256 * KB)
+        self.assertRaises(StreamRewindError, self.media.getbytes, 0, 256 * KB)
+
+    def test_skips_bytes_a_resumed_session_already_has(self):
+        self.assertEqual(self.media.getbytes(512 * KB, 256 * KB), self.data[512 * KB:768 * KB])
+        self.assertEqual(self.media.getbytes(768 * KB, 256 * KB), self.data[768 * KB:])
+        self.assertRaises(StreamRewindError, self.media.getbytes, 0, 256 * KB)
+        # The skipped bytes were read, so the hash still covers the whole file
+        self.assertEqual(self.media.hexdigest(), hashlib.md5(self.data).hexdigest())
+
+    def test_short_read_at_the_end(self):
+        self.media.getbytes(0, len(self.data) - 10)
+        self.assertEqual(self.media.getbytes(len(self.data) - 10, 256 * KB), self.data[-10:])
+        self.assertEqual(self.media.getbytes(len(self.data), 256 * KB), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import Queue
+import threading
+
+# Placed on a stage's queue once per worker to tell the workers that no more items are coming
+_DONE = object()
+
+
+class Pipeline(object):
+    def __init__(self, error_handler=None):
+        """Initializer for a Pipeline: a chain of stages, each with its own pool of worker threads, connected by queues.
+
+        error_handler: Called as error_handler(stage_name, item, exception) when a stage handler raises. The item is
+        dropped from the pipeline afterwards.
+        """
+        self.error_handler = error_handler
+        self.stages = []
+
+    def add_stage(self, name, handler, workers=1, queue_size=0):
+        """Appends a stage to the pipeline. Must be called before start().
+
+        name: A label for the stage, handed to the error handler
+
+        handler: Function taking an item and returning the item to pass to the next stage, or None to drop it
+
+        workers: Number of threads running the handler
+
+        queue_size: Maximum number of items waiting for this stage. Producers block when it is full. 0 means unbounded.
+        """
+        self.stages.append(dict(name=name,
+                                handler=handler,
+                                workers=max(1, workers),
+                                queue=Queue.Queue(queue_size),
+                                threads=[]))
+
+    def start(self):
+        """Starts the worker threads of every stage."""
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage['workers']):
+                thread = threading.Thread(target=self._work, args=(index,), name=stage['name'])
+                thread.daemon = True
+                thread.start()
+                stage['threads'].append(thread)
+
+    def put(self, item):
+        """Feeds an item into the first stage, blocking while that stage's queue is full."""
+        self.stages[0]['queue'].put(item)
+
+    def join(self):
+        """Waits for every item fed so far to work its way through the pipeline, then stops the worker threads."""
+        for stage in self.stages:
+            for _ in stage['threads']:
+                stage['queue'].put(_DONE)
+            for thread in stage['threads']:
+                thread.join()
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage['queue'].get()
+            if item is _DONE:
+                return
+            try:
+                result = stage['handler'](item)
+            except Exception as exc:
+                if self.error_handler:
+                    self.error_handler(stage['name'], item, exc)
+                continue
+            if result is not None and next_stage:
+                next_stage['queue'].put(result)
@@ -0,0 +1,161 @@
+from datetime import datetime
+import threading
+
+# Format of the start_time of Zoom recordings, like '2017-03-01T15:00:00Z'
+ZOOM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def seconds_since(start_time):
+    """Returns how many seconds ago start_time was, a datetime in UTC like the start_time of a Meeting"""
+    return (datetime.utcnow() - start_time).total_seconds()
+
+
+class Host(object):
+    __slots__ = ('id', 'email')
+
+    def __init__(self, id, email):
+        """Initializer for a Host: a Zoom user whose recordings are archived. Get them from a HostRegistry, so every
+        meeting of a host points to the same Host.
+
+        id: Zoom user id
+
+        email: Zoom user email address, which is also the host's Google account, or None when only the id is known
+        """
+        self.id = id
+        self.email = email
+
+    @property
+    def username(self):
+        """The email address stripped of '@' and anything after it"""
+        return self.email.split('@')[0]
+
+    def to_dict(self):
+        """Returns the host in the shape of a Zoom user, for the journal"""
+        return dict(id=self.id, email=self.email)
+
+
+class HostRegistry(object):
+    def __init__(self):
+        """Initializer for a HostRegistry, which hands out one Host per Zoom user id. Thread safe."""
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def get(self, user):
+        """Returns the Host for a Zoom user dict holding at least its id and email, creating it on first sight. Also
+        takes a bare Zoom user id, for which a Host without an email is returned unless the user was seen before."""
+        if not isinstance(user, dict):
+            with self.lock:
+                host = self.hosts.get(user)
+            return host if host is not None else Host(user, None)
+        with self.lock:
+            host = self.hosts.get(user['id'])
+            if host is None:
+                host = self.hosts[user['id']] = Host(user['id'], user['email'])
+            return host
+
+
+class RecordingFile(object):
+    __slots__ = ('id', 'meeting_id', 'file_type', 'download_url', 'file_size')
+
+    def __init__(self, id, meeting_id, file_type, download_url, file_size=None):
+        """Initializer for a RecordingFile: one file of a meeting recording in Zoom.
+
+        id: Zoom file id
+
+        meeting_id: Zoom meeting UUID the file belongs to, for recording/delete
+
+        file_type: Extension of the file, like 'MP4' or 'M4A'
+
+        download_url: Where the file is downloaded from
+
+        file_size: Size in bytes reported by Zoom, or None if it reported none
+        """
+        self.id = id
+        self.meeting_id = meeting_id
+        self.file_type = file_type
+        self.download_url = download_url
+        self.file_size = file_size
+
+    @classmethod
+    def from_zoom(cls, recording_file, meeting_uuid=None):
+        """Builds a RecordingFile from an entry of a recording's "recording_files" array. The meeting_id string is
+        shared with meeting_uuid when they are equal, rather than kept twice."""
+        meeting_id = recording_file['meeting_id']
+        if meeting_id == meeting_uuid:
+            meeting_id = meeting_uuid
+        return cls(recording_file['id'], meeting_id, intern(str(recording_file['file_type'])),
+                   recording_file['download_url'], recording_file.get('file_size'))
+
+    @property
+    def filename(self):
+        """Local file name of the recording file, like '123abc.MP4'"""
+        return "{0}.{1}".format(self.id, self.file_type)
+
+    def to_dict(self):
+        """Returns the file in the shape of a Zoom recording file, for the journal"""
+        return dict(id=self.id, meeting_id=self.meeting_id, file_type=self.file_type, download_url=self.download_url,
+                    file_size=self.file_size)
+
+
+class Meeting(object):
+    __slots__ = ('host', 'uuid', 'meeting_number', 'topic', 'start_time', 'recording_files')
+
+    def __init__(self, host, uuid, meeting_number, topic, start_time, recording_files):
+        """Initializer for a Meeting: one recorded meeting in Zoom, holding just what a run needs.
+
+        host: The Host who recorded it
+
+        uuid: Zoom meeting UUID of this occurrence of the meeting
+
+        meeting_number: Zoom meeting id, shared by every occurrence of a recurring meeting
+
+        topic: Topic of the meeting, or None
+
+        start_time: When the recording started, a datetime in UTC
+
+        recording_files: Tuple of RecordingFile
+        """
+        self.host = host
+        self.uuid = uuid
+        self.meeting_number = meeting_number
+        self.topic = topic
+        self.start_time = start_time
+        self.recording_files = recording_files
+
+    @classmethod
+    def from_zoom(cls, host, recording):
+        """Builds a Meeting from an entry of the "meetings" array of /v1/recording/list, recorded by host"""
+        uuid = recording.get('uuid', recording.get('id'))
+        return cls(host,
+                   uuid,
+                   recording['meeting_number'],
+                   recording.get('topic'),
+                   datetime.strptime(recording['start_time'], ZOOM_TIME_FORMAT),
+                   tuple(RecordingFile.from_zoom(recording_file, uuid)
+                         for recording_file in recording.get('recording_files') or ()))
+
+    @classmethod
+    def from_dict(cls, meeting, hosts):
+        """Builds a Meeting back from to_dict(), taking its Host from the HostRegistry hosts"""
+        return cls.from_zoom(hosts.get(meeting['host']), meeting['recording'])
+
+    @property
+    def start_time_text(self):
+        """start_time in Zoom's format, like '2017-03-01T15:00:00Z'"""
+        return self.start_time.strftime(ZOOM_TIME_FORMAT)
+
+    @property
+    def size(self):
+        """Total bytes Zoom reports for the recording files"""
+        return sum(recording_file.file_size or 0 for recording_file in self.recording_files)
+
+    def to_dict(self):
+        """Returns the meeting in the shape collect_meetings used to yield, a Zoom user and a Zoom recording, for the
+        journal"""
+        return dict(host=self.host.to_dict(),
+                    recording=dict(uuid=self.uuid,
+                                   meeting_number=self.meeting_number,
+                                   topic=self.topic,
+                                   start_time=self.start_time_text,
+                                   recording_files=[recording_file.to_dict()
+                                                    for recording_file in self.recording_files]))
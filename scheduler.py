@@ -0,0 +1,72 @@
+from zoom_api import RateLimiter
+import time
+
+# Orders in which meetings can be archived: as Zoom lists them, oldest recording first, or largest meeting first
+POLICIES = ('listing', 'oldest', 'largest')
+
+
+class Scheduler(object):
+    def __init__(self, policy='listing', bandwidth=None, time_budget=None):
+        """Initializer for a Scheduler, which decides the order recordings are archived in and how fast and how long
+        the transfers may run.
+
+        policy: One of POLICIES. With 'listing', meetings are archived as they stream in from Zoom. With 'oldest' or
+        'largest', every eligible meeting is listed first, then archived oldest start_time first, or largest total
+        file_size first with each meeting's largest files first.
+
+        bandwidth: Bytes per second allowed across all workers, in each direction (downloads from Zoom and uploads to
+        Drive), or None for no cap
+
+        time_budget: Seconds after start() when no new recording file should be started, or None for no limit
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy '{0}', expected one of {1}".format(policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self.time_budget = time_budget
+        self.deadline = None
+        self.downloads = RateLimiter(bandwidth) if bandwidth else None
+        self.uploads = RateLimiter(bandwidth) if bandwidth else None
+
+    @property
+    def buffers(self):
+        """True when the policy needs every eligible meeting before it can hand out the first one"""
+        return self.policy != 'listing'
+
+    def start(self):
+        """Starts the clock on the time budget"""
+        if self.time_budget is not None:
+            self.deadline = time.time() + self.time_budget
+
+    @property
+    def expired(self):
+        """True once the time budget has run out"""
+        return self.deadline is not None and time.time() >= self.deadline
+
+    @staticmethod
+    def meeting_size(meeting):
+        """Returns the total file_size Zoom reports for a meeting's recording files"""
+        return meeting.size
+
+    def order(self, meetings):
+        """Returns a list of meetings sorted by the policy. The 'listing' policy keeps the order given."""
+        if self.policy == 'oldest':
+            return sorted(meetings, key=lambda meeting: meeting.start_time)
+        if self.policy == 'largest':
+            return sorted(meetings, key=self.meeting_size, reverse=True)
+        return list(meetings)
+
+    def order_files(self, recording_files):
+        """Returns a list of a meeting's recording files in the order they should be transferred"""
+        if self.policy == 'largest':
+            return sorted(recording_files, key=lambda recording_file: recording_file.file_size or 0, reverse=True)
+        return list(recording_files)
+
+    def throttle_download(self, size):
+        """Waits until size more bytes may be downloaded under the bandwidth cap"""
+        if self.downloads:
+            self.downloads.acquire(size)
+
+    def throttle_upload(self, size):
+        """Waits until size more bytes may be uploaded under the bandwidth cap"""
+        if self.uploads:
+            self.uploads.acquire(size)
@@ -0,0 +1,107 @@
+from metrics import log
+import argparse
+import hashlib
+import json
+import os
+import time
+
+
+class Shard(object):
+    def __init__(self, number, count):
+        """Initializer for a Shard: one of count processes splitting the account's hosts between them. Every process
+        computes the same split, so they need no coordination while they run.
+
+        number: Which shard this is, from 1 to count
+
+        count: Number of shards
+        """
+        if count < 1 or not 1 <= number <= count:
+            raise ValueError("Shard {0}/{1} doesn't exist".format(number, count))
+        self.number = number
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """Builds a Shard from text like '3/8'. Raises argparse.ArgumentTypeError when the text isn't one, so it can be
+        used as an argparse type."""
+        try:
+            number, count = [int(part) for part in text.split('/')]
+            return cls(number, count)
+        except ValueError:
+            raise argparse.ArgumentTypeError("expected a shard like 3/8, numbered from 1, got '{0}'".format(text))
+
+    def __str__(self):
+        return '{0}/{1}'.format(self.number, self.count)
+
+    def owns(self, zoom_user_id):
+        """True when a host's recordings belong to this shard. Hosts are spread by a hash of their Zoom user id."""
+        digest = hashlib.md5(str(zoom_user_id)).hexdigest()
+        return int(digest[:8], 16) % self.count == self.number - 1
+
+    def path(self, path):
+        """Returns this shard's version of a file path, with the shard in the name before the extension, like
+        'zoomout_index.shard3of8.db' for 'zoomout_index.db'. os.devnull is returned as is."""
+        if path == os.devnull:
+            return path
+        root, extension = os.path.splitext(path)
+        return '{0}.shard{1}of{2}{3}'.format(root, self.number, self.count, extension)
+
+
+def wait_for_shards(done_file_path, count, metrics_path=None, poll_interval=30, timeout=None):
+    """Coordinator for a sharded run. Waits until every one of count shards has written its done file, then writes the
+    global done file at done_file_path and removes the shard done files, so the next run's coordinator doesn't take
+    them for its own.
+
+    metrics_path: Where the shards' metrics summaries are, unsharded. When given, their totals are added up into a
+    summary there.
+
+    poll_interval: Seconds between looks at the shard done files
+
+    timeout: Seconds to wait before giving up, or None to wait for as long as it takes
+
+    Returns True when the global done file was written, False on timeout
+    """
+    shards = [Shard(number, count) for number in range(1, count + 1)]
+    started = time.time()
+    finished = set()
+    while True:
+        for shard in shards:
+            if shard.number not in finished and os.path.exists(shard.path(done_file_path)):
+                finished.add(shard.number)
+                log("Shard {0} is done, {1} of {2}".format(shard, len(finished), count), shard=str(shard))
+        if len(finished) == count:
+            break
+        waited = time.time() - started
+        if timeout is not None and waited >= timeout:
+            log("Gave up waiting for shards {0}".format(', '.join(str(shard) for shard in shards
+                                                                  if shard.number not in finished)),
+                finished=len(finished), shards=count)
+            return False
+        time.sleep(poll_interval if timeout is None else min(poll_interval, timeout - waited))
+
+    if metrics_path:
+        merge_summaries(metrics_path, shards)
+    with open(done_file_path, 'wb') as done_file:
+        done_file.write('Done')
+    for shard in shards:
+        if shard.path(done_file_path) != done_file_path:
+            os.remove(shard.path(done_file_path))
+    log("All {0} shards are done".format(count), shards=count)
+    return True
+
+
+def merge_summaries(metrics_path, shards):
+    """Writes a metrics summary at metrics_path holding the summary of each shard and the sum of their totals. Shards
+    without a summary are left out. Returns nothing."""
+    merged = dict(shards={}, totals={})
+    for shard in shards:
+        try:
+            with open(shard.path(metrics_path), 'rb') as summary_file:
+                summary = json.load(summary_file)
+        except (IOError, ValueError):
+            continue
+        merged['shards'][str(shard)] = summary
+        for name, value in summary.get('totals', {}).items():
+            merged['totals'][name] = merged['totals'].get(name, 0) + value
+    with open(metrics_path, 'wb') as merged_file:
+        json.dump(merged, merged_file, indent=2, sort_keys=True)
@@ -0,0 +1,94 @@
+import threading
+
+# Meeting folders named in a digest notification before the rest are summed up as "and N more"
+MAX_LISTED_MEETINGS = 20
+
+
+class _HostShares(object):
+    def __init__(self, host):
+        self.host = host
+        self.top_folder_id = None
+        self.meeting_folders = []
+
+
+class ShareQueue(object):
+    def __init__(self, share_message, top_folder_message, max_listed=MAX_LISTED_MEETINGS):
+        """Initializer for a ShareQueue, which holds the Drive permission grants of a run until its end, so every host
+        gets one notification email however many of their meetings were archived. A new top level folder is also
+        granted without a notification as soon as it is created, so its host keeps access if the run dies before the
+        end.
+
+        Meeting folders live in their host's top level folder and inherit its permissions, so a meeting folder never
+        needs a grant of its own: the host is granted the top level folder once, and the notification lists the new
+        meeting folders.
+
+        share_message: Message telling a host their recordings are in Drive, like messaging['share'] from
+        ZoomOut.load_messaging
+
+        top_folder_message: Message telling a host their top level folder was just created
+
+        max_listed: Meeting folders named in a notification before the rest are counted
+        """
+        self.share_message = share_message
+        self.top_folder_message = top_folder_message
+        self.max_listed = max_listed
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.hosts)
+
+    def _host(self, host):
+        shares = self.hosts.get(host.id)
+        if shares is None:
+            shares = self.hosts[host.id] = _HostShares(host)
+        return shares
+
+    def add_top_folder(self, host, folder_id):
+        """Queues the grant of a newly created top level folder to its host"""
+        with self.lock:
+            self._host(host).top_folder_id = folder_id
+
+    def add_meeting_folder(self, host, folder_id, folder_name):
+        """Queues a fully uploaded meeting folder for its host's notification"""
+        with self.lock:
+            self._host(host).meeting_folders.append((folder_id, folder_name))
+
+    def message(self, new_top_folder, folder_names):
+        """Returns the digest notification for one host: the top level folder message when their folder is new, then
+        the share message and the names of the meeting folders added"""
+        paragraphs = []
+        if new_top_folder:
+            paragraphs.append(self.top_folder_message)
+        if folder_names:
+            lines = ["{0} recorded meeting{1} added:".format(len(folder_names), '' if len(folder_names) == 1 else 's')]
+            lines.extend(" * {0}".format(name) for name in folder_names[:self.max_listed])
+            if len(folder_names) > self.max_listed:
+                lines.append(" ... and {0} more".format(len(folder_names) - self.max_listed))
+            paragraphs.append(self.share_message)
+            paragraphs.append('\n'.join(lines))
+        return '\n\n'.join(paragraphs)
+
+    def drain(self, top_folder):
+        """Empties the queue. Returns one (host, document_id, message) grant per host: their top level folder, with the
+        digest of what was added to it.
+
+        top_folder: Called with a Zoom user id to find the id of the host's top level folder when it wasn't created
+        in this run, like StateIndex.top_folder. It is granted again to make sure the meeting folders inherit the
+        host's access; Drive keeps a single permission per user. When it returns None, each meeting folder is granted
+        instead, with the notification on the first one only.
+        """
+        with self.lock:
+            hosts, self.hosts = self.hosts, {}
+        grants = []
+        for shares in hosts.values():
+            folder_names = [name for folder_id, name in shares.meeting_folders]
+            message = self.message(shares.top_folder_id is not None, folder_names)
+            top_folder_id = shares.top_folder_id or top_folder(shares.host.id)
+            if top_folder_id:
+                grants.append((shares.host, top_folder_id, message))
+                continue
+            for position, (folder_id, name) in enumerate(shares.meeting_folders):
+                grants.append((shares.host, folder_id, message if position == 0 else None))
+        return grants
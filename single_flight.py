@@ -0,0 +1,57 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache(object):
+    def __init__(self):
+        """Initializer for a SingleFlightCache: a per-run, thread-safe memo where concurrent requests for a key that
+        isn't cached yet share one computation instead of each running their own."""
+        self.lock = threading.Lock()
+        self.values = {}
+        self.calls = {}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.values
+
+    def set(self, key, value):
+        """Caches a value computed elsewhere, like the result of a batched request."""
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, key, compute):
+        """Returns the cached value for key. On a miss, the first caller runs compute() while later callers for the
+        same key wait for its result. If compute() raises, every waiting caller gets the exception and nothing is
+        cached, so the next call tries again."""
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+        except Exception as exc:
+            call.error = exc
+            raise
+        else:
+            with self.lock:
+                self.values[key] = call.value
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.value
@@ -0,0 +1,168 @@
+from datetime import datetime
+import sqlite3
+import threading
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class DriveInventory(object):
+    def __init__(self):
+        """Initializer for a DriveInventory: the Drive objects ZoomOut created, indexed in memory by Zoom user id, Zoom
+        meeting id and Zoom file id. Fill it with add() or build it with from_listing()."""
+        self.top_folders = {}
+        self.meeting_folders = {}
+        self.files = {}
+        self.files_by_meeting = {}
+        self.meetings_by_user = {}
+        self.folder_users = {}
+
+    @classmethod
+    def from_listing(cls, drive_objects):
+        """Builds an inventory from an iterable of Drive file resources holding id, mimeType, parents and
+        appProperties. Returns the DriveInventory."""
+        inventory = cls()
+        for drive_object in drive_objects:
+            inventory.add(drive_object)
+        return inventory
+
+    def add(self, drive_object):
+        """Indexes one Drive file resource. Returns True if it is a top level folder, meeting folder or recording file
+        created by ZoomOut, False if it was ignored."""
+        properties = drive_object.get('appProperties') or {}
+        self.meetings_by_user = {}  # Rebuilt on the next meetings_for_user() call
+        is_folder = drive_object.get('mimeType') == FOLDER_MIME_TYPE
+        if is_folder and 'zoomUserId' in properties:
+            user_id = str(properties['zoomUserId'])
+            self.top_folders[user_id] = drive_object
+            self.folder_users[drive_object['id']] = user_id
+        elif is_folder and 'zoomMeetingId' in properties:
+            self.meeting_folders[str(properties['zoomMeetingId'])] = drive_object
+        elif 'zoomFileId' in properties:
+            self.files[str(properties['zoomFileId'])] = drive_object
+            if 'zoomMeetingId' in properties:
+                self.files_by_meeting.setdefault(str(properties['zoomMeetingId']), []).append(drive_object)
+        else:
+            return False
+        return True
+
+    def meeting_ids(self):
+        """Returns the Zoom meeting ids that have a folder in Drive, as strings"""
+        return self.meeting_folders.keys()
+
+    def meetings_for_user(self, zoom_user_id):
+        """Returns the Zoom meeting ids whose folders sit in a host's top level folder"""
+        if not self.meetings_by_user:
+            for meeting_id, folder in self.meeting_folders.items():
+                for parent in folder.get('parents', []):
+                    if parent in self.folder_users:
+                        self.meetings_by_user.setdefault(self.folder_users[parent], []).append(meeting_id)
+        return self.meetings_by_user.get(str(zoom_user_id), [])
+
+    def files_for_meeting(self, zoom_meeting_id):
+        """Returns the recording files uploaded for a Zoom meeting"""
+        return self.files_by_meeting.get(str(zoom_meeting_id), [])
+
+
+class StateIndex(object):
+    def __init__(self, path):
+        """Initializer for a StateIndex: a SQLite database mapping Zoom user, meeting and file ids to the Drive objects
+        ZoomOut created for them, so lookups don't need a Drive query. Safe to share between threads.
+
+        path: Location of the SQLite database file. It is created if it doesn't exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS top_folders (zoom_user_id TEXT PRIMARY KEY, drive_id TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meeting_folders (zoom_meeting_id TEXT PRIMARY KEY, drive_id TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS files (zoom_file_id TEXT PRIMARY KEY, drive_id TEXT, state TEXT NOT NULL,
+                                                  updated TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS host_marks (zoom_user_id TEXT PRIMARY KEY, high_water TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS pending_meetings (meeting_uuid TEXT PRIMARY KEY, zoom_user_id TEXT NOT NULL,
+                                                             start_time TEXT NOT NULL);
+            """)
+
+    def _fetch(self, query, params):
+        with self.lock:
+            row = self.connection.execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def _write(self, query, params):
+        with self.lock, self.connection:
+            self.connection.execute(query, params)
+
+    @property
+    def bootstrapped(self):
+        """True once the index has been loaded from a Drive listing. Until then a miss doesn't mean Drive lacks the
+        object."""
+        return self._fetch("SELECT value FROM meta WHERE key = 'bootstrapped'", ()) is not None
+
+    def load(self, inventory):
+        """Replaces the Drive contents of the index with a DriveInventory. The incremental listing state is kept.
+        Returns nothing."""
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.connection:
+            for table in ('top_folders', 'meeting_folders', 'files', 'meta'):
+                self.connection.execute("DELETE FROM {0}".format(table))
+            self.connection.executemany("INSERT INTO top_folders VALUES (?, ?)",
+                                        [(user_id, folder['id']) for user_id, folder in inventory.top_folders.items()])
+            self.connection.executemany("INSERT INTO meeting_folders VALUES (?, ?)",
+                                        [(meeting_id, folder['id'])
+                                         for meeting_id, folder in inventory.meeting_folders.items()])
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, 'uploaded', ?)",
+                                        [(file_id, drive_file['id'], now)
+                                         for file_id, drive_file in inventory.files.items()])
+            self.connection.execute("INSERT INTO meta VALUES ('bootstrapped', ?)", (now,))
+
+    def top_folder(self, zoom_user_id):
+        """Returns the Drive id of a host's top level folder, or None"""
+        return self._fetch("SELECT drive_id FROM top_folders WHERE zoom_user_id = ?", (str(zoom_user_id),))
+
+    def meeting_folder(self, zoom_meeting_id):
+        """Returns the Drive id of a meeting's folder, or None"""
+        return self._fetch("SELECT drive_id FROM meeting_folders WHERE zoom_meeting_id = ?", (str(zoom_meeting_id),))
+
+    def file_state(self, zoom_file_id):
+        """Returns the transfer state of a recording file ('uploaded' or 'deleted'), or None if it isn't in Drive"""
+        return self._fetch("SELECT state FROM files WHERE zoom_file_id = ?", (str(zoom_file_id),))
+
+    def record_top_folder(self, zoom_user_id, drive_id):
+        """Remembers the Drive id of a host's top level folder"""
+        self._write("INSERT OR REPLACE INTO top_folders VALUES (?, ?)", (str(zoom_user_id), drive_id))
+
+    def record_meeting_folder(self, zoom_meeting_id, drive_id):
+        """Remembers the Drive id of a meeting's folder"""
+        self._write("INSERT OR REPLACE INTO meeting_folders VALUES (?, ?)", (str(zoom_meeting_id), drive_id))
+
+    def record_file(self, zoom_file_id, state, drive_id=None):
+        """Records the transfer state of a recording file. drive_id is kept from earlier records when not given."""
+        self._write("INSERT OR REPLACE INTO files VALUES (?, COALESCE(?, (SELECT drive_id FROM files WHERE zoom_file_id = ?)), ?, ?)",
+                    (str(zoom_file_id), drive_id, str(zoom_file_id), state, datetime.utcnow().isoformat()))
+
+    def high_water(self, zoom_user_id):
+        """Returns the date, as 'YYYY-MM-DD', up to which a host's recordings were last listed in full, or None if
+        they never were"""
+        return self._fetch("SELECT high_water FROM host_marks WHERE zoom_user_id = ?", (str(zoom_user_id),))
+
+    def record_high_water(self, zoom_user_id, date):
+        """Remembers that a host's recordings were listed in full up to a date given as 'YYYY-MM-DD'"""
+        self._write("INSERT OR REPLACE INTO host_marks VALUES (?, ?)", (str(zoom_user_id), date))
+
+    def pending_meetings(self, zoom_user_id):
+        """Returns (meeting_uuid, start_time) for every recorded meeting of a host still waiting to be archived"""
+        with self.lock:
+            return self.connection.execute("SELECT meeting_uuid, start_time FROM pending_meetings WHERE zoom_user_id = ?",
+                                           (str(zoom_user_id),)).fetchall()
+
+    def record_pending(self, meeting_uuid, zoom_user_id, start_time):
+        """Remembers a recorded meeting that was listed but not archived, because it wasn't old enough yet or some of its
+        files failed. start_time is Zoom's, like '2017-03-01T15:00:00Z'."""
+        self._write("INSERT OR REPLACE INTO pending_meetings VALUES (?, ?, ?)",
+                    (str(meeting_uuid), str(zoom_user_id), start_time))
+
+    def clear_pending(self, meeting_uuid):
+        """Forgets a pending meeting, once it has been archived or is gone from Zoom"""
+        self._write("DELETE FROM pending_meetings WHERE meeting_uuid = ?", (str(meeting_uuid),))
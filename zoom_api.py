@@ -1,86 +1,283 @@
 import requests
-from time import sleep
+import requests.adapters
+from metrics import Metrics, log
+from records import HostRegistry, Meeting, seconds_since
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from collections import deque
+from time import sleep, time
 import json
+import _strptime  # datetime.strptime imports this lazily, which races when pool threads call it first
 
-class ZoomApi:
-    def __init__(self, api_key, api_secret):
-        """Initializer for ZoomApi object. Takes api_key and api_secret parameters."""
+# Root of the Zoom v1 REST API, which every endpoint name is appended to
+ZOOM_API_URL = 'https://api.zoom.us/v1/'
+
+# Requests per second the Zoom API allows an account, shared by every process talking to it
+ZOOM_REQUESTS_PER_SECOND = 10
+
+
+class ZoomApiError(Exception):
+    """Raised when Zoom answers a call that a run can't do without, like listing the account's users, with an error"""
+    pass
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        """Token bucket shared by every thread talking to the Zoom API.
+
+        rate: Tokens added to the bucket per second (i.e. the sustained requests per second)
+
+        burst: Maximum number of tokens the bucket holds. Defaults to one second's worth of tokens.
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else self.rate
+        self.tokens = self.capacity
+        self.updated = time()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+        """Takes tokens from the bucket, sleeping until the bucket can cover them. Callers that overdraw the bucket
+        reserve their tokens up front, so concurrent callers queue up behind them instead of racing."""
+        with self.lock:
+            now = time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+
+
+class AsyncZoomApi(object):
+    def __init__(self, api_key, api_secret, concurrency=8, requests_per_second=ZOOM_REQUESTS_PER_SECOND,
+                 base_url=ZOOM_API_URL, metrics=None):
+        """Initializer for AsyncZoomApi, a Zoom API client whose calls run on a shared pool of threads. Single calls
+        (post, list_recordings, delete_recording) return AsyncResult futures instead of blocking. list_users and
+        collect_meetings are generators that block their caller, but keep the next page or a window of hosts in
+        flight on the pool. Takes api_key and api_secret parameters.
+
+        concurrency: Number of calls in flight at once, which is also the number of pooled keep-alive connections
+
+        requests_per_second: Request quota shared by every call this object makes against the Zoom API
+
+        base_url: Root URL of the Zoom v1 API, ending in a slash. Point it elsewhere to talk to a stand-in server.
+
+        metrics: Metrics that every call is timed in, under a phase named after its endpoint like 'zoom user/list'
+        """
         self.api_key = api_key
         self.api_secret = api_secret
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool = ThreadPool(concurrency)
+        self.hosts = HostRegistry()
+
+    def request(self, endpoint, **params):
+        """POSTs to a Zoom v1 endpoint like 'user/list' on the calling thread, once the rate limiter allows it, over a
+        pooled connection. Returns the response."""
+        self.rate_limiter.acquire()
+        params.update(api_key=self.api_key, api_secret=self.api_secret)
+        started = time()
+        try:
+            response = self.session.post(self.base_url + endpoint, data=params)
+        except Exception:
+            self.metrics.observe('zoom ' + endpoint, time() - started, error=True)
+            raise
+        self.metrics.observe('zoom ' + endpoint, time() - started, error=response.status_code != 200)
+        return response
+
+    def post(self, endpoint, **params):
+        """Queues a POST to a Zoom v1 endpoint on the pool. Returns an AsyncResult whose get() returns the response."""
+        return self.pool.apply_async(self.request, (endpoint,), params)
 
     def list_users(self):
-        """Queries the /v1/user/list endpoint and returns the array of users from the response."""
-        page = 0
-        max_page = 0
-        users = []
-        while page < 1 or page < max_page:
-            page += 1
-            response = requests.post('https://api.zoom.us/v1/user/list',
-                          data=dict(
-                                  api_key=self.api_key,
-                                  api_secret=self.api_secret,
-                                  page_number=page,
-                                  page_size=300))
-            sleep(0.1)
-            if response.status_code == 200:
+        """Queries the /v1/user/list endpoint and yields the users from the response. The next page is requested
+        before the users of the current one are yielded. Raises ZoomApiError when Zoom fails to list them, so a run
+        stops without its done file instead of passing for one that found nothing to archive."""
+        page = 1
+        pending = self.post('user/list', page_number=page, page_size=300)
+        while pending is not None:
+            response = pending.get()
+            pending = None
+            if response.status_code != 200:
+                raise ZoomApiError("Zoom user list failed with status {0}: {1}".format(response.status_code,
+                                                                                    response.content))
+            try:
                 content = json.loads(response.content)
-                max_page = content['page_count']
-                if not 'users' in content:
-                    print(content)
-                    return
-                for user in content['users']:
-                    users.append(user)
-            else:
-                print(response)
-                return
-        return users
+            except ValueError:
+                content = None
+            if not isinstance(content, dict) or 'users' not in content:
+                raise ZoomApiError("Unexpected Zoom user list: {0}".format(response.content))
+            if page < content['page_count']:
+                page += 1
+                pending = self.post('user/list', page_number=page, page_size=300)
+            for user in content['users']:
+                yield user
 
-    def list_recordings(self, userid):
-        """Fetches the recordings from /v1/recording/list and returns the "meetings" array"""
+    def list_recordings(self, userid, older_than=None, since=None, until=None):
+        """Fetches a host's recordings from /v1/recording/list on the pool. Returns an AsyncResult whose get() returns
+        the entries of the "meetings" array as Meeting records.
+
+        userid: Zoom user id, or a Zoom user dict like the ones list_users yield, which also gives the Meetings' host
+        its email
+
+        older_than: Only keep recordings whose start_time is more than this many seconds ago. Keeps everything when None.
+
+        since, until: Dates like '2017-03-01' passed to Zoom as the "from" and "to" of the listing. Zoom's default range
+        is used when they are None.
+        """
+        host = self.hosts.get(userid)
+        return self.pool.apply_async(lambda: self._fetch_recordings(host, older_than, since, until)[0])
+
+    def _fetch_recordings(self, host, older_than, since=None, until=None):
+        # Returns the host's meetings as Meeting records, built straight from each page so the raw JSON is dropped as
+        # soon as possible, and whether every page of them could be fetched
         page = 0
         max_page = 0
         meetings = []
+        complete = True
+        date_range = {}
+        if since:
+            date_range['from'] = since
+        if until:
+            date_range['to'] = until
         while page < 1 or page < max_page:
             page += 1
-            response = requests.post('https://api.zoom.us/v1/recording/list',
-                             data=dict(
-                                 api_key=self.api_key,
-                                 api_secret=self.api_secret,
-                                 page_number=page,
-                                 page_size=300,
-                                 host_id=userid))
-            sleep(0.1)
+            response = self.request('recording/list',
+                                    page_number=page,
+                                    page_size=300,
+                                    host_id=host.id,
+                                    **date_range)
             if response.status_code == 200:
                 content = json.loads(response.content)
                 max_page = content['page_count'] if 'page_count' in content else 1
                 if not 'meetings' in content:
-                    print(content)
+                    log("Unexpected Zoom recording list", endpoint='recording/list', host=host.id, content=content)
+                    complete = False
                     break
-                for meeting in content['meetings']:
-                    meetings.append(meeting)
+                for recording in content['meetings']:
+                    meeting = Meeting.from_zoom(host, recording)
+                    if older_than is None or seconds_since(meeting.start_time) > older_than:
+                        meetings.append(meeting)
             else:
-                print(response)
-        return meetings
+                log("Zoom recording list failed", endpoint='recording/list', host=host.id, page=page,
+                    status=response.status_code, content=response.content)
+                complete = False
+        return meetings, complete
+
+    def collect_meetings(self, older_than=None, skip_hosts=None, host_done=None, since=None, until=None,
+                         host_filter=None):
+        """Retrieve user list from Zoom. Will iterate through all, looking for aging meeting recordings. Yields Zoom meetings
+        as Meeting records. Every meeting of a host shares one Host record.
+
+        older_than: Only yield recordings that started more than this many seconds ago. Yields everything when None.
+
+        skip_hosts: Collection of user ids whose recordings should not be fetched
+
+        host_filter: Called with each Host. Recordings are only fetched for the hosts it returns True for.
+
+        host_done: Called with a Host once all of that host's meetings have been yielded. It isn't called for a host
+        whose recordings couldn't all be listed.
+
+        since: Called with a host's user id, before its recordings are fetched. Returns the first date of the listing,
+        like '2017-03-01', or None for Zoom's default range.
+
+        until: Last date of every listing, or None for Zoom's default
 
-    def collect_meetings(self):
-        """Retrieve user list from Zoom. Will iterate through all, looking for aging meeting recordings. Returns an array of Zoom meetings
+        Recordings for up to self.concurrency hosts are fetched at once, and at most twice that many hosts are held in
+        memory waiting to be consumed. Meetings come back grouped by host in the order list_users returned the hosts, no
+        matter which host's recordings finished first.
         """
-        user_list = self.list_users()
-        meetings = []
-        for user in user_list:
-            user_recordings = self.list_recordings(user['id'])
-            for recording in user_recordings:
-                meetings.append(dict(host=user, recording=recording))
-        return meetings
+        pending = deque()
+        for user in self.list_users():
+            if skip_hosts and user['id'] in skip_hosts:
+                continue
+            host = self.hosts.get(user)
+            if host_filter and not host_filter(host):
+                continue
+            pending.append((host, self.pool.apply_async(self._fetch_recordings,
+                                                        (host, older_than, since(host.id) if since else None, until))))
+            if len(pending) >= self.concurrency * 2:
+                for meeting in self._drain(pending.popleft(), host_done):
+                    yield meeting
+        while pending:
+            for meeting in self._drain(pending.popleft(), host_done):
+                yield meeting
+
+    @staticmethod
+    def _drain(pending_host, host_done):
+        host, recordings = pending_host
+        meetings, complete = recordings.get()
+        for meeting in meetings:
+            yield meeting
+        if host_done and complete:
+            host_done(host)
+
+    def delete_recording(self, meeting_id, file_id):
+        """Deletes a Zoom recording, leaving the meeting history in place. Returns an AsyncResult whose get() returns the
+        response."""
+        return self.post('recording/delete',
+                         meeting_id=meeting_id,
+                         file_id=file_id)
+
+    def close(self):
+        """Stops the thread pool and closes the pooled connections"""
+        self.pool.terminate()
+        self.pool.join()
+        self.session.close()
+
+
+class ZoomApi:
+    def __init__(self, api_key, api_secret, workers=8, requests_per_second=ZOOM_REQUESTS_PER_SECOND,
+                 base_url=ZOOM_API_URL, metrics=None):
+        """Initializer for ZoomApi object. Takes api_key and api_secret parameters. A blocking wrapper around
+        AsyncZoomApi.
+
+        workers: Number of Zoom calls in flight at once, e.g. hosts whose recordings are fetched at the same time by
+        collect_meetings
+
+        requests_per_second: Request quota shared by every call this object makes against the Zoom API
+
+        base_url: Root URL of the Zoom v1 API, ending in a slash
+
+        metrics: Metrics that every Zoom call is timed in
+        """
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.client = AsyncZoomApi(api_key, api_secret, concurrency=workers, requests_per_second=requests_per_second,
+                                   base_url=base_url, metrics=metrics)
+
+    def post(self, endpoint, **params):
+        """POSTs to a Zoom v1 endpoint like 'user/list' once the rate limiter allows it. Returns the response."""
+        return self.client.post(endpoint, **params).get()
+
+    def list_users(self):
+        """Queries the /v1/user/list endpoint and yields the users from the response one page at a time."""
+        return self.client.list_users()
+
+    def list_recordings(self, userid):
+        """Fetches a host's recordings from /v1/recording/list and yields them as Meeting records. userid is a Zoom
+        user id or user dict, as for AsyncZoomApi.list_recordings."""
+        for meeting in self.client.list_recordings(userid).get():
+            yield meeting
+
+    def aging_recordings(self, userid, older_than=None):
+        """Returns the list of a host's recordings whose start_time is more than older_than seconds ago, as Meeting
+        records. Every recording is returned when older_than is None. userid is a Zoom user id or user dict."""
+        return self.client.list_recordings(userid, older_than).get()
+
+    def collect_meetings(self, older_than=None, skip_hosts=None, host_done=None, since=None, until=None,
+                         host_filter=None):
+        """Retrieve user list from Zoom. Will iterate through all, looking for aging meeting recordings. Yields Zoom meetings
+        as Meeting records. See AsyncZoomApi.collect_meetings for the parameters."""
+        return self.client.collect_meetings(older_than=older_than, skip_hosts=skip_hosts, host_done=host_done,
+                                            since=since, until=until, host_filter=host_filter)
 
     def delete_recording(self, meeting_id, file_id):
         """Deletes a Zoom recording, leaving the meeting history in place."""
-        response = requests.post('https://api.zoom.us/v1/recording/delete',
-                                 data=dict(
-                                     api_key=self.api_key,
-                                     api_secret=self.api_secret,
-                                     meeting_id=meeting_id,
-                                     file_id=file_id
-                                 ))
-        sleep(0.1)
-        return response
\ No newline at end of file
+        return self.client.delete_recording(meeting_id, file_id).get()
@@ -1,6 +1,7 @@
 import unittest
 import json
 from zoomout import ZoomOut
+from records import Host
 
 class ZoomOutTest(unittest.TestCase):
 
@@ -14,26 +15,31 @@ class ZoomOutTest(unittest.TestCase):
         pass
 
     def test_collect_zoom_meetings(self):
-        meetings = self.zoomout.zoom.collect_meetings()
+        meetings = list(self.zoomout.zoom.collect_meetings())
         self.assertTrue(len(meetings) > 0)
-        self.assertTrue('recording' in meetings[0])
-        self.assertTrue('meeting_number' in meetings[0]['recording'])
+        self.assertTrue(meetings[0].meeting_number)
         # for meeting in meetings:
-        self.assertTrue('host' in meetings[0])
-        self.assertTrue('email' in meetings[0]['host'])
+        self.assertTrue(meetings[0].host)
+        self.assertTrue(meetings[0].host.email)
 
         print("There are {} recorded zoom meetings.".format(str(len(meetings))))
 
+    def test_collect_zoom_meetings_older_than(self):
+        meetings = list(self.zoomout.zoom.collect_meetings(older_than=0))
+        older = list(self.zoomout.zoom.collect_meetings(older_than=60*60*24*365*100))
+        self.assertTrue(len(meetings) > 0)
+        self.assertEqual(len(older), 0)
+
     def test_add_folders_with_meta_and_file_and_share(self):
         host_email = raw_input('Input an email address for a mockup meeting host: ')
         host_id = raw_input('Input an id for the mockup meeting host: ')
-        host = dict(email=host_email, id=host_id)
-        host_username = host_email.split('@')[0]
+        host = Host(host_id, host_email)
+        host_username = host.username
 
         # Test that top folder creation won't make duplicates
         top_folder = self.zoomout.find_or_create_top_folder(host, host_username)
         self.ids.append(top_folder['id'])
-        q_top_folder = self.zoomout.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomUserId' and value='" + host['id'] + "'} ").execute()['files']
+        q_top_folder = self.zoomout.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomUserId' and value='" + host.id + "'} ").execute()['files']
         self.assertTrue(q_top_folder[0]['id'] == top_folder['id'])
         top_folder_2 = self.zoomout.find_or_create_top_folder(host, host_username)
         self.assertTrue(q_top_folder[0]['id'] == top_folder_2['id'])
@@ -1,172 +1,816 @@
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-from apiclient.http import MediaFileUpload
-from apiclient import errors
-from zoom_api import ZoomApi
-from datetime import datetime
-from httplib2 import Http
+# The Google API client stack (googleapiclient, oauth2client, httplib2, and drive_upload and drive_batch, which build on
+# it) is imported by the methods that talk to Drive, so listing runs and short invocations never load it
+from zoom_api import ZoomApi, ZOOM_API_URL, ZOOM_REQUESTS_PER_SECOND
+from pipeline import Pipeline
+from state_index import StateIndex, DriveInventory
+from share_queue import ShareQueue
+from single_flight import SingleFlightCache
+from journal import Journal
+from sharding import Shard, wait_for_shards
+from scheduler import Scheduler, POLICIES
+from metrics import Metrics, log
+from records import ZOOM_TIME_FORMAT, seconds_since
+from drive_discovery import load_discovery_document
+from datetime import datetime, timedelta
 import urllib2
+import httplib
+import socket
+import argparse
+import hashlib
 import json
 import os
 import time
 import sys
 import traceback
+import threading
 
 
-def log(string):
-    """
-    Prints a string to stdout, prepended with a date in the format %Y-%m-%d %H:%M:%S
-    """
-    print("{0} - {1}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), string))
+# Message sent to a host when their top level folder is first shared with them
+TOP_FOLDER_MESSAGE = "This folder containing your recorded Zoom meetings should show in your \"Shared with Me\" view in Google Drive."
 
 
-class ZoomOut:
-    def __init__(self, limit):
+class MeetingProgress(object):
+    def __init__(self, meeting, meeting_folder, folder_name, total):
+        """Tracks the recording files of one meeting as they leave the transfer pipeline, so the meeting folder is
+        queued for sharing once, after its last file settles, and only if every file made it to Drive. In incremental
+        mode, the meeting stays pending unless every file was also deleted from Zoom.
+
+        meeting: The Meeting from collect_meetings
+
+        meeting_folder: The Drive folder the meeting's files are uploaded into
+
+        folder_name: Name of the meeting folder, used for logging
+
+        total: Number of recording files in the meeting
+        """
+        self.meeting = meeting
+        self.meeting_folder = meeting_folder
+        self.folder_name = folder_name
+        self.remaining = total
+        self.successful_uploads = 0
+        self.successful_deletes = 0
+        self.lock = threading.Lock()
+
+    def settle(self, uploaded, deleted=False):
+        """Marks one recording file as finished. uploaded says whether it reached Drive, deleted whether it is gone from
+        Zoom. Returns True for the call that settles the meeting's last file."""
+        with self.lock:
+            if uploaded:
+                self.successful_uploads += 1
+            if deleted:
+                self.successful_deletes += 1
+            self.remaining -= 1
+            return self.remaining == 0
+
+    @property
+    def complete(self):
+        """True when every recording file of the meeting was uploaded."""
+        return self.successful_uploads == len(self.meeting.recording_files)
+
+    @property
+    def archived(self):
+        """True when every recording file of the meeting was deleted from Zoom, having reached Drive in this run or an
+        earlier one."""
+        return self.successful_deletes == len(self.meeting.recording_files)
+
+
+class ZoomOut(object):
+    def __init__(self, limit, download_workers=2, upload_workers=2, delete_workers=1, queue_size=4, stream=False,
+                 stream_chunksize=16 * 1024 * 1024, reconcile=False, batch_size=50, resume=False, zoom_concurrency=8,
+                 min_chunksize=1024 * 1024, max_chunksize=64 * 1024 * 1024, upload_retries=10, prometheus_path=None,
+                 incremental=False, shard=None, priority='listing', bandwidth_limit=None, time_budget=None,
+                 dry_run=False):
         """
         Initializer for the ZoomOut class, takes an integer parameter 'limit' that sets the maximum age for Zoom
         recordings before they are downloaded, archived in Google, and deleted.
+
+        download_workers, upload_workers, delete_workers: Number of threads in each stage of the transfer pipeline
+
+        queue_size: Maximum number of downloaded files waiting for an upload worker, which bounds local disk use, and
+        of recording files waiting to be downloaded (or streamed), which keeps the listing of Zoom from running ahead
+        of the transfers
+
+        stream: When True, recording files are piped from Zoom straight into Drive without being written to disk
+
+        stream_chunksize: Bytes in the first Drive upload request in streaming mode. Each upload worker holds one chunk
+        in memory.
+
+        reconcile: When True, the local state index is rebuilt from a full Drive listing before any work starts
+
+        batch_size: Number of meetings whose missing folders are created together in batched Drive requests
+
+        resume: When True, picks up where an unfinished previous run left off, using its journal
+
+        zoom_concurrency: Number of Zoom API calls in flight at once, over as many pooled connections
+
+        min_chunksize, max_chunksize: Bounds in bytes on the Drive upload chunk size, which adapts to the measured
+        throughput of each upload
+
+        upload_retries: Number of times in a row a failed upload chunk is retried before the upload is abandoned
+
+        prometheus_path: File the run's metrics are written to in the Prometheus text format when the run ends, or None
+
+        incremental: When True, each host's recordings are only listed from where the last incremental run left off,
+        plus the dates of meetings it left pending because they weren't old enough yet or didn't make it to Drive
+
+        shard: The Shard of the account's hosts this process archives, or None to archive every host. Each shard has its
+        own done file, state index, journal and metrics, named after the shard.
+
+        priority: Order meetings are archived in, one of scheduler.POLICIES: 'listing', 'oldest' or 'largest'
+
+        bandwidth_limit: Bytes per second allowed for downloads and for uploads, across all workers, or None
+
+        time_budget: Seconds after the start of main() when no new recording file is started, or None. What is left is
+        recorded for the next run.
+
+        dry_run: When True, the ZoomOut is only used to list what a run would archive, with list_eligible(). The journal
+        of the last run is left alone.
         """
+        self.shard = shard
+
         # Set the path for the done file
         try:
-            self.done_file_path = os.environ['ZOOMOUT_DONEFILE_PATH']
+            self.done_file_path = self.shard_path(os.environ['ZOOMOUT_DONEFILE_PATH'])
         except KeyError:
             log("Aborting: You need to set the ZOOMOUT_DONEFILE_PATH variable so the script knows what file to write to signal it has finished.")
             exit()
 
-        # Establish Google Drive API
-        self.drive = self.authorize_with_drive()
+        # Time every Zoom and Drive call by phase. The summary is written next to the done file at the end of the run.
+        self.metrics = Metrics()
+        self.metrics_path = self.shard_path(os.environ.get('ZOOMOUT_METRICS_PATH',
+                                                           self.default_metrics_path(self.done_file_path)))
+        self.prometheus_path = self.shard_path(prometheus_path) if prometheus_path else None
+
+        # Google Drive API, authorized on first use. Each pipeline thread authorizes its own Drive service, because the
+        # underlying Http object can't be shared between threads.
+        self.local = threading.local()
 
-        # Establish Zoom API
+        # Establish Zoom API. The shards of a sharded run share the account's request rate evenly.
         try:
             self.zoom = ZoomApi(
                     os.environ['ZOOM_API_KEY'],
-                    os.environ['ZOOM_API_SECRET']
+                    os.environ['ZOOM_API_SECRET'],
+                    workers=zoom_concurrency,
+                    requests_per_second=ZOOM_REQUESTS_PER_SECOND / float(shard.count if shard else 1),
+                    base_url=os.environ.get('ZOOM_API_URL', ZOOM_API_URL),
+                    metrics=self.metrics
             )
         except KeyError:
             log("Aborting: You need to set the ZOOM_API_KEY and ZOOM_API_SECRET environment variables first.")
             exit()
 
+        # Open the local index of what ZoomOut has already put in Drive. A dry run without one keeps it in memory rather
+        # than creating the file.
+        index_path = self.shard_path(os.environ.get('ZOOMOUT_INDEX_PATH', 'zoomout_index.db'))
+        self.index = StateIndex(':memory:' if dry_run and not os.path.exists(index_path) else index_path)
+        self.reconcile = reconcile
+        self.inventory = None
+        self.top_folders = SingleFlightCache()  # Top level folders by Zoom user id, for this run
+
+        # Open the journal of per-file progress, replaying the last run's if we're resuming it
+        if dry_run:
+            self.journal = Journal(os.devnull)
+        else:
+            self.journal = Journal(self.shard_path(os.environ.get('ZOOMOUT_JOURNAL_PATH', 'zoomout_journal.jsonl')),
+                                   resume=resume)
+        self.batch_size = batch_size
+
         # Translate the limit given in hours to a limit in seconds
         self.limit = limit*60*60 if isinstance(limit, (int, long)) else 1*60*60
 
+        # Incremental listing: the first date asked of Zoom and the meetings it returned, by host, for this run
+        self.incremental = incremental
+        self.listing_date = datetime.utcnow().strftime('%Y-%m-%d')
+        self.listing_starts = {}
+        self.listed = {}
+
+        # Order, speed and time limit of the transfers
+        self.scheduler = Scheduler(priority, bandwidth=bandwidth_limit, time_budget=time_budget)
+
+        # Concurrency of the download -> upload -> delete pipeline
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.delete_workers = delete_workers
+        self.queue_size = queue_size
+        self.stream = stream
+        self.stream_chunksize = stream_chunksize
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.upload_retries = upload_retries
+
         # Try to load messaging from messaging.json. Goes with defaults if none present.
         self.load_messaging()  # Assigns self.messaging based on the messaging.json file or fails and keeps the default.
 
+        # Folders are shared with their hosts at the end of the run, with one notification per host
+        self.shares = ShareQueue(self.messaging['share'], TOP_FOLDER_MESSAGE)
+
+    def shard_path(self, path):
+        """Returns this process's version of a file path: the path itself, or the shard's version of it when sharded"""
+        return self.shard.path(path) if self.shard else path
+
+    @staticmethod
+    def default_metrics_path(done_file_path):
+        """Returns where the metrics summary goes when ZOOMOUT_METRICS_PATH isn't set: zoomout_metrics.json next to the
+        done file, or in the working directory when the done file is os.devnull"""
+        directory = os.getcwd() if done_file_path == os.devnull else os.path.dirname(os.path.abspath(done_file_path))
+        return os.path.join(directory, 'zoomout_metrics.json')
+
+    @property
+    def drive(self):
+        """Resource object for the Drive API v3, authorized on first use in each thread."""
+        if not hasattr(self.local, 'drive'):
+            self.local.drive = self.authorize_with_drive()
+        return self.local.drive
+
     def main(self):
         """
         The main method. Executes if you execute 'python zoomout.py 48'. Numeric argument is optional.
+
+        Folders are found or created here as meetings stream in from Zoom. Each recording file is then handed to a
+        pipeline of download workers, upload workers and Zoom deletion workers. The recording files waiting for a
+        download worker, and the downloaded files waiting for an upload worker, are each capped at queue_size, so
+        meetings are only listed from Zoom as fast as they are archived. In streaming mode the download and upload stages are replaced by a
+        single stage that pipes each file from Zoom into Drive.
+
+        The hosts are granted their folders once the pipeline is done, in batched requests with one notification each.
+
+        Every step is written to the journal. When resuming, the meetings the last run discovered but didn't finish are
+        handled first, and hosts it finished enumerating aren't asked for their recordings again.
+
+        With the 'oldest' or 'largest' priority, every eligible meeting is listed before the first one is archived, in
+        priority order. Once the time budget runs out no new recording file is started: the files already on their way
+        finish, and the rest is left in the journal (and as pending in incremental mode) for the next run.
         """
-        log("Starting...")
+        log("Starting shard {0}...".format(self.shard) if self.shard else "Starting...")
+        self.scheduler.start()
+        self.drive  # Authorizes with Drive here rather than in a pipeline worker, so bad credentials stop the run early
         try:
-            # Collect meetings from Zoom and iterate through them...
-            meetings = self.zoom.collect_meetings()
-            for meeting in meetings:
-                start_time = datetime.strptime(meeting['recording']['start_time'], '%Y-%m-%dT%H:%M:%SZ')
-                host = meeting['host']['email']
-                host_username = host.split('@')[0]
-                now = datetime.now()
-                topic = meeting['recording']['topic'] if 'topic' in meeting['recording'] else '[no topic]'
-
-                # If the recording is more than x hours old, save it and upload it to Google.
-                if (now - start_time).total_seconds() > self.limit:
-                    log("Handling Meeting {0}: {1} - {2} hosted by {3}".
-                        format(meeting['recording']['meeting_number'],
-                               topic,
-                               start_time,
-                               host))
-                    # Find or create user's top level folder
-                    top_folder = self.find_or_create_top_folder(
-                            host=meeting['host'],
-                            host_username=host_username)
-
-                    # Find or create meeting's folder
-                    meeting_folder_name = "{0} - {1}".format(topic, start_time)
-                    meeting_folder = self.find_or_create_meeting_folder(
-                            folder_name=meeting_folder_name,
-                            zoom_meeting_id=meeting['recording']['meeting_number'],
-                            top_folder=top_folder,
-                            host=meeting['host'])
-
-                    # Iterate through recording files and save them
-                    successful_uploads = 0
-                    for recording_file in meeting['recording']['recording_files']:
-                        recording_file_id = recording_file['id']
-                        filename = "{0}.{1}".format(recording_file_id, recording_file['file_type'])
-                        if self.drive_file_exists(recording_file_id):
-                            log("Skipping {0} recorded by {1}. Zoom file with this zoomFileId ({2}) in the appProperties already exists in Drive.".
-                                format(filename, host, recording_file_id))
-                            delete_response = self.zoom.delete_recording(
-                                    meeting_id=recording_file['meeting_id'],
-                                    file_id=recording_file_id)
-                            if delete_response.status_code != 200:
-                                log("Delete of Zoom Recording Failed: {0}".format(delete_response.content))
-                            if os.path.isfile(filename):
-                                os.remove(filename)
-                            continue  # Causes the loop to skip downloading this file (and all subsequent steps)
-
-                        try:
-                            # Downloads the recording file to disk
-                            remote_file = urllib2.urlopen(recording_file['download_url'])
-                            with open(filename, 'wb') as f:
-                                while True:
-                                    tmp = remote_file.read(1024)
-                                    if not tmp:
-                                        break
-                                    f.write(tmp)
-                        except Exception as exc:
-                            log("Could not download the file {0} from Zoom Meeting {1} (URL {2}): {3}".
-                                format(filename,
-                                       meeting['id'],
-                                       recording_file['download_url'],
-                                       exc.message))
-                            if os.path.isfile(filename):
-                                os.remove(filename)
-                            continue  # Causes the loop to skip uploading to Drive, sharing, and deleting from Zoom
-
-                        try:
-                            # Upload it to Drive
-                            upload_success = self.upload_to_drive(meeting_folder['id'], filename)
-                            if upload_success:
-                                successful_uploads += 1
-                            else:
-                                log("Failed to upload {0}, skipping deletion from Zoom. Will try again next time".format(filename))
-                                # Delete local file
-                                if os.path.isfile(filename):
-                                    os.remove(filename)
-                                continue  # Causes the loop to skip deleting from Zoom
-                        except Exception as e:
-                            log("Couldn't Upload {0} to Drive: {1}".format(filename, e.message))
-                            # Delete local file
-                            if os.path.isfile(filename):
-                                os.remove(filename)
-                            continue  # Causes the loop to skip deleting from Zoom
-
-                        try:
-                            # Delete Zoom recording
-                            self.zoom.delete_recording(
-                                    meeting_id=recording_file['meeting_id'],
-                                    file_id=recording_file_id)
-                        except Exception as e:
-                            log("Couldn't Delete Meeting {0} from Zoom: {1}".format(meeting['id'], e.message))
-
-                        # Delete local file
-                        if os.path.isfile(filename):
-                            os.remove(filename)
-
-                    # Now share the folder containing the files we just uploaded
-                    if successful_uploads == len(meeting['recording']['recording_files']):
-                        message = self.messaging['share']
-                        self.share_document(meeting_folder['id'], host, message)
-                    else:
-                        log("Could not upload every recording file for meeting {0}".format(meeting_folder_name))
+            self.journal.record('started')
+            self.prepare_index()
+
+            pipeline = Pipeline(error_handler=self.abandon_recording)
+            # The first stage's queue is bounded too, so listing Zoom and creating folders wait for the transfers
+            if self.stream:
+                pipeline.add_stage('stream', self.stream_recording, workers=self.upload_workers,
+                                   queue_size=self.queue_size)
+            else:
+                pipeline.add_stage('download', self.download_recording, workers=self.download_workers,
+                                   queue_size=self.queue_size)
+                pipeline.add_stage('upload', self.upload_recording, workers=self.upload_workers, queue_size=self.queue_size)
+            pipeline.add_stage('delete', self.delete_recording, workers=self.delete_workers)
+            pipeline.start()
+
+            meetings = self.eligible_meetings()
+            if self.scheduler.buffers:
+                meetings = self.scheduler.order(meetings)
+                log("Archiving {0} meetings ({1} bytes), {2} first".format(
+                    len(meetings), sum(self.scheduler.meeting_size(meeting) for meeting in meetings), self.scheduler.policy),
+                    meetings=len(meetings), priority=self.scheduler.policy)
 
+            # Handle the meetings a window at a time, as they arrive from Zoom or in priority order...
+            window = []
+            remaining = []
+            for position, meeting in enumerate(meetings):
+                if self.scheduler.expired:
+                    # In listing order, the meetings after this one are still in Zoom for the next run to list
+                    remaining = window + (meetings[position:] if self.scheduler.buffers else [meeting])
+                    break
+                window.append(meeting)
+                if len(window) >= self.batch_size:
+                    self.archive_meetings(window, pipeline)
+                    window = []
+            else:
+                self.archive_meetings(window, pipeline)
+
+            pipeline.join()
+            self.flush_shares()
+            if self.scheduler.expired:
+                self.record_remaining(remaining)
+                self.write_metrics(finished=False, out_of_time=True)
+            else:
+                self.journal.record('finished')
+                self.write_metrics(finished=True)
             self.write_done_file()
         except Exception as e:
             ex_type, ex, tb = sys.exc_info()
             trace = traceback.format_tb(tb)
-            log("Something terrible has happened. Stopping here. {0} | {1}".format(e.message, trace))
+            log("Something terrible has happened. Stopping here. {0}".format(e.message), trace=trace)
+            try:
+                self.flush_shares()  # Hosts still get the folders that were finished
+            except Exception as exc:
+                log("Couldn't share the queued folders: {0}".format(exc))
+            self.write_metrics(finished=False)
             exit()
 
+    def list_eligible(self):
+        """Dry run. Logs every meeting a run would archive now, in the order the priority would archive it, with the
+        bytes Zoom reports for its recording files, then the totals. Nothing is downloaded, Drive is never contacted
+        and no state is written, so it needs neither Google credentials nor the Google API client to be loaded. In
+        incremental mode, hosts are listed from their high-water marks, like a run would.
+
+        Returns the number of meetings
+        """
+        log("Listing the meetings {0} would archive...".format("shard {0}".format(self.shard) if self.shard else "a run"))
+        meetings = []
+        for meeting in self.zoom.collect_meetings(older_than=None if self.incremental else self.limit,
+                                                  since=self.listing_start if self.incremental else None,
+                                                  until=self.listing_until() if self.incremental else None,
+                                                  host_filter=(lambda user: self.shard.owns(user.id)) if self.shard else None):
+            if self.incremental and not self.old_enough(meeting.start_time):
+                continue
+            meetings.append(meeting)
+
+        hosts = set()
+        files = 0
+        total = 0
+        for meeting in self.scheduler.order(meetings):
+            size = self.scheduler.meeting_size(meeting)
+            recording_files = meeting.recording_files
+            hosts.add(meeting.host.email)
+            files += len(recording_files)
+            total += size
+            log("Would archive {0} hosted by {1}: {2} recording files, {3} bytes".
+                format(self.meeting_folder_name(meeting), meeting.host.email, len(recording_files), size),
+                meeting=meeting.meeting_number, host=meeting.host.email,
+                files=len(recording_files), bytes=size)
+        log("Would archive {0} meetings from {1} hosts: {2} recording files, {3} bytes ({4:.2f} GB)".
+            format(len(meetings), len(hosts), files, total, total / float(1024 ** 3)),
+            meetings=len(meetings), hosts=len(hosts), files=files, bytes=total)
+        return len(meetings)
+
+    def eligible_meetings(self):
+        """Yields the meetings to archive: when resuming, the meetings the last run left unfinished, then the meetings
+        old enough to archive as they stream in from Zoom, each recorded in the journal as discovered."""
+        if self.journal.resuming:
+            unfinished = self.journal.unfinished_meetings()
+            log("Resuming the last run: {0} meetings left unfinished, {1} hosts already enumerated".
+                format(len(unfinished), len(self.journal.hosts)),
+                unfinished_meetings=len(unfinished), enumerated_hosts=len(self.journal.hosts))
+            for meeting in unfinished:
+                yield meeting
+
+        for meeting in self.zoom.collect_meetings(older_than=None if self.incremental else self.limit,
+                                                  skip_hosts=self.journal.hosts,
+                                                  host_done=self.host_listed,
+                                                  since=self.listing_start if self.incremental else None,
+                                                  until=self.listing_until() if self.incremental else None,
+                                                  host_filter=(lambda user: self.shard.owns(user.id)) if self.shard else None):
+            if self.incremental and not self.due_for_archiving(meeting):
+                continue  # Left pending until it is old enough
+            if not self.journal.discover(meeting):
+                continue  # Already handed to the pipeline from the resumed journal
+            yield meeting
+
+    def record_remaining(self, meetings):
+        """Called when the time budget ran out. Leaves the meetings that were never handed to the pipeline for the next
+        run: they stay unfinished in the journal, which is marked as stopped rather than finished so --resume picks them
+        up, and in incremental mode they are recorded as pending. Returns nothing."""
+        size = sum(self.scheduler.meeting_size(meeting) for meeting in meetings)
+        if self.incremental:
+            for meeting in meetings:
+                self.index.record_pending(meeting.uuid, meeting.host.id, meeting.start_time_text)
+        deferred = self.metrics.count('files', 'deferred')
+        self.journal.record('stopped', remaining_meetings=len(meetings), remaining_bytes=size, deferred_files=deferred)
+        log("Out of time. Left {0} meetings ({1} bytes) that were never started and {2} deferred recording files for the "
+            "next run".format(len(meetings), size, deferred),
+            remaining_meetings=len(meetings), remaining_bytes=size, deferred_files=deferred)
+
+    def host_listed(self, host):
+        """Called once all of a host's recordings have been listed and handed out. Journals the host as enumerated and,
+        in incremental mode, moves its high-water mark up to today and forgets the pending meetings that are gone from
+        Zoom."""
+        self.journal.record('enumerated', host=host.id)
+        if not self.incremental:
+            return
+        listed = self.listed.pop(host.id, set())
+        since = self.listing_starts.pop(host.id, None)
+        for meeting_uuid, start_time in self.index.pending_meetings(host.id):
+            if meeting_uuid not in listed and self.old_enough(datetime.strptime(start_time, ZOOM_TIME_FORMAT)) \
+                    and (since is None or start_time[:10] >= since):
+                self.index.clear_pending(meeting_uuid)
+        self.index.record_high_water(host.id, self.listing_date)
+
+    def listing_start(self, zoom_user_id):
+        """Returns the first date, like '2017-03-01', of the recordings to ask Zoom for in incremental mode: a day before
+        the host's high-water mark, or earlier if one of its pending meetings has become old enough since. Returns None,
+        for a full listing, when the host was never listed incrementally."""
+        high_water = self.index.high_water(zoom_user_id)
+        if high_water is None:
+            since = None
+        else:
+            # A day of overlap covers time zones and recordings that finished processing after the last listing
+            since = (datetime.strptime(high_water, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+            for meeting_uuid, start_time in self.index.pending_meetings(zoom_user_id):
+                if self.old_enough(datetime.strptime(start_time, ZOOM_TIME_FORMAT)):
+                    since = min(since, start_time[:10])
+        self.listing_starts[zoom_user_id] = since
+        return since
+
+    def listing_until(self):
+        """Returns the last date of the recordings to ask Zoom for in incremental mode, tomorrow's in UTC so the
+        listing reaches the present in any time zone"""
+        return (datetime.strptime(self.listing_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def old_enough(self, start_time):
+        """True when a recording that started at start_time, a datetime in UTC, is past the age limit"""
+        return seconds_since(start_time) > self.limit
+
+    def due_for_archiving(self, meeting):
+        """In incremental mode, notes a listed meeting and returns True if it is old enough to archive. Either way it is
+        recorded in the index as pending: the host's high-water mark moves past it as soon as its listing ends, so a
+        meeting handed out is only cleared by finish_meeting once all of its files are in Drive. If the run dies before
+        then, the next listing still reaches back to it."""
+        self.listed.setdefault(meeting.host.id, set()).add(meeting.uuid)
+        self.index.record_pending(meeting.uuid, meeting.host.id, meeting.start_time_text)
+        return self.old_enough(meeting.start_time)
+
+    def archive_meetings(self, meetings, pipeline):
+        """Prepares the Drive folders for a window of meetings and hands their recording files to the pipeline.
+
+        meetings: List of Meetings from collect_meetings
+
+        pipeline: The started transfer Pipeline
+
+        Returns nothing
+        """
+        self.prepare_folders(meetings)
+        for meeting in meetings:
+            host = meeting.host.email
+            topic = meeting.topic if meeting.topic is not None else '[no topic]'
+
+            # collect_meetings only yields recordings more than x hours old, so save it and upload it to Google.
+            log("Handling Meeting {0}: {1} - {2} hosted by {3}".
+                format(meeting.meeting_number,
+                       topic,
+                       meeting.start_time,
+                       host),
+                meeting=meeting.meeting_number, host=host)
+
+            # Find or create user's top level folder
+            top_folder = self.find_or_create_top_folder(
+                    host=meeting.host,
+                    host_username=meeting.host.username)
+
+            # Find or create meeting's folder
+            meeting_folder_name = self.meeting_folder_name(meeting)
+            meeting_folder = self.find_or_create_meeting_folder(
+                    folder_name=meeting_folder_name,
+                    zoom_meeting_id=meeting.meeting_number,
+                    top_folder=top_folder,
+                    host=meeting.host)
+
+            # Hand the recording files to the pipeline. The folder gets shared once the last one settles.
+            recording_files = meeting.recording_files
+            progress = MeetingProgress(meeting, meeting_folder, meeting_folder_name, len(recording_files))
+            if not recording_files:
+                self.finish_meeting(progress)
+            for recording_file in self.scheduler.order_files(recording_files):
+                pipeline.put(dict(progress=progress,
+                                  recording_file=recording_file,
+                                  filename=recording_file.filename))
+
+    def prepare_folders(self, meetings):
+        """Creates the top level folders and meeting folders missing for a window of meetings, using batched Drive
+        requests. New top level folders are granted to their hosts right away, without a notification, and queued for
+        the digest at the end of the run. Everything created is recorded in the state
+        index, so find_or_create_top_folder and find_or_create_meeting_folder answer without a round trip. Calls that
+        fail are left for those methods to retry one at a time.
+
+        meetings: List of Meetings from collect_meetings
+
+        Returns nothing
+        """
+        if not self.index.bootstrapped:
+            return  # Without an index a miss doesn't mean the folder is missing
+        from drive_batch import DriveBatch
+
+        created = []
+
+        def record_top_folder(host):
+            def callback(response, exception):
+                if exception:
+                    log("Batched creation of the top level folder for {0} failed: {1}".format(host.email, exception))
+                    return
+                self.index.record_top_folder(host.id, response['id'])
+                self.top_folders.set(str(host.id), dict(id=response['id']))
+                self.shares.add_top_folder(host, response['id'])
+                created.append((host, response['id']))
+            return callback
+
+        def record_meeting_folder(zoom_meeting_id):
+            def callback(response, exception):
+                if exception:
+                    log("Batched creation of the folder for meeting {0} failed: {1}".format(zoom_meeting_id, exception))
+                    return
+                self.index.record_meeting_folder(zoom_meeting_id, response['id'])
+            return callback
+
+        # First round trip: top level folders for hosts we haven't seen
+        creates = DriveBatch(self.drive, metrics=self.metrics)
+        hosts = {}
+        for meeting in meetings:
+            host = meeting.host
+            if host.id in hosts or str(host.id) in self.top_folders or self.index.top_folder(host.id):
+                continue
+            hosts[host.id] = host
+            creates.add(self.drive.files().create(body=self.top_folder_body(host, host.username),
+                                                  fields='id'),
+                        callback=record_top_folder(host))
+        creates.execute()
+
+        # Grant the new top level folders now, so a run that dies before flush_shares doesn't leave their hosts without
+        # access to recordings already gone from Zoom. The notification waits for the digest.
+        grants = DriveBatch(self.drive, metrics=self.metrics)
+        for host, folder_id in created:
+            grants.add(self.share_request(folder_id, host.email, None), callback=self.record_share(host, folder_id))
+        grants.execute()
+
+        # Second round trip: meeting folders
+        folders = DriveBatch(self.drive, metrics=self.metrics)
+        seen = set()
+        for meeting in meetings:
+            zoom_meeting_id = meeting.meeting_number
+            top_folder_id = self.index.top_folder(meeting.host.id)
+            if zoom_meeting_id in seen or not top_folder_id or self.index.meeting_folder(zoom_meeting_id):
+                continue
+            seen.add(zoom_meeting_id)
+            folders.add(self.drive.files().create(body=self.meeting_folder_body(self.meeting_folder_name(meeting),
+                                                                                zoom_meeting_id,
+                                                                                dict(id=top_folder_id)),
+                                                  fields='id'),
+                        callback=record_meeting_folder(zoom_meeting_id))
+        folders.execute()
+
+    @staticmethod
+    def meeting_folder_name(meeting):
+        """Returns the name of a meeting's folder in Drive: its topic and start time"""
+        topic = meeting.topic if meeting.topic is not None else '[no topic]'
+        return "{0} - {1}".format(topic, meeting.start_time)
+
+    def skip_archived_recording(self, job):
+        """If Drive already has a recording file, deletes the Zoom copy and settles the file as not uploaded.
+
+        job: Dict holding the meeting's progress, the RecordingFile from Zoom and the local filename
+
+        Returns True when the file was skipped
+        """
+        recording_file = job['recording_file']
+        recording_file_id = recording_file.id
+        if not self.drive_file_exists(recording_file_id):
+            return False
+        log("Skipping {0} recorded by {1}. Zoom file with this zoomFileId ({2}) in the appProperties already exists in Drive.".
+            format(job['filename'], job['progress'].meeting.host.email, recording_file_id),
+            file=recording_file_id)
+        self.metrics.add('files', 'skipped')
+        delete_response = self.zoom.delete_recording(
+                meeting_id=recording_file.meeting_id,
+                file_id=recording_file_id)
+        if delete_response.status_code != 200:
+            log("Delete of Zoom Recording Failed: {0}".format(delete_response.content))
+        else:
+            self.index.record_file(recording_file_id, 'deleted')
+            self.journal.record('deleted', file=recording_file_id)
+            job['deleted'] = True
+        self.settle_recording(job, uploaded=False)
+        return True
+
+    def download_recording(self, job):
+        """First pipeline stage. Downloads a recording file to disk, unless Drive already has it, in which case the Zoom
+        copy is deleted and the file leaves the pipeline.
+
+        job: Dict holding the meeting's progress, the RecordingFile from Zoom and the local filename
+
+        Returns the job when the file was downloaded, otherwise None
+        """
+        if self.scheduler.expired:
+            self.settle_recording(job, uploaded=False, deferred=True)
+            return None  # Out of time: leaves the file for the next run
+        if self.skip_archived_recording(job):
+            return None  # Skips downloading this file (and all subsequent steps)
+
+        recording_file = job['recording_file']
+        filename = job['filename']
+        checkpoint = self.journal.file_state(recording_file.id)
+        if checkpoint.get('state') in ('downloaded', 'uploading') and os.path.isfile(filename) \
+                and os.path.getsize(filename) == checkpoint.get('size'):
+            log("Reusing {0}, downloaded by the last run".format(filename))
+            job.update(md5=checkpoint.get('md5') or self.file_md5(filename), size=checkpoint['size'])
+            return job
+
+        try:
+            # Downloads the recording file to disk, hashing it on the way so it never has to be read again
+            md5 = hashlib.md5()
+            with self.metrics.timer('download'):
+                remote_file = urllib2.urlopen(recording_file.download_url)
+                with open(filename, 'wb') as f:
+                    while True:
+                        tmp = remote_file.read(1024 * 1024)
+                        if not tmp:
+                            break
+                        f.write(tmp)
+                        md5.update(tmp)
+                        self.metrics.add('bytes', 'download', len(tmp))
+                        self.scheduler.throttle_download(len(tmp))
+        except Exception as exc:
+            log("Could not download the file {0} from Zoom Meeting {1} (URL {2}): {3}".
+                format(filename,
+                       job['progress'].meeting.uuid,
+                       recording_file.download_url,
+                       exc.message),
+                file=recording_file.id)
+            self.settle_recording(job, uploaded=False)
+            return None  # Skips uploading to Drive, sharing, and deleting from Zoom
+        job.update(md5=md5.hexdigest(), size=os.path.getsize(filename))
+        self.journal.record('downloaded', file=recording_file.id, filename=filename, size=job['size'], md5=job['md5'])
+        return job
+
+    @staticmethod
+    def file_md5(filename):
+        """Returns the MD5 hash, in hex, of a local file. Only needed for files downloaded by a run whose journal didn't
+        record their hash."""
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def upload_recording(self, job, media_body=None):
+        """Second pipeline stage. Uploads a downloaded recording file into its meeting folder, then checks the copy in
+        Drive against the bytes downloaded from Zoom.
+
+        media_body: Media to upload instead of the local file, used in streaming mode
+
+        Returns the job when the upload succeeded and checked out, otherwise None
+        """
+        filename = job['filename']
+        recording_file_id = job['recording_file'].id
+        checkpoint = self.journal.file_state(recording_file_id)
+        started = time.time()
+        try:
+            # Upload it to Drive, picking up the last run's upload session if it had one going
+            upload_success = self.upload_to_drive(job['progress'].meeting_folder['id'], filename, media_body=media_body,
+                                                  app_properties={'zoomFileId': recording_file_id,
+                                                                  'zoomMeetingId': job['progress'].meeting.meeting_number},
+                                                  resume_uri=checkpoint.get('session_uri') if checkpoint.get('state') == 'uploading' else None,
+                                                  session_callback=lambda uri: self.journal.record('uploading', file=recording_file_id, session_uri=uri))
+            self.metrics.observe('upload', time.time() - started, error=not upload_success)
+            if upload_success and media_body is not None:
+                if media_body.bytes_read:
+                    job.update(md5=media_body.hexdigest(), size=media_body.bytes_read)
+                else:
+                    # The last run's session already held the whole file, so nothing went by to hash
+                    log("Nothing was streamed for {0}: only checking its size in Drive against Zoom's".format(filename),
+                        file=recording_file_id)
+            if upload_success and not self.verify_upload(job, upload_success):
+                upload_success = False
+            if upload_success:
+                self.index.record_file(recording_file_id, 'uploaded', drive_id=upload_success['id'])
+                self.journal.record('uploaded', file=recording_file_id, drive_id=upload_success['id'])
+            else:
+                log("Failed to upload {0}, skipping deletion from Zoom. Will try again next time".format(filename),
+                    file=recording_file_id)
+                self.settle_recording(job, uploaded=False)
+                return None  # Skips deleting from Zoom
+        except Exception as e:
+            self.metrics.observe('upload', time.time() - started, error=True)
+            log("Couldn't Upload {0} to Drive: {1}".format(filename, e.message), file=recording_file_id)
+            self.settle_recording(job, uploaded=False)
+            return None  # Skips deleting from Zoom
+        return job
+
+    def verify_upload(self, job, response):
+        """Checks an uploaded recording file before its Zoom copy is deleted: Drive's md5Checksum must match the MD5
+        hash computed while the bytes went by, and Drive's size must match the bytes downloaded, which must match the
+        file_size Zoom reported (when it reported one). A copy that doesn't check out is removed from Drive, so the next
+        run uploads the file again instead of taking the copy for an archived one.
+
+        job: Dict holding the RecordingFile from Zoom, and the md5 and size of the bytes downloaded. Without them (a
+        streamed file whose earlier upload session turned out complete, so no byte went by) only Drive's size is
+        checked against Zoom's.
+
+        response: Drive API's response for the new file, with its id, md5Checksum and size
+
+        Returns True when the copy in Drive checks out
+        """
+        from apiclient import errors
+        recording_file = job['recording_file']
+        expected_size = recording_file.file_size
+        drive_size = int(response['size']) if response.get('size') is not None else None
+        problems = []
+        if 'md5' in job and response.get('md5Checksum') != job['md5']:
+            problems.append("MD5 {0} in Drive, {1} downloaded".format(response.get('md5Checksum'), job['md5']))
+        if 'size' in job and drive_size != job['size']:
+            problems.append("{0} bytes in Drive, {1} downloaded".format(drive_size, job['size']))
+        size = job.get('size', drive_size)
+        if expected_size is not None and size is not None and int(expected_size) != size:
+            problems.append("{0} bytes reported by Zoom, {1} {2}".format(expected_size, size,
+                                                                        'downloaded' if 'size' in job else 'in Drive'))
+        if not problems:
+            return True
+
+        log("Uploaded copy of {0} doesn't match the download: {1}. Removing it from Drive".
+            format(job['filename'], '; '.join(problems)), file=recording_file.id)
+        self.metrics.add('files', 'mismatched')
+        try:
+            self.remove_from_drive(response['id'])
+        except errors.HttpError as e:
+            log("Couldn't remove the mismatched copy of {0} from Drive: {1}".format(job['filename'], e),
+                file=recording_file.id)
+        return False
+
+    def stream_recording(self, job):
+        """Pipeline stage used in streaming mode in place of download_recording and upload_recording. Pipes a recording
+        file from its Zoom download_url straight into a Drive resumable upload, holding one chunk in memory and nothing
+        on disk.
+
+        Returns the job when the upload succeeded, otherwise None
+        """
+        from drive_upload import StreamingMediaUpload
+        if self.scheduler.expired:
+            self.settle_recording(job, uploaded=False, deferred=True)
+            return None  # Out of time: leaves the file for the next run
+        if self.skip_archived_recording(job):
+            return None  # Skips streaming this file (and all subsequent steps)
+
+        recording_file = job['recording_file']
+        filename = job['filename']
+        try:
+            remote_file = urllib2.urlopen(recording_file.download_url)
+        except Exception as exc:
+            log("Could not download the file {0} from Zoom Meeting {1} (URL {2}): {3}".
+                format(filename,
+                       job['progress'].meeting.uuid,
+                       recording_file.download_url,
+                       exc),
+                file=recording_file.id)
+            self.settle_recording(job, uploaded=False)
+            return None  # Skips deleting from Zoom
+        try:
+            media_body = StreamingMediaUpload(remote_file,
+                                              size=recording_file.file_size,
+                                              chunksize=self.stream_chunksize)
+            return self.upload_recording(job, media_body=media_body)
+        finally:
+            remote_file.close()
+
+    def delete_recording(self, job):
+        """Last pipeline stage. Deletes an uploaded recording file from Zoom and from local disk."""
+        recording_file = job['recording_file']
+        try:
+            # Delete Zoom recording
+            delete_response = self.zoom.delete_recording(
+                    meeting_id=recording_file.meeting_id,
+                    file_id=recording_file.id)
+            if delete_response.status_code == 200:
+                self.index.record_file(recording_file.id, 'deleted')
+                self.journal.record('deleted', file=recording_file.id)
+                self.metrics.add('files', 'archived')
+                job['deleted'] = True
+            else:
+                log("Delete of Zoom Recording Failed: {0}".format(delete_response.content), file=recording_file.id)
+        except Exception as e:
+            log("Couldn't Delete Meeting {0} from Zoom: {1}".format(job['progress'].meeting.uuid, e.message))
+        self.settle_recording(job, uploaded=True)
+
+    def abandon_recording(self, stage, job, exc):
+        """Error handler for the pipeline. Settles a recording file whose stage raised unexpectedly as not uploaded."""
+        log("Unexpected error in the {0} stage for {1}: {2}".format(stage, job['filename'], exc))
+        self.settle_recording(job, uploaded=False)
+
+    def settle_recording(self, job, uploaded, deferred=False):
+        """Removes the local copy of a recording file that is leaving the pipeline and updates its meeting's progress.
+        Finishes the meeting when this was its last file. deferred says the file wasn't tried because the time budget
+        ran out."""
+        recording_file_id = job['recording_file'].id
+        # Deleted from Zoom by this run or by the run being resumed
+        deleted = job.get('deleted') or self.journal.file_state(recording_file_id).get('state') == 'deleted'
+        if os.path.isfile(job['filename']):
+            os.remove(job['filename'])
+        if deferred:
+            self.journal.record('deferred', file=recording_file_id)
+            self.metrics.add('files', 'deferred')
+        elif not uploaded and not deleted:
+            self.journal.record('failed', file=recording_file_id)
+            self.metrics.add('files', 'failed')
+        self.journal.settle(recording_file_id)
+        if job['progress'].settle(uploaded, deleted):
+            self.finish_meeting(job['progress'])
+
+    def finish_meeting(self, progress):
+        """Queues the meeting folder containing the files we just uploaded for its host's notification, if all of them
+        were uploaded. In incremental mode, the meeting stops being pending once all of them were deleted from Zoom;
+        otherwise it is left pending for the next run."""
+        if self.incremental:
+            if progress.archived:
+                self.index.clear_pending(progress.meeting.uuid)
+            else:
+                self.index.record_pending(progress.meeting.uuid, progress.meeting.host.id,
+                                          progress.meeting.start_time_text)
+        if progress.complete:
+            self.shares.add_meeting_folder(progress.meeting.host, progress.meeting_folder['id'], progress.folder_name)
+        else:
+            log("Could not upload every recording file for meeting {0}".format(progress.folder_name))
+
     def load_messaging(self):
         """
         Loads specialized messaging if you provide it in a JSON file whose location is determined by ZOOMOUT_MESSAGING_JSON.
@@ -185,83 +829,216 @@ class ZoomOut:
             log("File 'messaging.json' exists but something went wrong. Reverting to defaults.")
 
     def collect_archived_meetings(self):
-        """Retrieves file list from Google Drive. Returns a list of file names. Returns an array of meeting ids in string form"""
-        meeting_ids = []
-        for f in self.drive.files().list().execute()['files']:
-            try:
-                meeting_ids.append(self.drive.files().get(fileId=f['id']).execute()['appProperties']['zoomMeetingId'])
-            except Exception as exc:
-                pass
-        return meeting_ids
+        """Retrieves the inventory of ZoomOut's objects from Google Drive. Returns an array of meeting ids in string form"""
+        return self.collect_inventory().meeting_ids()
+
+    def collect_inventory(self):
+        """Pages through every folder and file ZoomOut has created in Drive, with their appProperties, in as few list
+        calls as possible. Returns a DriveInventory indexing them by Zoom user, meeting and file id."""
+        return DriveInventory.from_listing(self.list_drive_objects())
+
+    def prepare_index(self):
+        """Loads the state index from a Drive inventory when it has never been loaded, or when a reconcile was asked
+        for. Returns nothing."""
+        if self.reconcile or not self.index.bootstrapped:
+            log("Building the state index at {0} from Drive...".format(self.index.path))
+            self.inventory = self.collect_inventory()
+            self.index.load(self.inventory)
+            log("Indexed {0} top level folders, {1} meeting folders and {2} recording files".format(
+                len(self.inventory.top_folders), len(self.inventory.meeting_folders), len(self.inventory.files)))
 
-    def upload_to_drive(self, parent_id, filename):
+    def list_drive_objects(self):
+        """Pages through every file and folder owned by ZoomOut's service account that isn't in the trash. Yields file
+        resources holding id, mimeType, parents and appProperties."""
+        page_token = None
+        while True:
+            with self.metrics.timer('drive list'):
+                response = self.drive.files().list(q="'me' in owners and trashed = false",
+                                                   pageSize=1000,
+                                                   pageToken=page_token,
+                                                   fields='nextPageToken, files(id, mimeType, parents, appProperties)').execute()
+            for drive_object in response.get('files', []):
+                yield drive_object
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def upload_to_drive(self, parent_id, filename, media_body=None, app_properties=None, resume_uri=None,
+                        session_callback=None):
         """Uploads the file to Google Drive.
 
         filename: A filepath to a file like '123abc.MP4'.
 
         parent_id: Google Drive document id of the parent folder
 
-        Returns True or False representing successful vs unsuccessful upload
+        media_body: Media to upload in place of the file at filename, like a StreamingMediaUpload. filename is then
+        only used to name the file in Drive.
+
+        app_properties: Dict of appProperties to set on the file, like {'zoomFileId': ...}
+
+        resume_uri: URI of a resumable upload session started earlier for this file. The upload continues from the
+        bytes Drive already has.
+
+        session_callback: Called with the URI of the resumable upload session once Drive has opened it
+
+        Returns the Drive API's response for the new file on success, holding its id, md5Checksum and size, or False
+        representing an unsuccessful upload
         """
+        from apiclient.http import MediaFileUpload
+        from apiclient import errors
+        from drive_upload import StreamRewindError, AdaptiveChunkSize, is_retryable, retry_delay
         try:
-            media_body = MediaFileUpload(
-                    filename,
-                    mimetype='application/octet-stream',
-                    chunksize=1024 * 256,
-                    resumable=True)
+            if media_body is None:
+                media_body = MediaFileUpload(
+                        filename,
+                        mimetype='application/octet-stream',
+                        chunksize=self.min_chunksize,
+                        resumable=True)
             body = {
                 'name': filename,
                 'description': "Zoom Recording",
                 'parents': [parent_id],
                 'mimeType': 'application/octet-stream'
             }
+            if app_properties:
+                body['appProperties'] = app_properties
         except IOError as e:
             log("Couldn't generate upload for {0}. {1}".format(filename, e.strerror))
             return ''
 
-        retries = 0
-        request = self.drive.files().create(body=body, media_body=media_body)
+        request = self.drive.files().create(body=body, media_body=media_body, fields='id,md5Checksum,size')
         response = None
-        # Upload the file
+        if resume_uri:
+            response = self.resume_upload_session(request, resume_uri, media_body.size(), filename)
+        session_uri = request.resumable_uri
+
+        # Upload the file, sizing each chunk from the throughput of the ones before it
+        chunk_size = AdaptiveChunkSize(media_body.chunksize(), self.min_chunksize, self.max_chunksize)
+        started = time.time()
+        start_progress = request.resumable_progress
+        chunks = 0
+        retries = 0
+        total_retries = 0
         while response is None:
+            media_body._chunksize = chunk_size.size
+            chunk_started = time.time()
+            progress = request.resumable_progress
             try:
                 status, response = request.next_chunk()
-                if status:
-                    retries = 0
-            except errors.HttpError, e:
-                if e.resp.status == 404:
-                    log("Error 404 - Aborting the upload of {0}".format(filename))
+            except StreamRewindError as e:
+                log("Can't resume the upload of {0}: {1}".format(filename, e), file=filename)
+                return False
+            except errors.HttpError as e:
+                self.metrics.observe('upload chunk', time.time() - chunk_started, error=True)
+                if not is_retryable(e):
+                    log("Error {0} - Aborting the upload of {1}: {2}".format(e.resp.status, filename, e),
+                        file=filename, status=e.resp.status)
                     return False
-                else:
-                    if retries > 10:
-                        log("Retries limit exceeded! Aborting")
-                        return False
-                    else:
-                        retries += 1
-                        time.sleep(2 ** retries)
-                        print "Error ({0})({1})... retrying.".format(e.resp.status, e.message)
-                        continue
-        return True
+                error, retry_after = e.resp.status, e.resp.get('retry-after')
+            except (socket.error, httplib.HTTPException) as e:
+                self.metrics.observe('upload chunk', time.time() - chunk_started, error=True)
+                error, retry_after = e, None
+            else:
+                self.metrics.observe('upload chunk', time.time() - chunk_started)
+                sent = (media_body.size() or request.resumable_progress) if response else request.resumable_progress
+                self.metrics.add('bytes', 'upload', sent - progress)
+                self.scheduler.throttle_upload(sent - progress)
+                chunks += 1
+                retries = 0
+                if status:
+                    chunk_size.update(request.resumable_progress - progress, time.time() - chunk_started)
+                if session_callback and request.resumable_uri != session_uri:
+                    session_uri = request.resumable_uri
+                    session_callback(session_uri)
+                continue
+
+            if retries >= self.upload_retries:
+                log("Retries limit exceeded uploading {0}! Aborting".format(filename), file=filename)
+                return False
+            retries += 1
+            total_retries += 1
+            self.metrics.add('retries', 'upload')
+            delay = retry_delay(retries, retry_after)
+            log("Error ({0}) uploading {1}... retrying in {2:.1f} seconds.".format(error, filename, delay),
+                file=filename, error=str(error), delay=round(delay, 3))
+            time.sleep(delay)
+            if request.resumable_uri:
+                # Ask Drive how much of the file it kept ourselves: the client library's own check fails on the 308
+                # without a Range header that Drive answers with when it has none of the file yet
+                response = self.resume_upload_session(request, request.resumable_uri, media_body.size(), filename)
+                request._in_error_state = False
+
+        elapsed = time.time() - started
+        uploaded = (media_body.size() or request.resumable_progress) - start_progress
+        log("Uploaded {0}: {1} bytes in {2:.1f} seconds ({3:.2f} MB/s), {4} chunks, last chunk {5} KB, {6} retries".
+            format(filename, uploaded, elapsed, uploaded / max(elapsed, 0.001) / (1024 * 1024), chunks,
+                   chunk_size.size / 1024, total_retries),
+            file=filename, bytes=uploaded, seconds=round(elapsed, 3), chunks=chunks, retries=total_retries)
+        return response
+
+    @staticmethod
+    def resume_upload_session(request, session_uri, size, filename):
+        """Points an upload request at a resumable upload session opened by an earlier run, after asking Drive how many
+        bytes of the file that session already holds.
+
+        request: The files().create request for the upload, not yet started
+
+        session_uri: URI of the earlier upload session
+
+        size: Total size of the upload in bytes, or None if unknown
+
+        filename: Name of the file, used for logging
+
+        Returns the Drive API's response for the new file if the session had already received the whole file,
+        otherwise None. If the session has expired, the request is left alone and will open a new session.
+        """
+        resp, content = request.http.request(session_uri, 'PUT', headers={
+            'Content-Length': '0',
+            'Content-Range': 'bytes */{0}'.format(size if size is not None else '*')})
+        if resp.status in (200, 201):
+            log("The last run already finished uploading {0}".format(filename))
+            return json.loads(content)
+        if resp.status == 308:
+            request.resumable_uri = str(session_uri)  # Unicode when read back from the journal
+            request.resumable_progress = int(resp['range'].split('-')[1]) + 1 if 'range' in resp else 0
+            log("Resuming the upload of {0} at byte {1}".format(filename, request.resumable_progress))
+        else:
+            log("The upload session for {0} from the last run has expired ({1}). Starting over.".format(filename, resp.status))
+        return None
 
     def find_or_create_top_folder(self, host, host_username):
         """Finds or creates the top level folder all of a user's recorded meetings will go in.
 
-        host: the host dict from our meetings array
+        host: the Host of our meetings
 
         host_username: host email stripped of '@' and anything after it
 
         Returns top_folder
+
+        Results are memoized for the run. Concurrent calls for the same host wait on a single lookup or creation, so a
+        host never gets two top level folders or two share notifications.
         """
-        user_recordings_folder_list = self.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomUserId' and value='" + str(host['id']) + "'}").execute()['files']
+        return self.top_folders.get(str(host.id), lambda: self._find_or_create_top_folder(host, host_username))
+
+    def _find_or_create_top_folder(self, host, host_username):
+        drive_id = self.index.top_folder(host.id)
+        if drive_id:
+            return dict(id=drive_id)
+        # Once the index has been loaded from Drive, a miss in the index means the folder has to be created
+        if self.index.bootstrapped:
+            user_recordings_folder_list = []
+        else:
+            with self.metrics.timer('drive query'):
+                user_recordings_folder_list = self.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomUserId' and value='" + str(host.id) + "'}").execute()['files']
         if len(user_recordings_folder_list) > 0:
             top_folder = user_recordings_folder_list[0]
         else:
-            top_folder = self.drive.files().create(body=dict(name="{0} Zoom Recorded Meetings".format(
-                                                                host_username),
-                                                             appProperties={'zoomUserId': host['id']},
-                                                             mimeType="application/vnd.google-apps.folder"),
-                                                   fields='id').execute()
-            self.share_document(document_id=top_folder['id'], user=host['email'], message="This folder containing your recorded Zoom meetings should show in your \"Shared with Me\" view in Google Drive.")
+            with self.metrics.timer('drive create'):
+                top_folder = self.drive.files().create(body=self.top_folder_body(host, host_username),
+                                                       fields='id').execute()
+            self.grant_top_folder(host, top_folder['id'])
+            self.shares.add_top_folder(host, top_folder['id'])
+        self.index.record_top_folder(host.id, top_folder['id'])
         return top_folder
 
     def find_or_create_meeting_folder(self, folder_name, zoom_meeting_id, top_folder, host):
@@ -277,17 +1054,38 @@ class ZoomOut:
 
         Returns meeting_folder
         """
-        meeting_folder_list = self.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomMeetingId' and value='" + str(zoom_meeting_id) + "'}").execute()['files']
+        drive_id = self.index.meeting_folder(zoom_meeting_id)
+        if drive_id:
+            return dict(id=drive_id)
+        if self.index.bootstrapped:
+            meeting_folder_list = []
+        else:
+            with self.metrics.timer('drive query'):
+                meeting_folder_list = self.drive.files().list(q="mimeType = 'application/vnd.google-apps.folder' and appProperties has { key='zoomMeetingId' and value='" + str(zoom_meeting_id) + "'}").execute()['files']
         if len(meeting_folder_list) < 1:
-            meeting_folder = self.drive.files().create(body=dict(name=folder_name,
-                                                                 parents=[top_folder['id']],
-                                                                 mimeType="application/vnd.google-apps.folder",
-                                                                 appProperties={'zoomMeetingId': zoom_meeting_id}),
-                                                       fields='id').execute()
+            with self.metrics.timer('drive create'):
+                meeting_folder = self.drive.files().create(body=self.meeting_folder_body(folder_name, zoom_meeting_id, top_folder),
+                                                           fields='id').execute()
         else:
             meeting_folder = meeting_folder_list[0]
+        self.index.record_meeting_folder(zoom_meeting_id, meeting_folder['id'])
         return meeting_folder
 
+    @staticmethod
+    def top_folder_body(host, host_username):
+        """Returns the Drive file resource for a new top level folder holding a host's recorded meetings"""
+        return dict(name="{0} Zoom Recorded Meetings".format(host_username),
+                    appProperties={'zoomUserId': host.id},
+                    mimeType="application/vnd.google-apps.folder")
+
+    @staticmethod
+    def meeting_folder_body(folder_name, zoom_meeting_id, top_folder):
+        """Returns the Drive file resource for a new meeting folder inside a host's top level folder"""
+        return dict(name=folder_name,
+                    parents=[top_folder['id']],
+                    mimeType="application/vnd.google-apps.folder",
+                    appProperties={'zoomMeetingId': zoom_meeting_id})
+
     def drive_file_exists(self, zoom_file_id):
         """
         Checks to see if a file with a given Zoom file id exists among the archived Zoom files. The file id is stored in an appProperties field called zoomFileId.
@@ -296,7 +1094,12 @@ class ZoomOut:
 
         Returns True or False
         """
-        matches = self.drive.files().list(q="appProperties has { key='zoomFileId' and value='" + zoom_file_id + "'}").execute()['files']
+        if self.index.file_state(zoom_file_id):
+            return True
+        if self.index.bootstrapped:
+            return False
+        with self.metrics.timer('drive query'):
+            matches = self.drive.files().list(q="appProperties has { key='zoomFileId' and value='" + zoom_file_id + "'}").execute()['files']
         return len(matches) > 0
 
     def share_document(self, document_id, user, message):
@@ -310,12 +1113,57 @@ class ZoomOut:
 
         Returns the Drive API's response. When successful, that is a "drive_service" object that you can make API calls on.
         """
-        return self.drive.permissions().create(fileId=document_id,
-                                               sendNotificationEmail=True,
-                                               emailMessage=message,
-                                               body={'emailAddress': user,
-                                                     'role': 'writer',
-                                                     'type': 'user'}).execute()
+        with self.metrics.timer('drive share'):
+            return self.share_request(document_id, user, message).execute()
+
+    def share_request(self, document_id, user, message):
+        """Builds the unexecuted permissions().create request behind share_document, so it can go in a DriveBatch. A
+        message of None grants the permission without a notification email."""
+        kwargs = dict(fileId=document_id,
+                      sendNotificationEmail=message is not None,
+                      body={'emailAddress': user,
+                            'role': 'writer',
+                            'type': 'user'})
+        if message is not None:
+            kwargs['emailMessage'] = message
+        return self.drive.permissions().create(**kwargs)
+
+    def grant_top_folder(self, host, folder_id):
+        """Grants a newly created top level folder to its host without a notification, which waits for the digest sent
+        by flush_shares. A failed grant is logged and left to flush_shares. Returns nothing."""
+        from apiclient import errors
+        try:
+            with self.metrics.timer('drive share'):
+                self.share_request(folder_id, host.email, None).execute()
+        except errors.HttpError as e:
+            log("Couldn't share folder {0} with {1}: {2}".format(folder_id, host.email, e), host=host.email)
+        else:
+            self.journal.record('shared', host=host.email, folder=folder_id)
+
+    def record_share(self, host, document_id):
+        """Returns a DriveBatch callback for a grant of document_id to host, which journals it or logs its failure"""
+        def callback(response, exception):
+            if exception:
+                log("Couldn't share folder {0} with {1}: {2}".format(document_id, host.email, exception),
+                    host=host.email)
+            else:
+                self.journal.record('shared', host=host.email, folder=document_id)
+        return callback
+
+    def flush_shares(self):
+        """Grants every host in the share queue their folder, with one digest notification each, in batched Drive
+        requests. Each grant is written to the journal. Returns nothing."""
+        grants = self.shares.drain(self.index.top_folder)
+        if not grants:
+            return
+        from drive_batch import DriveBatch
+        batch = DriveBatch(self.drive, metrics=self.metrics)
+        for host, document_id, message in grants:
+            batch.add(self.share_request(document_id, host.email, message), callback=self.record_share(host, document_id))
+        failures = batch.execute()
+        hosts = len(set(host.id for host, document_id, message in grants))
+        log("Shared folders with {0} hosts in {1} grants, {2} failed".format(hosts, len(grants), failures),
+            hosts=hosts, grants=len(grants), failed=failures)
 
     def remove_from_drive(self, document_id):
         """Removes the file from Google Drive
@@ -324,7 +1172,21 @@ class ZoomOut:
 
         Returns nothing
         """
-        self.drive.files().delete(fileId=document_id).execute()
+        with self.metrics.timer('drive delete'):
+            self.drive.files().delete(fileId=document_id).execute()
+
+    def write_metrics(self, **details):
+        """Writes the run's metrics summary as JSON to metrics_path, and in the Prometheus text format to
+        prometheus_path when one was given, then logs the totals. details, like finished=True, are added to the
+        summary. Returns nothing."""
+        summary = self.metrics.summary(**details)
+        try:
+            self.metrics.write_summary(self.metrics_path, **details)
+            if self.prometheus_path:
+                self.metrics.write_prometheus(self.prometheus_path)
+        except (IOError, OSError) as exc:
+            log("Couldn't write the metrics: {0}".format(exc))
+        log("Run summary written to {0}".format(self.metrics_path), elapsed=summary['elapsed'], totals=summary['totals'])
 
     def write_done_file(self):
         done_file = open(self.done_file_path, 'wb')
@@ -336,6 +1198,10 @@ class ZoomOut:
         """Runs the authorization routine for a Google service account. Uses a JSON keyfile client_secrets.json
         :return: Resource object for interacting with Drive API v3
         """
+        from googleapiclient.discovery import build_from_document
+        from oauth2client.service_account import ServiceAccountCredentials
+        from httplib2 import Http
+
         # Authorize with Google API
         #scopes = ['https://www.googleapis.com/auth/drive']
         scopes = ['https://www.googleapis.com/auth/drive.file',
@@ -346,19 +1212,125 @@ class ZoomOut:
             log("You need to set environment variable GOOGLE_AUTH_JSON with the path to a client secrets json file with a type value of \"service account\". {0}".format(exc.message))
             exit()
         http_auth = credentials.authorize(Http())
-        drive = build('drive', 'v3', http=http_auth)
+        # Same as build('drive', 'v3'), with the discovery document cached on disk instead of fetched every time
+        discovery = load_discovery_document(os.environ.get('ZOOMOUT_DISCOVERY_PATH', 'drive_v3_discovery.json'))
+        drive = build_from_document(discovery, http=http_auth)
         return drive
 
 
+def parse_args(argv):
+    """Parses the command line. Returns an argparse Namespace."""
+    parser = argparse.ArgumentParser(description="Archives aging Zoom cloud recordings in Google Drive.")
+    parser.add_argument('limit', nargs='?',
+                        help="Number of hours to wait before archiving a Zoom recording. Defaults to 1.")
+    parser.add_argument('--download-workers', type=int, default=2,
+                        help="Number of recording files downloaded from Zoom at the same time. Defaults to 2.")
+    parser.add_argument('--upload-workers', type=int, default=2,
+                        help="Number of recording files uploaded to Drive at the same time. Defaults to 2.")
+    parser.add_argument('--delete-workers', type=int, default=1,
+                        help="Number of recording files deleted from Zoom at the same time. Defaults to 1.")
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help="Number of downloaded files allowed to wait on disk for an upload worker, and of recording "
+                             "files waiting to be downloaded. Defaults to 4.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Pipe recording files from Zoom straight into Drive without writing them to disk.")
+    parser.add_argument('--stream-chunk-size', type=int, default=16,
+                        help="Megabytes sent in the first Drive request of each upload in streaming mode. Later "
+                             "chunks adapt to the measured throughput. Defaults to 16.")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="Rebuild the local state index from a full Drive listing before archiving.")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="Number of meetings whose missing Drive folders are created together in batched "
+                             "requests. Defaults to 50.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Pick up where an unfinished previous run left off, using its journal.")
+    parser.add_argument('--zoom-concurrency', type=int, default=8,
+                        help="Number of Zoom API calls in flight at once. Defaults to 8.")
+    parser.add_argument('--min-chunk-size', type=int, default=1,
+                        help="Smallest Drive upload chunk in megabytes. Defaults to 1.")
+    parser.add_argument('--max-chunk-size', type=int, default=64,
+                        help="Largest Drive upload chunk in megabytes, which bounds the memory each streaming upload "
+                             "worker uses. Defaults to 64.")
+    parser.add_argument('--upload-retries', type=int, default=10,
+                        help="Times in a row a failed upload chunk is retried before giving up on the file. "
+                             "Defaults to 10.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only ask Zoom for each host's recordings since the last incremental run, plus the ones it "
+                             "left pending.")
+    parser.add_argument('--shard', type=Shard.parse, metavar='I/N',
+                        help="Archive only the hosts of shard I out of N, numbered from 1, e.g. 3/8. Each shard writes "
+                             "its own done file, state index, journal and metrics.")
+    parser.add_argument('--coordinate', type=int, metavar='N',
+                        help="Don't archive anything. Wait for the done files of all N shards, then write the done file "
+                             "and a combined metrics summary.")
+    parser.add_argument('--coordinate-timeout', type=float, metavar='MINUTES',
+                        help="Minutes --coordinate waits for the shards before giving up. Defaults to no limit.")
+    parser.add_argument('--priority', choices=POLICIES, default='listing',
+                        help="Order to archive meetings in: as Zoom lists them (the default), oldest recording first, or "
+                             "largest meeting first. The last two list every eligible meeting before starting.")
+    parser.add_argument('--bandwidth-limit', type=float, metavar='MB_PER_SECOND',
+                        help="Cap on megabytes per second downloaded from Zoom, and on megabytes per second uploaded to "
+                             "Drive, across all workers. Defaults to no cap.")
+    parser.add_argument('--time-budget', type=float, metavar='MINUTES',
+                        help="Minutes after which no new recording file is started. What is left is recorded for the "
+                             "next run. Defaults to no limit.")
+    parser.add_argument('--dry-run', '--list', dest='dry_run', action='store_true',
+                        help="Only list the meetings that would be archived and the bytes Zoom reports for them. "
+                             "Nothing is downloaded, and Drive isn't contacted.")
+    parser.add_argument('--prometheus-file', metavar='PATH',
+                        help="Also write the run's metrics to PATH in the Prometheus text format, e.g. for "
+                             "node_exporter's textfile collector.")
+    return parser.parse_args(argv)
+
+
+def zoomout_options(args):
+    """Translates the command line options from parse_args into keyword arguments for ZoomOut, other than limit"""
+    return dict(download_workers=args.download_workers,
+                upload_workers=args.upload_workers,
+                delete_workers=args.delete_workers,
+                queue_size=args.queue_size,
+                stream=args.stream,
+                stream_chunksize=max(1, args.stream_chunk_size) * 1024 * 1024,
+                reconcile=args.reconcile,
+                batch_size=max(1, args.batch_size),
+                resume=args.resume,
+                zoom_concurrency=max(1, args.zoom_concurrency),
+                min_chunksize=max(1, args.min_chunk_size) * 1024 * 1024,
+                max_chunksize=max(1, args.max_chunk_size) * 1024 * 1024,
+                upload_retries=max(0, args.upload_retries),
+                prometheus_path=args.prometheus_file,
+                incremental=args.incremental,
+                shard=args.shard,
+                priority=args.priority,
+                bandwidth_limit=args.bandwidth_limit * 1024 * 1024 if args.bandwidth_limit else None,
+                time_budget=args.time_budget * 60 if args.time_budget is not None else None,
+                dry_run=args.dry_run)
+
+
 if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.coordinate:
+        try:
+            done_file_path = os.environ['ZOOMOUT_DONEFILE_PATH']
+        except KeyError:
+            log("Aborting: You need to set the ZOOMOUT_DONEFILE_PATH variable so the script knows which done files to wait for.")
+            sys.exit(1)
+        finished = wait_for_shards(done_file_path, args.coordinate,
+                                   metrics_path=os.environ.get('ZOOMOUT_METRICS_PATH',
+                                                               ZoomOut.default_metrics_path(done_file_path)),
+                                   timeout=args.coordinate_timeout * 60 if args.coordinate_timeout else None)
+        sys.exit(0 if finished else 1)
     try:
-        lim = int(sys.argv[1])
+        lim = int(args.limit)
     except ValueError as e:
         log("Correct Usage: zoomout.py N   where N is an integer representing the number of hours to wait before archiving a Zoom recording. Using the default 1 hour...")
         lim = 1
-    except IndexError as e:
+    except TypeError as e:
         log("No argument provided. Archiving Zoom meetings over an hour old ...")
         lim = 1
 
-    za = ZoomOut(limit=lim)
-    za.main()
+    za = ZoomOut(limit=lim, **zoomout_options(args))
+    if args.dry_run:
+        za.list_eligible()
+    else:
+        za.main()